@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+
+"""
+Microbenchmarks for the plugin's hot paths.
+
+Run from the repo root:
+
+    python contrib/benchmark.py event
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+
+def timed(label: str, fn, n: int):
+    """run fn n times, print per-op time and peak allocation"""
+    fn()  # warm up
+
+    start = time.perf_counter()
+    for _ in range(n):
+        fn()
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{label:<32} {elapsed / n * 1e6:10.2f} us/op "
+          f"{n / elapsed:12.0f} op/s {peak:8d} B peak/op")
+
+
+def bench_event(args):
+    from coincurve import PrivateKey
+    from lib.event import Event
+    from lib.nip47 import NIP47Request
+
+    client = PrivateKey()
+    wallet_pubkey = PrivateKey().public_key.format()[1:].hex()
+
+    request = Event(kind=23194, content="x" * 200,
+                    tags=[["p", wallet_pubkey]])
+    request.sign(privkey=client.secret.hex())
+    evt_json = request.event_data()
+
+    def parse():
+        req = NIP47Request.from_JSON(evt_json)
+        req.tags.p_tags
+        req.pubkey
+
+    def sign():
+        evt = Event(kind=23195, content="y" * 200,
+                    tags=[["p", request.pubkey], ["e", request.id]])
+        evt.sign(privkey=client.secret.hex())
+        evt.event_data()
+
+    timed("NIP47Request.from_JSON", parse, args.n)
+    timed("Event.sign + event_data", sign, args.n)
+
+
+def bench_crypto(args):
+    from coincurve import PrivateKey
+    from lib import nip04, nip44
+
+    wallet = PrivateKey().secret.hex()
+    client = PrivateKey().public_key.format()[1:].hex()
+    message = '{"method":"pay_invoice","params":{"invoice":"' + \
+        "lnbc" * 80 + '"}}'
+
+    nip04_payload = nip04.encrypt(wallet, client, message)
+    nip44_payload = nip44.encrypt(wallet, client, message)
+
+    def nip44_uncached():
+        key = nip44.get_conversation_key(wallet, client)
+        nip44.decrypt_with_key(key, nip44_payload)
+        nip44.encrypt_with_key(key, message)
+
+    timed("nip04 decrypt + encrypt", lambda: (
+        nip04.decrypt(wallet, client, nip04_payload),
+        nip04.encrypt(wallet, client, message)), args.n)
+    timed("nip44 decrypt + encrypt", lambda: (
+        nip44.decrypt(wallet, client, nip44_payload),
+        nip44.encrypt(wallet, client, message)), args.n)
+    timed("nip44 without key cache", nip44_uncached, args.n)
+
+
+def bench_pool(args):
+    import asyncio
+    from coincurve import PrivateKey
+    from lib import crypto
+
+    wallet = PrivateKey()
+    wallet_secret = wallet.secret.hex()
+    wallet_pubkey = wallet.public_key.format()[1:].hex()
+    clients = [PrivateKey() for _ in range(64)]
+    message = '{"method":"get_info","params":{}}'
+    requests = [(client.public_key.format()[1:].hex(),
+                 crypto.encrypt("nip04", client.secret.hex(),
+                                wallet_pubkey, message))
+                for client in clients]
+
+    async def handle(i):
+        client_pubkey, content = requests[i % len(requests)]
+        payload = await crypto.run("decrypt", "nip04", wallet_secret,
+                                   client_pubkey, content)
+        encrypted = await crypto.run("encrypt", "nip04", wallet_secret,
+                                     client_pubkey, payload)
+        await crypto.run("sign", {
+            "kind": 23195, "content": encrypted, "pubkey": wallet_pubkey,
+            "tags": [["p", client_pubkey]], "created_at": int(time.time())
+        }, wallet_secret)
+
+    async def burst(n):
+        await asyncio.gather(*(handle(i) for i in range(n)))
+
+    cores = os.cpu_count() or 1
+    sizes = sorted({0, 1, 2, 4, 8, cores} - {s for s in (8, 4, 2) if s > cores})
+    for workers in sizes:
+        crypto.configure(workers)
+        asyncio.run(burst(workers * 8))  # start the workers
+
+        start = time.perf_counter()
+        asyncio.run(burst(args.n))
+        elapsed = time.perf_counter() - start
+
+        print(f"{'workers=' + str(workers):<32} {args.n / elapsed:12.0f} "
+              f"requests/s {elapsed / args.n * 1e6:10.2f} us/request")
+    crypto.configure(0)
+
+
+def bench_startup(args):
+    import statistics
+    import subprocess
+
+    src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+    runs = min(args.n, 20)
+
+    def measure(label, code):
+        times = []
+        for _ in range(runs):
+            out = subprocess.run(
+                [sys.executable, '-c',
+                 'import time; start = time.perf_counter(); ' + code +
+                 '; print(time.perf_counter() - start)'],
+                cwd=src, capture_output=True, text=True, check=True)
+            times.append(float(out.stdout.split()[-1]))
+        print(f"{label:<32} {statistics.median(times) * 1000:10.1f} ms median "
+              f"{min(times) * 1000:10.1f} ms min ({runs} runs)")
+
+    # what lightningd waits for before getmanifest/init
+    measure("import nwc", 'import nwc')
+    # what load() imports in the background after init returned
+    measure("import nwc + deferred modules",
+            'import nwc, lib.nip47, lib.store, lib.wallet, lib.crypto')
+
+
+def bench_local_relay(args):
+    import asyncio
+    import json
+    import statistics
+    import websockets
+    from coincurve import PrivateKey
+    from lib.event import Event
+    from lib.local_relay import LocalRelay
+
+    wallet = PrivateKey().secret.hex()
+    client = PrivateKey().secret.hex()
+    runs = min(args.n, 1000)
+
+    async def run():
+        relay = LocalRelay("127.0.0.1", 0)
+        await relay.start()
+        port = relay._server.sockets[0].getsockname()[1]
+
+        # stands in for LocalWallet: answer every request in-process
+        async def answer(request):
+            response = Event(kind=23195, content=request["content"],
+                             tags=[["p", request["pubkey"]], ["e", request["id"]]])
+            response.sign(privkey=wallet)
+            await relay.publish(response.event_data())
+        relay.subscribe_local("requests", {"kinds": [23194]}, answer)
+
+        latencies = []
+        async with websockets.connect(f"ws://127.0.0.1:{port}") as ws:
+            await ws.send(json.dumps(["REQ", "responses", {"kinds": [23195]}]))
+            await ws.recv()  # EOSE
+            for _ in range(runs):
+                request = Event(kind=23194, content="x" * 200)
+                request.sign(privkey=client)
+                frame = json.dumps(["EVENT", request.event_data()])
+
+                start = time.perf_counter()
+                await ws.send(frame)
+                await ws.recv()  # OK
+                await ws.recv()  # the response
+                latencies.append(time.perf_counter() - start)
+        await relay.stop()
+        return sorted(latencies)
+
+    latencies = asyncio.run(run())
+    print(f"{'local relay round trip':<32} "
+          f"{statistics.median(latencies) * 1000:10.2f} ms p50 "
+          f"{latencies[int(len(latencies) * 0.99)] * 1000:10.2f} ms p99 ({runs} requests)")
+
+
+def bench_log(args):
+    from lib.log import logger
+    from utilities.rpc_plugin import plugin
+
+    # stands in for the notification to lightningd
+    plugin.log = lambda message, level='info': None
+    payload = {"method": "pay_invoice", "params": {"invoice": "lnbc" * 80},
+               "preimage": "00" * 32}
+
+    def line():
+        logger.debug("request", "nwc request executed", connection="ab" * 32,
+                     method="pay_invoice", latency_ms=1.5, params=payload)
+
+    logger.configure("info")
+    timed("below level", line, args.n)
+    logger.configure("debug", {"request": 100}, rate=0)
+    timed("sampled 1 in 100", line, args.n)
+    logger.configure("debug", rate=20)
+    timed("rate capped at 20/s", line, args.n)
+    logger.configure("debug", rate=0)
+    timed("emitted", line, args.n)
+
+
+def bench_usage(args):
+    from lib.usage import ConnectionUsage, RequestUsage, UsageTracker
+    from lib.utils import generate_secrets
+
+    tracker = UsageTracker()
+    pubkeys = [pubkey for _, pubkey in generate_secrets(10000)]
+    methods = ["get_balance", "get_balance", "list_transactions", "pay_invoice"]
+    i = 0
+
+    def add():
+        nonlocal i
+        i += 1
+        tracker.add(RequestUsage(pubkeys[i % len(pubkeys)], methods[i % len(methods)],
+                                 paid_msat=1000 if i % 4 == 3 else 0, rpc_seconds=0.002))
+
+    timed("UsageTracker.add, 10k connections", add, args.n)
+    timed("nwc-usage top 20 of 10k", lambda: tracker.top(limit=20), max(1, args.n // 10000))
+
+    tracemalloc.start()
+    connections = [ConnectionUsage() for _ in range(100)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{'memory per connection':<32} {size // len(connections):10d} B")
+
+
+def serve_fake_rpc(path: str, results: dict):
+    """a lightningd JSON-RPC socket answering each method with a fixed result"""
+    import json
+    import socket
+    import threading
+
+    def handle(conn):
+        buff = ""
+        decoder = json.JSONDecoder()
+        with conn:
+            while True:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                buff += data.decode()
+                while buff.strip():
+                    try:
+                        request, end = decoder.raw_decode(buff.lstrip())
+                    except ValueError:
+                        break
+                    buff = buff.lstrip()[end:]
+                    conn.sendall(json.dumps({
+                        "jsonrpc": "2.0", "id": request["id"],
+                        "result": results[request["method"]]
+                    }).encode() + b"\n\n")
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(64)
+
+    def accept():
+        while True:
+            conn, _ = server.accept()
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+
+
+def bench_shards(args):
+    import asyncio
+    import tempfile
+    from coincurve import PrivateKey
+    from lib import nip04, shards
+    from lib.event import Event
+    from lib.store import ConnectionStore
+    from lib.usage import UsageTracker
+    from lib.utils import generate_secrets
+    from utilities.rpc_plugin import plugin
+
+    # the workers' log lines and usage end up here, not on lightningd's stdout
+    plugin.log = lambda message, level='info': None
+    plugin.usage = UsageTracker()
+
+    data_dir = tempfile.mkdtemp()
+    rpc_path = os.path.join(data_dir, "lightning-rpc")
+    wallet = PrivateKey()
+    wallet_pubkey = wallet.public_key.format()[1:].hex()
+    serve_fake_rpc(rpc_path, {
+        "listdatastore": {"datastore": [
+            {"key": ["nwc", "key", "v0"], "string": wallet.secret.hex()}]},
+        "getinfo": {"id": "02" * 33, "alias": "bench", "network": "regtest",
+                    "blockheight": 1}
+    })
+
+    clients = generate_secrets(256)
+    store = ConnectionStore(os.path.join(data_dir, "connections.sqlite3"))
+    store.insert_many([{"pubkey": pubkey, "secret": secret, "relay_url": "ws://bench"}
+                       for secret, pubkey in clients])
+
+    requests = []
+    for secret, _ in clients:
+        event = Event(kind=23194, tags=[["p", wallet_pubkey]], content=nip04.encrypt(
+            secret, wallet_pubkey, '{"method":"get_info","params":{}}'))
+        event.sign(privkey=secret)
+        requests.append(event.event_data())
+
+    async def burst(pool, n):
+        await asyncio.gather(*(pool.submit(requests[i % len(requests)])
+                               for i in range(n)))
+
+    cores = os.cpu_count() or 1
+    for workers in sorted({1, 2, 4, cores} - {s for s in (2, 4) if s > cores}):
+        pool = shards.ShardPool(workers, {
+            "data_dir": data_dir, "rpc_path": rpc_path,
+            # the requests are signed once up front, keep them all valid
+            "request_max_age": 0,
+            "log": {"level": "info"},
+            "capture": None
+        })
+        pool.start()
+        # workers start, load their tenants and fill the get_info cache
+        asyncio.run(burst(pool, len(requests)))
+
+        start = time.perf_counter()
+        asyncio.run(burst(pool, args.n))
+        elapsed = time.perf_counter() - start
+        pool.stop()
+
+        print(f"{'shards=' + str(workers):<32} {args.n / elapsed:12.0f} "
+              f"requests/s {elapsed / args.n * 1e6:10.2f} us/request")
+
+
+def replay_keys(args) -> dict:
+    """{datastore key: privkey hex} of the wallet service keys, from --key or the node"""
+    from lib.store import DEFAULT_TENANT
+    from lib.tenants import KEY_BASE
+
+    keys = {}
+    if args.lightning_dir:
+        from pyln.client import LightningRpc
+        rpc = LightningRpc(os.path.join(args.lightning_dir, "lightning-rpc"))
+        for entry in rpc.listdatastore(key=KEY_BASE)["datastore"]:
+            if "string" in entry:
+                keys[tuple(entry["key"])] = entry["string"]
+    for value in args.key or []:
+        name, _, privkey = value.rpartition("=")
+        keys[tuple(KEY_BASE + [name or DEFAULT_TENANT])] = privkey
+    return keys
+
+
+def bench_replay(args):
+    import asyncio
+    import sqlite3
+    import statistics
+    import tempfile
+    from lib.admission import AdmissionFilter, LoadShedder
+    from lib.cache import ResponseCache
+    from lib.capture import ReplayRpc, read_recording
+    from lib.coalesce import SingleFlight
+    from lib.journal import SpendJournal
+    from lib.nip47 import NIP47URI
+    from lib.payments import PaymentRegistry
+    from lib.store import ConnectionStore
+    from lib.tenants import TenantRegistry
+    from lib.usage import UsageTracker, time_rpc
+    from lib.wallet import respond, MAX_CONCURRENT_REQUESTS
+    from utilities.rpc_plugin import plugin
+
+    events, calls = read_recording(args.recording)
+    if not events:
+        sys.exit(f"no events in {args.recording}")
+    # the recording has no keys, see Recorder
+    keys = replay_keys(args)
+    if not keys:
+        sys.exit("the wallet keys aren't in the recording, pass --lightning-dir or --key")
+
+    # the replay spends the connections' budgets, on a copy of the store
+    data_dir = tempfile.mkdtemp()
+    store_path = os.path.join(data_dir, "connections.sqlite3")
+    with sqlite3.connect(os.path.join(args.data_dir, "connections.sqlite3")) as source, \
+            sqlite3.connect(store_path) as copy:
+        source.backup(copy)
+
+    plugin.log = lambda message, level='info': None
+    plugin.rpc = ReplayRpc(calls, keys)
+    time_rpc(plugin.rpc)
+    plugin.shards = None
+    plugin.capture = None
+    plugin.store = ConnectionStore(store_path)
+    plugin.journal = SpendJournal(os.path.join(data_dir, "spends.journal"), plugin.store)
+    plugin.journal.start()
+    plugin.tenants = TenantRegistry(plugin.store)
+    plugin.tenants.load(plugin)
+    plugin.pubkey = plugin.tenants.default.pubkey
+    plugin.responses = ResponseCache()
+    plugin.payments = PaymentRegistry()
+    plugin.coalescer = SingleFlight()
+    plugin.shedder = LoadShedder()
+    plugin.usage = UsageTracker()
+    # the recorded requests are old by now, their created_at only paces the replay
+    plugin.request_max_age = 0
+    plugin.admission = AdmissionFilter(max_age=float("inf"))
+    plugin.admission.load(NIP47URI.find_all(status="active"))
+
+    async def run(speed):
+        slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        latencies = []
+        start = time.perf_counter()
+        first = events[0]["t"]
+
+        async def handle(event_data, due):
+            async with slots:
+                if plugin.admission.admit(event_data):
+                    await respond(event_data)
+                    # from when it was due, so queueing counts
+                    latencies.append(time.perf_counter() - due)
+
+        tasks = []
+        for record in events:
+            due = start + (record["t"] - first) / speed if speed else start
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(handle(record["event"], due)))
+        await asyncio.gather(*tasks)
+        return latencies, time.perf_counter() - start
+
+    label = f"{args.speed:g}x" if args.speed else "max"
+    latencies, elapsed = asyncio.run(run(args.speed))
+    plugin.journal.stop()
+
+    latencies.sort()
+    print(f"{'replay ' + label:<32} {len(events)} events, {len(latencies)} requests "
+          f"in {elapsed:.2f}s, {len(latencies) / elapsed:.0f} requests/s")
+    if latencies:
+        print(f"{'latency':<32} {statistics.median(latencies) * 1000:10.2f} ms p50 "
+              f"{latencies[int(len(latencies) * 0.99)] * 1000:10.2f} ms p99 "
+              f"{latencies[-1] * 1000:10.2f} ms max")
+    print(f"{'dropped by admission':<32} {dict(plugin.admission.rejected)}")
+    print(f"{'load shedding':<32} {plugin.shedder.stats()}")
+    print(f"{'rpc calls not in recording':<32} {plugin.rpc.missed}")
+    for usage in plugin.usage.top(limit=3):
+        print(f"{'busiest ' + usage['pubkey'][:16]:<32} {usage['since_start']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=10000,
+                        help='iterations per benchmark')
+    sub = parser.add_subparsers(dest='bench', required=True)
+    sub.add_parser('event', help='event parsing and signing')
+    sub.add_parser('crypto', help='nip04 vs nip44 throughput')
+    sub.add_parser('pool', help='request crypto throughput by worker count')
+    sub.add_parser('startup', help='plugin import time, -n caps at 20 runs')
+    sub.add_parser('log', help='cost of a request log line by outcome')
+    sub.add_parser('usage', help='per-connection usage accounting cost and memory')
+    sub.add_parser('shards', help='get_info requests/s through 1, 2, 4, ... '
+                   'shard workers against a fake lightningd')
+    replay = sub.add_parser('replay', help='feed a recording (see --nwc-capture) '
+                            'through the request path against its recorded RPC responses')
+    replay.add_argument('recording', help='the --nwc-capture file')
+    replay.add_argument('--data-dir', required=True,
+                        help="the plugin's nwc data dir, its connections are copied")
+    replay.add_argument('--speed', type=float, default=1,
+                        help='1 for recorded pace, 10 for 10x, 0 for as fast as possible')
+    replay.add_argument('--lightning-dir',
+                        help="read the wallet keys from this node's datastore")
+    replay.add_argument('--key', action='append',
+                        help='[tenant=]privkey hex of a wallet key, the default '
+                        'tenant without a name, repeat for more tenants')
+    sub.add_parser('local-relay', help='request/response round trip through '
+                   'the embedded relay, -n caps at 1000')
+
+    args = parser.parse_args()
+    {
+        'event': bench_event,
+        'crypto': bench_crypto,
+        'pool': bench_pool,
+        'startup': bench_startup,
+        'local-relay': bench_local_relay,
+        'log': bench_log,
+        'usage': bench_usage,
+        'replay': bench_replay,
+        'shards': bench_shards,
+    }[args.bench](args)
+
+
+if __name__ == '__main__':
+    main()
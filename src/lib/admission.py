@@ -0,0 +1,317 @@
+"""
+Cheap checks on incoming events, run before any crypto or RPC work
+"""
+
+import base64
+import struct
+import threading
+import time
+from collections import Counter, OrderedDict
+from enum import Enum
+
+NIP47_REQUEST_KIND = 23194
+
+# NIP-47 requests are small json payloads, anything bigger is not for us
+MAX_CONTENT_LENGTH = 64 * 1024
+
+# requests older than this are dropped, apps have long given up on them
+MAX_CREATED_AT_AGE = 60 * 60
+
+# tolerate some clock drift on the client
+MAX_CREATED_AT_SKEW = 5 * 60
+
+# remember this many admitted event ids to drop relay replays
+SEEN_EVENTS = 10000
+# a remembered event in dump_seen(), its id and created_at
+SEEN_RECORD = struct.Struct(">32sI")
+
+# admitted requests not executed within this many seconds of created_at
+# are answered with an error instead, see deadline()
+REQUEST_MAX_AGE = 60
+
+# requests executing at once before LoadShedder turns requests away,
+# below Wallet's MAX_CONCURRENT_REQUESTS so shedding starts before the
+# relay socket backs up
+MAX_IN_FLIGHT = 48
+# reads are shed from this many on, payments keep the remaining slots
+MAX_READS_IN_FLIGHT = 24
+
+# a tenant's share of those while other tenants have requests executing,
+# a tenant on its own can use all of them
+TENANT_MAX_IN_FLIGHT = MAX_IN_FLIGHT // 2
+TENANT_MAX_READS_IN_FLIGHT = MAX_READS_IN_FLIGHT // 2
+
+# methods that don't move funds, the first to go under overload
+READ_METHODS = {"get_info", "get_balance", "lookup_invoice", "list_transactions"}
+
+
+class RejectReason(Enum):
+    MALFORMED = "malformed"
+    KIND = "kind"
+    TOO_LARGE = "too_large"
+    UNKNOWN_PUBKEY = "unknown_pubkey"
+    CONNECTION_EXPIRED = "connection_expired"
+    STALE = "stale"
+    FUTURE = "future"
+    EVENT_EXPIRED = "event_expired"
+    DUPLICATE = "duplicate"
+
+
+def deadline(evt_json: dict, max_age: int = REQUEST_MAX_AGE) -> int:
+    """
+    unix time after which the request isn't executed anymore: created_at
+    plus max_age or its NIP-40 expiration, whichever is earlier. None
+    without either (max_age 0)
+    """
+    deadlines = []
+    if max_age and isinstance(evt_json.get("created_at"), int):
+        deadlines.append(evt_json["created_at"] + max_age)
+    for tag in evt_json.get("tags", ()):
+        if len(tag) >= 2 and tag[0] == "expiration":
+            try:
+                deadlines.append(int(tag[1]))
+            except (TypeError, ValueError):
+                pass
+            break
+    return min(deadlines, default=None)
+
+
+class AdmissionFilter:
+    """
+    Ordered admission stage for incoming events.
+
+    Works on the raw event dict as received from the relay so that unknown
+    or expired senders are dropped before an Event is built, the content is
+    decrypted or the datastore is queried.
+    """
+
+    def __init__(self, max_content_length: int = MAX_CONTENT_LENGTH,
+                 max_age: int = MAX_CREATED_AT_AGE,
+                 max_skew: int = MAX_CREATED_AT_SKEW):
+        self.max_content_length = max_content_length
+        self.max_age = max_age
+        self.max_skew = max_skew
+
+        # client pubkey (hex) -> expiry_unix or None
+        self._active: dict[str, int] = {}
+        # called with (added, removed) pubkeys whenever the active set changes
+        self._listeners = []
+        # admitted event id -> its created_at, oldest admitted first
+        self._seen = OrderedDict()
+        # admit() runs on the relay thread, dump_seen() on the Snapshotter's
+        self._seen_lock = threading.Lock()
+
+        self.admitted = 0
+        self.rejected = Counter()
+
+    def add_listener(self, listener):
+        """listener(added: list[str], removed: list[str]), called from any thread"""
+        self._listeners.append(listener)
+
+    def _notify(self, added, removed):
+        for listener in self._listeners:
+            listener(added, removed)
+
+    def add(self, pubkey: str, expiry_unix: int = None):
+        """allow requests from a connection"""
+        self._active[pubkey] = expiry_unix
+        self._notify([pubkey], [])
+
+    def remove(self, pubkey: str):
+        """stop accepting requests from a connection"""
+        if self._active.pop(pubkey, False) is not False:
+            self._notify([], [pubkey])
+
+    def load(self, connections):
+        """replace the active set with the given NIP47URIs"""
+        self.load_entries((nwc.pubkey, nwc.expiry_unix) for nwc in connections)
+
+    def load_entries(self, entries):
+        """replace the active set with (pubkey, expiry_unix) pairs"""
+        previous = self._active
+        self._active = dict(entries)
+        self._notify([pk for pk in self._active if pk not in previous],
+                     [pk for pk in previous if pk not in self._active])
+
+    def entries(self) -> list[tuple[str, int]]:
+        """snapshot of the active (pubkey, expiry_unix) pairs"""
+        return list(self._active.items())
+
+    def dump_seen(self, now: int = None) -> str:
+        """
+        the remembered events check() wouldn't reject as stale anyway,
+        packed (see SEEN_RECORD) and base64 encoded for restore_seen()
+        """
+        cutoff = (now or int(time.time())) - self.max_age
+        with self._seen_lock:
+            seen = list(self._seen.items())
+        packed = bytearray()
+        for event_id, created_at in seen:
+            if created_at < cutoff:
+                continue
+            try:
+                packed += SEEN_RECORD.pack(bytes.fromhex(event_id), created_at)
+            except (ValueError, struct.error):
+                # not a valid event, its signature check fails on a replay
+                continue
+        return base64.b64encode(packed).decode()
+
+    def restore_seen(self, data: str):
+        packed = base64.b64decode(data)
+        seen = OrderedDict(
+            (event_id.hex(), created_at)
+            for event_id, created_at in SEEN_RECORD.iter_unpack(packed))
+        while len(seen) > SEEN_EVENTS:
+            seen.popitem(last=False)
+        with self._seen_lock:
+            self._seen = seen
+
+    @property
+    def pubkeys(self) -> list[str]:
+        """snapshot of the active client pubkeys"""
+        return list(self._active)
+
+    def __contains__(self, pubkey: str):
+        return pubkey in self._active
+
+    def __len__(self):
+        return len(self._active)
+
+    def check(self, evt_json: dict, now: int = None) -> RejectReason:
+        """
+        Run the checks in order of cost, return the first failing reason or
+        None if the event should be processed.
+        """
+        try:
+            kind = evt_json["kind"]
+            content = evt_json["content"]
+            pubkey = evt_json["pubkey"]
+            created_at = evt_json["created_at"]
+            tags = evt_json["tags"]
+            event_id = evt_json["id"]
+        except (KeyError, TypeError):
+            return RejectReason.MALFORMED
+
+        if event_id in self._seen:
+            return RejectReason.DUPLICATE
+
+        if kind != NIP47_REQUEST_KIND:
+            return RejectReason.KIND
+
+        if not isinstance(content, str) or len(content) > self.max_content_length:
+            return RejectReason.TOO_LARGE
+
+        if pubkey not in self._active:
+            return RejectReason.UNKNOWN_PUBKEY
+
+        if now is None:
+            now = int(time.time())
+
+        expiry_unix = self._active.get(pubkey)
+        if expiry_unix and now > expiry_unix:
+            return RejectReason.CONNECTION_EXPIRED
+
+        if not isinstance(created_at, int):
+            return RejectReason.MALFORMED
+        if created_at < now - self.max_age:
+            return RejectReason.STALE
+        if created_at > now + self.max_skew:
+            return RejectReason.FUTURE
+
+        # NIP-40
+        for tag in tags:
+            if len(tag) >= 2 and tag[0] == "expiration":
+                try:
+                    if int(tag[1]) < now:
+                        return RejectReason.EVENT_EXPIRED
+                except (TypeError, ValueError):
+                    return RejectReason.MALFORMED
+                break
+
+        return None
+
+    def admit(self, evt_json: dict, now: int = None) -> bool:
+        """check the event and count the outcome"""
+        reason = self.check(evt_json, now)
+        if reason:
+            self.rejected[reason.value] += 1
+            return False
+
+        with self._seen_lock:
+            self._seen[evt_json["id"]] = evt_json["created_at"]
+            if len(self._seen) > SEEN_EVENTS:
+                self._seen.popitem(last=False)
+
+        self.admitted += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "active_connections": len(self._active),
+            "admitted": self.admitted,
+            "rejected": dict(self.rejected)
+        }
+
+
+class LoadShedder:
+    """
+    Bounds the requests executing at once. Reads are turned away first so
+    payments keep getting through, beyond max_in_flight everything is.
+    While several tenants have requests executing each one is held to its
+    share of both limits, so a busy tenant can't take the others' slots.
+    Turned away requests are answered with RATE_LIMITED right away, which
+    keeps latency bounded instead of queueing them.
+    """
+
+    def __init__(self, max_in_flight: int = MAX_IN_FLIGHT,
+                 max_reads_in_flight: int = MAX_READS_IN_FLIGHT,
+                 tenant_max_in_flight: int = TENANT_MAX_IN_FLIGHT,
+                 tenant_max_reads_in_flight: int = TENANT_MAX_READS_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self.max_reads_in_flight = max_reads_in_flight
+        self.tenant_max_in_flight = tenant_max_in_flight
+        self.tenant_max_reads_in_flight = tenant_max_reads_in_flight
+        self.in_flight = 0
+        # tenant name -> requests executing
+        self.tenants = Counter()
+
+        # method -> requests turned away
+        self.shed = Counter()
+        # tenant name -> requests turned away for being over its share
+        self.shed_tenant = Counter()
+        # requests answered with an error because their deadline passed
+        self.expired = 0
+
+    def acquire(self, method: str, tenant: str = None) -> bool:
+        """False if the request should be shed, release(tenant) after True"""
+        read = method in READ_METHODS
+        limit = self.max_reads_in_flight if read else self.max_in_flight
+        if self.in_flight >= limit:
+            self.shed[method] += 1
+            return False
+
+        own = self.tenants[tenant]
+        tenant_limit = self.tenant_max_reads_in_flight if read \
+            else self.tenant_max_in_flight
+        if own >= tenant_limit and self.in_flight > own:
+            self.shed[method] += 1
+            self.shed_tenant[tenant] += 1
+            return False
+
+        self.in_flight += 1
+        self.tenants[tenant] += 1
+        return True
+
+    def release(self, tenant: str = None):
+        self.in_flight -= 1
+        self.tenants[tenant] -= 1
+        if not self.tenants[tenant]:
+            del self.tenants[tenant]
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": self.in_flight,
+            "shed": dict(self.shed),
+            "shed_tenant": dict(self.shed_tenant),
+            "expired": self.expired
+        }
@@ -0,0 +1,147 @@
+"""
+Renewable budgets backed by a fixed size ring of spend buckets
+"""
+
+import json
+import time
+from datetime import datetime, timedelta, timezone
+
+# NIP-47 budget_renewal values
+RENEWALS = ("daily", "weekly", "monthly", "yearly", "never")
+
+RING_SIZE = 32
+
+DAY = 24 * 60 * 60
+
+# bucket width for the calendar windows, the window never spans more than
+# RING_SIZE buckets so a bucket is only reused once its period is over
+BUCKET_WIDTH = {
+    "daily": 60 * 60,
+    "weekly": 6 * 60 * 60,
+    "monthly": DAY,
+    "yearly": 12 * DAY,
+}
+
+
+def period_start(renewal: str, now: int) -> int:
+    """unix time the current daily/weekly/monthly/yearly period began (UTC)"""
+    dt = datetime.fromtimestamp(now, tz=timezone.utc)
+    day = dt.replace(hour=0, minute=0, second=0, microsecond=0)
+
+    if renewal == "daily":
+        start = day
+    elif renewal == "weekly":
+        start = day - timedelta(days=day.weekday())
+    elif renewal == "monthly":
+        start = day.replace(day=1)
+    elif renewal == "yearly":
+        start = day.replace(month=1, day=1)
+    else:
+        raise ValueError(f"unknown budget renewal {renewal}")
+
+    return int(start.timestamp())
+
+
+class SpendRing:
+    """
+    Time bucketed spend totals for one connection.
+
+    Either renews on calendar periods (renewal) or covers a rolling window
+    of window_seconds. Adding a spend and summing the current window are
+    both O(RING_SIZE) no matter how many payments were made.
+    """
+    __slots__ = ('renewal', 'window_seconds', '_buckets')
+
+    def __init__(self, renewal: str = None, window_seconds: int = None):
+        if renewal not in (None, *RENEWALS):
+            raise ValueError(f"unknown budget renewal {renewal}")
+        if renewal not in (None, "never") and window_seconds:
+            raise ValueError("budget renewal and window are exclusive")
+        if window_seconds is not None and window_seconds <= 0:
+            raise ValueError("budget window must be positive")
+
+        self.renewal = renewal if renewal != "never" else None
+        self.window_seconds = window_seconds or None
+        # [[bucket_start, amount_msat], ...] indexed by slot
+        self._buckets = [[0, 0] for _ in range(RING_SIZE)]
+
+    @property
+    def renews(self) -> bool:
+        return bool(self.renewal or self.window_seconds)
+
+    def _window(self, now: int) -> tuple[int, int, int]:
+        """(window_start, bucket_width, bucket origin) at now"""
+        if self.renewal:
+            start = period_start(self.renewal, now)
+            return start, BUCKET_WIDTH[self.renewal], start
+
+        # rolling, the oldest bucket may stick out of the window which
+        # errs on the side of counting a spend for a bit longer
+        width = -(-self.window_seconds // (RING_SIZE - 1))
+        return now - self.window_seconds, width, 0
+
+    def add(self, amount_msat: int, now: int = None):
+        if now is None:
+            now = int(time.time())
+        _, width, origin = self._window(now)
+
+        index = (now - origin) // width
+        bucket_start = origin + index * width
+        bucket = self._buckets[index % RING_SIZE]
+        if bucket[0] > bucket_start:
+            # older than anything the ring still covers
+            return
+        if bucket[0] != bucket_start:
+            bucket[0], bucket[1] = bucket_start, 0
+        bucket[1] += amount_msat
+
+    def spent(self, now: int = None) -> int:
+        """total spent in the current window"""
+        if now is None:
+            now = int(time.time())
+        window_start, width, _ = self._window(now)
+        if self.renewal:
+            # buckets start at the period start, the previous period's last
+            # bucket can reach past it
+            oldest = window_start
+        else:
+            oldest = window_start - width + 1
+
+        return sum(amount for bucket_start, amount in self._buckets
+                   if oldest <= bucket_start <= now)
+
+    def next_renewal(self, now: int = None) -> int:
+        """unix time the calendar budget renews, None for rolling windows"""
+        if not self.renewal:
+            return None
+        if now is None:
+            now = int(time.time())
+        start = period_start(self.renewal, now)
+
+        if self.renewal == "daily":
+            return start + DAY
+        if self.renewal == "weekly":
+            return start + 7 * DAY
+        dt = datetime.fromtimestamp(start, tz=timezone.utc)
+        if self.renewal == "monthly":
+            if dt.month == 12:
+                return int(dt.replace(year=dt.year + 1, month=1).timestamp())
+            return int(dt.replace(month=dt.month + 1).timestamp())
+        return int(dt.replace(year=dt.year + 1).timestamp())
+
+    def dumps(self) -> str:
+        # only keep used buckets
+        return json.dumps([b for b in self._buckets if b[1]],
+                          separators=(',', ':'))
+
+    @staticmethod
+    def from_record(record: dict):
+        """load the ring from a ConnectionStore record"""
+        ring = SpendRing(record.get("budget_renewal"),
+                         record.get("budget_window"))
+        if record.get("spend_ring") and ring.renews:
+            for bucket_start, amount in json.loads(record["spend_ring"]):
+                _, width, origin = ring._window(bucket_start)
+                index = (bucket_start - origin) // width
+                ring._buckets[index % RING_SIZE] = [bucket_start, amount]
+        return ring
@@ -0,0 +1,143 @@
+"""
+Cache for the read-only NIP-47 methods, invalidated by node notifications
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# settled/expired lookup_invoice results kept, least recently used dropped first
+LOOKUP_CACHE_SIZE = 10000
+
+# pending invoices/payments can change any moment, payment notifications
+# invalidate them earlier
+PENDING_TTL = 5
+
+# get_info is refreshed on block_added, this is a fallback in case one is missed
+INFO_MAX_AGE = 10 * 60
+
+
+class ResponseCache:
+    """
+    Per method policies:
+
+    get_info: one entry, dropped when the block height changes
+    lookup_invoice: settled or expired results are final and kept in an
+        LRU, anything still pending only for PENDING_TTL seconds or until a
+        payment notification for its payment_hash
+
+    Handlers run on the relay thread while notifications arrive on the
+    plugin thread, so everything is under one lock.
+    """
+
+    def __init__(self, lookup_size: int = LOOKUP_CACHE_SIZE,
+                 pending_ttl: int = PENDING_TTL):
+        self.lookup_size = lookup_size
+        self.pending_ttl = pending_ttl
+
+        self._lock = threading.Lock()
+        # (value, cached_at)
+        self._info = None
+        # ("payment_hash", hash) or ("invoice", bolt11) -> (result, valid_until or None)
+        self._lookups: OrderedDict[tuple, tuple] = OrderedDict()
+        # payment_hash -> lookup keys holding a result for it
+        self._by_hash: dict[str, set] = {}
+
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = Counter()
+
+    def get_info(self, now: float = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            if self._info and now - self._info[1] < INFO_MAX_AGE:
+                self.hits["get_info"] += 1
+                return self._info[0]
+            self.misses["get_info"] += 1
+            return None
+
+    def put_info(self, result: dict, now: float = None):
+        with self._lock:
+            self._info = (result, time.time() if now is None else now)
+
+    def on_block(self):
+        """block_added, the cached block height is outdated"""
+        with self._lock:
+            if self._info:
+                self.evictions["get_info"] += 1
+            self._info = None
+
+    @staticmethod
+    def lookup_key(payment_hash: str = None, invoice: str = None) -> tuple:
+        if payment_hash:
+            return ("payment_hash", payment_hash)
+        return ("invoice", invoice)
+
+    def get_lookup(self, key: tuple, now: float = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._lookups.get(key)
+            if entry is not None:
+                result, valid_until = entry
+                if valid_until is None or now < valid_until:
+                    self._lookups.move_to_end(key)
+                    self.hits["lookup_invoice"] += 1
+                    return result
+                self._drop(key)
+                self.evictions["lookup_invoice"] += 1
+            self.misses["lookup_invoice"] += 1
+            return None
+
+    def put_lookup(self, key: tuple, result: dict, now: float = None):
+        now = time.time() if now is None else now
+        final = bool(result.get("settled_at")) or \
+            bool(result.get("expires_at") and result["expires_at"] < now
+                 and result.get("type") == "incoming")
+        valid_until = None if final else now + self.pending_ttl
+
+        with self._lock:
+            self._drop(key)
+            self._lookups[key] = (result, valid_until)
+            payment_hash = result.get("payment_hash")
+            if payment_hash:
+                self._by_hash.setdefault(payment_hash, set()).add(key)
+
+            while len(self._lookups) > self.lookup_size:
+                self._drop(next(iter(self._lookups)))
+                self.evictions["lookup_invoice"] += 1
+
+    def on_payment(self, payment_hash: str):
+        """invoice_payment/sendpay_success/sendpay_failure, the lookup changed"""
+        with self._lock:
+            for key in list(self._by_hash.get(payment_hash, ())):
+                self._drop(key)
+                self.evictions["lookup_invoice"] += 1
+
+    def _drop(self, key: tuple):
+        entry = self._lookups.pop(key, None)
+        if entry is None:
+            return
+        payment_hash = entry[0].get("payment_hash")
+        keys = self._by_hash.get(payment_hash)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_hash[payment_hash]
+
+    def stats(self) -> dict:
+        def method_stats(method):
+            hits, misses = self.hits[method], self.misses[method]
+            return {
+                "hits": hits,
+                "misses": misses,
+                "evictions": self.evictions[method],
+                "hit_rate": round(hits / (hits + misses), 3) if hits + misses else None
+            }
+
+        return {
+            "get_info": method_stats("get_info"),
+            "lookup_invoice": {
+                "size": len(self._lookups),
+                **method_stats("lookup_invoice")
+            }
+        }
@@ -0,0 +1,164 @@
+"""
+Record the inbound request stream and the RPC responses, for replaying
+production-shaped traffic offline (see contrib/benchmark.py replay)
+"""
+
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+from pyln.client import LightningRpc, RpcError
+
+REDACTED = "<redacted>"
+
+# the wallet service keys are datastore values, makesecret makes new ones
+DATASTORE_VALUES = ("string", "hex")
+
+
+def redact_rpc(method: str, payload, result):
+    """(payload, result) of a call without the private keys in them"""
+    if method == "datastore" and isinstance(payload, dict):
+        payload = {key: REDACTED if key in DATASTORE_VALUES and value else value
+                   for key, value in payload.items()}
+    if isinstance(result, dict):
+        if method == "listdatastore":
+            result = {**result, "datastore": [
+                {key: REDACTED if key in DATASTORE_VALUES else value
+                 for key, value in entry.items()}
+                for entry in result.get("datastore", [])]}
+        elif method in ("datastore", "makesecret"):
+            result = {key: REDACTED if key in DATASTORE_VALUES + ("secret",) else value
+                      for key, value in result.items()}
+    return payload, result
+
+
+def rpc_key(method: str, payload) -> str:
+    """match calls by method and the params that were set"""
+    if isinstance(payload, dict):
+        payload = {key: value for key, value in payload.items() if value is not None}
+    return method + " " + json.dumps(payload, sort_keys=True, default=str)
+
+
+class Recorder:
+    """
+    Appends one json line per inbound event (as received, still encrypted)
+    and per RPC call. Each line is a single write on an O_APPEND file, so
+    the shard workers record into the same file.
+
+    Datastore values and new secrets are redacted, they are the wallet
+    service keys. The recording still holds preimages, it is created
+    readable by the owner only.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self._file = os.fdopen(fd, "ab", buffering=0)
+        self._lock = threading.Lock()
+        self.events = 0
+        self.rpc_calls = 0
+
+    def _write(self, record: dict):
+        line = json.dumps(record, default=str, separators=(",", ":")) + "\n"
+        with self._lock:
+            if not self._file.closed:
+                self._file.write(line.encode())
+
+    def on_event(self, relay: str, event_data: dict):
+        """an event read from a relay, before admission"""
+        self.events += 1
+        self._write({"t": time.time(), "type": "event", "relay": relay,
+                     "event": event_data})
+
+    def wrap_rpc(self, rpc):
+        """record every call of rpc from now on, with its result or error"""
+        call = rpc.call
+
+        def recorded_call(method, payload=None, *args, **kwargs):
+            start = time.time()
+            record = {"t": start, "type": "rpc", "method": method}
+            result = None
+            try:
+                result = call(method, payload, *args, **kwargs)
+                return result
+            except RpcError as e:
+                record["error"] = e.error
+                raise
+            finally:
+                record["params"], redacted = redact_rpc(method, payload, result)
+                if "error" not in record:
+                    record["result"] = redacted
+                record["ms"] = round((time.time() - start) * 1000, 3)
+                self.rpc_calls += 1
+                self._write(record)
+
+        rpc.call = recorded_call
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def stats(self) -> dict:
+        return {
+            "path": self.path,
+            "events": self.events,
+            "rpc_calls": self.rpc_calls
+        }
+
+
+def read_recording(path: str) -> tuple[list[dict], list[dict]]:
+    """(event records, rpc records) each ordered by time"""
+    events, calls = [], []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            (events if record["type"] == "event" else calls).append(record)
+    events.sort(key=lambda record: record["t"])
+    calls.sort(key=lambda record: record["t"])
+    return events, calls
+
+
+class ReplayRpc(LightningRpc):
+    """
+    Answers calls with the recorded responses to the same method and
+    params, in recorded order, repeating the last one when they run out.
+    Calls that were never recorded get the most recent response to the
+    method, or an RpcError without one.
+
+    The recording has no keys, listdatastore calls are answered from
+    keys instead, {datastore key (list): string value}.
+    """
+
+    def __init__(self, calls: list[dict], keys: dict = None):
+        super().__init__("replay")
+        self._keys = {tuple(key): value for key, value in (keys or {}).items()}
+        self._lock = threading.Lock()
+        self._responses = defaultdict(deque)
+        self._by_method = {}
+        for record in calls:
+            self._responses[rpc_key(record["method"], record["params"])].append(record)
+            self._by_method[record["method"]] = record
+        self.missed = 0
+
+    def call(self, method, payload=None, cmdprefix=None, filter=None):
+        if method == "listdatastore":
+            prefix = tuple((payload or {}).get("key") or ())
+            return {"datastore": [{"key": list(key), "string": value}
+                                  for key, value in self._keys.items()
+                                  if key[:len(prefix)] == prefix]}
+        with self._lock:
+            responses = self._responses.get(rpc_key(method, payload))
+            if responses:
+                record = responses.popleft() if len(responses) > 1 else responses[0]
+            else:
+                self.missed += 1
+                record = self._by_method.get(method)
+        if record is None:
+            raise RpcError(method, payload, {"code": -32601,
+                                             "message": "not in the recording"})
+        if "error" in record:
+            raise RpcError(method, payload, record["error"])
+        return record["result"]
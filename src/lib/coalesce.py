@@ -0,0 +1,41 @@
+"""
+Merge identical read requests that are in flight at the same time
+"""
+
+import asyncio
+from collections import Counter
+
+
+class SingleFlight:
+    """
+    The first request for a key runs fn(), identical requests arriving
+    before it finishes wait for the same result (or exception).
+
+    Keys are tuples starting with the method name, used for the stats.
+    Only used from the relay thread's event loop.
+    """
+
+    def __init__(self):
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        self.calls = Counter()
+        self.shared = Counter()
+
+    async def do(self, key: tuple, fn):
+        future = self._inflight.get(key)
+        if future is not None:
+            self.shared[key[0]] += 1
+        else:
+            self.calls[key[0]] += 1
+            future = asyncio.ensure_future(fn())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shielded, a cancelled waiter must not cancel the others' call
+        return await asyncio.shield(future)
+
+    def stats(self) -> dict:
+        return {
+            method: {
+                "calls": self.calls[method],
+                "shared": self.shared[method]
+            } for method in self.calls
+        }
@@ -0,0 +1,178 @@
+"""
+CPU heavy event crypto (decrypt, encrypt, sign), optionally run in a
+process pool so bursts of requests can use more than one core
+"""
+
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from . import nip04, nip44
+from .event import Event
+
+# in order of preference, advertised in the info event
+ENCRYPTION_SCHEMES = {
+    "nip44_v2": nip44,
+    "nip04": nip04
+}
+# requests without an encryption tag are nip04
+DEFAULT_ENCRYPTION = "nip04"
+
+# jobs sent to a worker in one round trip
+CHUNK_SIZE = 32
+
+
+def decrypt(encryption: str, secret_key: str, pubkey_hex: str, data: str) -> str:
+    return ENCRYPTION_SCHEMES[encryption].decrypt(
+        secret_key=secret_key, pubkey_hex=pubkey_hex, data=data)
+
+
+def encrypt(encryption: str, secret_key: str, pubkey_hex: str, data: str) -> str:
+    return ENCRYPTION_SCHEMES[encryption].encrypt(
+        secret_key=secret_key, pubkey_hex=pubkey_hex, data=data)
+
+
+def sign(event_data: dict, privkey: str) -> dict:
+    """id + sign an unsigned event's data, returns the signed event data"""
+    event = Event(
+        kind=event_data["kind"],
+        content=event_data["content"],
+        tags=event_data["tags"],
+        pubkey=event_data["pubkey"],
+        created_at=event_data["created_at"]
+    )
+    event.sign(privkey=privkey)
+    return event.event_data()
+
+
+OPERATIONS = {
+    "decrypt": decrypt,
+    "encrypt": encrypt,
+    "sign": sign,
+    # nip44 in the pool, with the conversation key from the plugin's cache
+    "nip44_decrypt": nip44.decrypt_with_key,
+    "nip44_encrypt": nip44.encrypt_with_key,
+}
+
+
+def run_chunk(jobs: list[tuple]) -> list[tuple]:
+    """runs in a worker, [(op, args), ...] -> [(ok, result or exception), ...]"""
+    results = []
+    for op, args in jobs:
+        try:
+            results.append((True, OPERATIONS[op](*args)))
+        except Exception as e:
+            results.append((False, e))
+    return results
+
+
+class CryptoPool:
+    """
+    Process pool for the crypto operations. Jobs submitted in the same
+    event loop tick are sent to the workers in chunks of CHUNK_SIZE to
+    amortize the pickling/IPC cost.
+
+    Workers don't cache nip44 conversation keys, run() sends them along
+    from nip44.conversation_keys where revoked connections are evicted.
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        # spawn, forking a process that runs several threads is not safe
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"))
+        self._batch = []
+        self._flush_scheduled = False
+        self.chunks = 0
+        self.jobs = 0
+
+    def submit(self, op: str, *args) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._batch.append((op, args, future))
+
+        if len(self._batch) >= CHUNK_SIZE:
+            self._flush()
+        elif not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush)
+
+        return future
+
+    def _flush(self):
+        self._flush_scheduled = False
+        batch, self._batch = self._batch, []
+        if not batch:
+            return
+
+        # spread the tick's jobs over the workers
+        size = max(1, min(CHUNK_SIZE, -(-len(batch) // self.workers)))
+        for i in range(0, len(batch), size):
+            chunk = batch[i:i + size]
+            self.chunks += 1
+            self.jobs += len(chunk)
+            done = asyncio.wrap_future(self._executor.submit(
+                run_chunk, [(op, args) for op, args, _ in chunk]))
+            done.add_done_callback(
+                lambda done, futures=[f for _, _, f in chunk]:
+                    self._resolve(done, futures))
+
+    @staticmethod
+    def _resolve(done: asyncio.Future, futures: list[asyncio.Future]):
+        if done.exception():
+            for future in futures:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+
+        for future, (ok, result) in zip(futures, done.result()):
+            if future.done():
+                continue
+            if ok:
+                future.set_result(result)
+            else:
+                future.set_exception(result)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "chunks": self.chunks,
+            "jobs": self.jobs
+        }
+
+
+_pool: CryptoPool = None
+
+
+def parse_workers(value) -> int:
+    """nwc-crypto-workers option: 0 (off), a number, or "auto" for one per core"""
+    if value == "auto":
+        return os.cpu_count() or 1
+    return max(0, int(value))
+
+
+def configure(workers: int):
+    """use a pool of workers for the crypto operations, 0 runs them inline"""
+    global _pool
+    if _pool:
+        _pool.shutdown()
+    _pool = CryptoPool(workers) if workers else None
+
+
+async def run(op: str, *args):
+    """run a crypto operation, in the pool if one is configured"""
+    if _pool is None:
+        return OPERATIONS[op](*args)
+    if op in ("decrypt", "encrypt") and args[0] == "nip44_v2":
+        _, secret_key, pubkey_hex, data = args
+        return await _pool.submit(
+            f"nip44_{op}", nip44.conversation_keys.get(secret_key, pubkey_hex), data)
+    return await _pool.submit(op, *args)
+
+
+def stats() -> dict:
+    return _pool.stats() if _pool else {"workers": 0}
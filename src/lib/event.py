@@ -5,17 +5,18 @@ Defines classes for handling events
 import hashlib
 import time
 import json
-from coincurve import PrivateKey
-from .utils import get_hex_pubkey
+from coincurve import PrivateKey, PublicKeyXOnly
 
-# copied EventTags exactly from
+# EventTags started as a copy of
 # https://github.com/monty888/monstr/blob/cb728f1710dc47c8289ab0994f15c24e844cebc4/src/monstr/event/event.py
+# it now indexes the tags by name the first time they are looked up
 
 
 class EventTags:
     """
         split out so we can use event tags without have to create the whole event
     """
+    __slots__ = ('_tags', '_index')
 
     def __init__(self, tags):
         self.tags = tags
@@ -37,6 +38,20 @@ class EventTags:
         if tags is None:
             tags = []
         self._tags = tags
+        self._index = None
+
+    def _get_index(self) -> dict:
+        """
+        build {tag_name: [tag[1:], ...]} in a single pass, only once
+        """
+        index = self._index
+        if index is None:
+            index = {}
+            for c_tag in self._tags:
+                if len(c_tag) >= 1:
+                    index.setdefault(c_tag[0], []).append(c_tag[1:])
+            self._index = index
+        return index
 
     def get_tags(self, tag_name: str):
         """
@@ -45,7 +60,7 @@ class EventTags:
         :param tag_name:
         :return:
         """
-        return [t[1:] for t in self._tags if len(t) >= 1 and t[0] == tag_name]
+        return list(self._get_index().get(tag_name, ()))
 
     def get_tags_value(self, tag_name: str) -> []:
         """
@@ -54,7 +69,7 @@ class EventTags:
         :param tag_name:
         :return:
         """
-        return [t[0] for t in self.get_tags(tag_name)]
+        return [t[0] for t in self._get_index().get(tag_name, ()) if t]
 
     def get_tag_value_pos(self, tag_name: str, pos: int = 0,
                           default: str = None) -> str:
@@ -75,21 +90,21 @@ class EventTags:
     @property
     def tag_names(self) -> set:
         # return all unique tag names
-        return {c_tag[0] for c_tag in self._tags if len(c_tag) > 0}
+        return set(self._get_index())
 
     @property
     def e_tags(self):
         """
         :return: all ref'd events/#e tag in [evt_id, evt_id,...] makes sure evt_id is correct len
         """
-        return [t[0] for t in self.get_tags('e') if len(t[0]) == 64]
+        return [v for v in self.get_tags_value('e') if len(v) == 64]
 
     @property
     def p_tags(self):
         """
         :return: all ref'd profile/#p tag in [pub_k, pub_k,...] makes sure pub_k is correct len
         """
-        return [t[0] for t in self.get_tags('p') if len(t[0]) == 64]
+        return [v for v in self.get_tags_value('p') if len(v) == 64]
 
     def __str__(self):
         return json.dumps(self._tags)
@@ -104,13 +119,27 @@ class EventTags:
         for c_tag in self._tags:
             yield c_tag
 
+
+def _to_bytes(value):
+    """hex str -> bytes, bytes and None are passed through"""
+    if value is None or isinstance(value, bytes):
+        return value
+    return bytes.fromhex(value)
+
 # copied some + adapted to use coincurve from
 # https://github.com/monty888/monstr/blob/cb728f1710dc47c8289ab0994f15c24e844cebc4/src/monstr/event/event.py
 
 
 class Event:
-    @staticmethod
-    def from_JSON(evt_json):
+    """
+    A nostr event. id, pubkey and sig are held as raw bytes, the hex
+    versions are only produced when they are asked for.
+    """
+    __slots__ = ('_id', '_sig', '_kind', '_created_at', '_content',
+                 '_pubkey', '_tags', '_serialized')
+
+    @classmethod
+    def from_JSON(cls, evt_json):
         """
         TODO: add option to verify sig/eror if invalid?
         creates an event object from json - at the moment this must be a full event, has id and has been signed,
@@ -118,20 +147,22 @@ class Event:
         :param evt_json: json to create the event, as you'd recieve from subscription
         :return:
         """
-        return Event(
-            id=evt_json['id'],
-            sig=evt_json['sig'],
-            kind=evt_json['kind'],
-            content=evt_json['content'],
-            tags=evt_json['tags'],
-            pubkey=evt_json['pubkey'],
-            created_at=evt_json['created_at']
-        )
+        # fill the slots directly, this runs once per event off the relay
+        evt = cls.__new__(cls)
+        evt._id = bytes.fromhex(evt_json['id'])
+        evt._sig = bytes.fromhex(evt_json['sig'])
+        evt._kind = evt_json['kind']
+        evt._created_at = evt_json['created_at']
+        evt._content = str(evt_json['content'])
+        evt._pubkey = bytes.fromhex(evt_json['pubkey'])
+        evt._tags = EventTags(evt_json['tags'])
+        evt._serialized = None
+        return evt
 
     def __init__(self, id=None, sig=None, kind=None, content=None,
                  tags=None, pubkey=None, created_at=None):
-        self._id = id
-        self._sig = sig
+        self._id = _to_bytes(id)
+        self._sig = _to_bytes(sig)
         self._kind = kind
         self._created_at = created_at
         # normally the case when creating a new event
@@ -141,28 +172,63 @@ class Event:
         # content forced to str
         self._content = str(content)
 
-        self._pubkey = pubkey
+        self._pubkey = _to_bytes(pubkey)
 
-        self._tags = EventTags(tags)
+        self._tags = tags if isinstance(tags, EventTags) else EventTags(tags)
+        self._serialized = None
+
+    @property
+    def id(self) -> str:
+        """hex event id"""
+        return self._id.hex() if self._id is not None else None
+
+    @property
+    def pubkey(self) -> str:
+        """hex x-only pubkey of the author"""
+        return self._pubkey.hex() if self._pubkey is not None else None
+
+    @property
+    def sig(self) -> str:
+        """hex schnorr signature"""
+        return self._sig.hex() if self._sig is not None else None
+
+    @property
+    def kind(self) -> int:
+        return self._kind
+
+    @property
+    def created_at(self) -> int:
+        return self._created_at
+
+    @property
+    def content(self) -> str:
+        return self._content
+
+    @property
+    def tags(self) -> EventTags:
+        return self._tags
 
     def serialize(self):
         """
             see https://github.com/fiatjaf/nostr/blob/master/nips/01.md
         """
+        if self._serialized is not None:
+            return self._serialized
+
         if self._pubkey is None:
             raise Exception(
                 'Event::serialize can\'t be done unless pub key is set')
 
-        ret = json.dumps([
+        self._serialized = json.dumps([
             0,
-            self._pubkey,
+            self._pubkey.hex(),
             self._created_at,
             self._kind,
             self._tags.tags,
             self._content
         ], separators=(',', ':'), ensure_ascii=False)
 
-        return ret
+        return self._serialized
 
     def _get_id(self):
         """
@@ -170,32 +236,44 @@ class Event:
             pub key must be set to generate the id
         """
         evt_str = self.serialize()
-        self._id = hashlib.sha256(evt_str.encode('utf-8')).hexdigest()
+        self._id = hashlib.sha256(evt_str.encode('utf-8')).digest()
 
     def sign(self, privkey: str):
         """
         Sign the event and set event's public key if not already set.
         """
+        pk = PrivateKey(bytes.fromhex(privkey))
+
         if self._pubkey is None:
-            self._pubkey = get_hex_pubkey(privkey)
+            self._pubkey = pk.public_key.format()[1:]
+            self._serialized = None
 
         self._get_id()
 
-        pk = PrivateKey(bytes.fromhex(privkey))
+        self._sig = pk.sign_schnorr(message=self._id, aux_randomness=None)
 
-        id_bytes = (bytes(bytearray.fromhex(self._id)))
-        sig = pk.sign_schnorr(message=id_bytes, aux_randomness=None)
-        sig_hex = sig.hex()
-
-        self._sig = sig_hex
+    def verify(self) -> bool:
+        """
+        check the id is the hash of the event and the sig is the author's,
+        relays do this for us, the embedded relay has to do it itself
+        """
+        if self._id is None or self._sig is None or self._pubkey is None:
+            return False
+        evt_id = hashlib.sha256(self.serialize().encode('utf-8')).digest()
+        if evt_id != self._id:
+            return False
+        try:
+            return PublicKeyXOnly(self._pubkey).verify(self._sig, self._id)
+        except ValueError:
+            return False
 
     def event_data(self):
         return {
-            'id': self._id,
-            'pubkey': self._pubkey,
+            'id': self.id,
+            'pubkey': self.pubkey,
             'created_at': self._created_at,
             'kind': self._kind,
             'tags': self._tags.tags,
             'content': self._content,
-            'sig': self._sig
+            'sig': self.sig
         }
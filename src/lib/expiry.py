@@ -0,0 +1,106 @@
+"""
+Expire connections when they reach their expiry_unix
+"""
+
+import heapq
+import threading
+import time
+
+
+class ExpiryScheduler:
+    """
+    Keeps a min-heap of connection deadlines and sleeps until the earliest
+    one, instead of polling. Rescheduled or cancelled connections are left
+    in the heap and skipped when they come up.
+    """
+
+    def __init__(self, on_expire):
+        self._on_expire = on_expire
+        self._heap: list[tuple[int, str]] = []
+        # pubkey -> current deadline, anything else in the heap is stale
+        self._deadlines: dict[str, int] = {}
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    def schedule(self, pubkey: str, expiry_unix: int):
+        """expire pubkey once expiry_unix has passed"""
+        if not expiry_unix:
+            return self.cancel(pubkey)
+
+        with self._cond:
+            self._deadlines[pubkey] = expiry_unix
+            heapq.heappush(self._heap, (expiry_unix, pubkey))
+            # only wake the thread if this is the new earliest deadline
+            if self._heap[0][1] == pubkey:
+                self._cond.notify()
+
+    def cancel(self, pubkey: str):
+        with self._cond:
+            self._deadlines.pop(pubkey, None)
+
+    def load(self, entries):
+        """schedule every (pubkey, expiry_unix) pair that has an expiry"""
+        with self._cond:
+            for pubkey, expiry_unix in entries:
+                if expiry_unix:
+                    self._deadlines[pubkey] = expiry_unix
+                    self._heap.append((expiry_unix, pubkey))
+            heapq.heapify(self._heap)
+            self._cond.notify()
+
+    @property
+    def next_deadline(self) -> int:
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def _drop_stale(self):
+        while self._heap:
+            deadline, pubkey = self._heap[0]
+            if self._deadlines.get(pubkey) == deadline:
+                return
+            heapq.heappop(self._heap)
+
+    def _pop_expired(self) -> list[str]:
+        """wait for the next deadline, return the pubkeys that expired"""
+        with self._cond:
+            while self._running:
+                self._drop_stale()
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                now = time.time()
+                deadline = self._heap[0][0]
+                # expired means now > expiry_unix, see NIP47URI.expired
+                if int(now) <= deadline:
+                    self._cond.wait(deadline + 1 - now)
+                    continue
+
+                expired = []
+                while self._heap and int(now) > self._heap[0][0]:
+                    deadline, pubkey = heapq.heappop(self._heap)
+                    if self._deadlines.get(pubkey) == deadline:
+                        del self._deadlines[pubkey]
+                        expired.append(pubkey)
+                return expired
+            return []
+
+    def _run(self):
+        while self._running:
+            for pubkey in self._pop_expired():
+                self._on_expire(pubkey)
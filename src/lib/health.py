@@ -0,0 +1,116 @@
+"""
+Relay health: latency, errors, disconnects and delivery lag, folded into a score
+"""
+
+import time
+from collections import Counter
+
+# weight of the newest sample in the moving averages
+EWMA_ALPHA = 0.2
+
+# ms of penalty per unit, lower scores are better
+LAG_PENALTY_MS = 100          # per second of delivery lag
+ERROR_PENALTY_MS = 2000       # at a 100% error rate
+DISCONNECT_PENALTY_MS = 1000  # per disconnect in the last DISCONNECT_WINDOW
+DISCONNECT_WINDOW = 60 * 60
+
+# score above which a relay only gets responses when better ones are missing
+DEGRADED_SCORE_MS = 2000
+
+
+def ewma(average: float, sample: float) -> float:
+    if average is None:
+        return sample
+    return EWMA_ALPHA * sample + (1 - EWMA_ALPHA) * average
+
+
+class RelayHealth:
+    """
+    Moving averages of ping and OK round trips and of delivery lag (when
+    an event arrives minus its created_at), plus error and disconnect
+    counts, for one relay.
+    """
+
+    def __init__(self, url: str):
+        self.url = url
+        self.connected = False
+        self.connected_at = None
+        self.ping_ms = None
+        self.ack_ms = None
+        self.lag_s = None
+        self.counters = Counter()
+        self._disconnects = []
+
+    def on_connect(self):
+        self.connected = True
+        self.connected_at = time.time()
+        self.counters["connects"] += 1
+
+    def on_disconnect(self):
+        if self.connected:
+            self._disconnects.append(time.time())
+            self.counters["disconnects"] += 1
+        self.connected = False
+
+    def on_ping(self, rtt: float):
+        self.ping_ms = ewma(self.ping_ms, rtt * 1000)
+
+    def on_ack(self, latency: float, accepted: bool = True):
+        self.ack_ms = ewma(self.ack_ms, latency * 1000)
+        self.counters["acked" if accepted else "rejected"] += 1
+
+    def on_error(self):
+        self.counters["errors"] += 1
+
+    def on_event(self, created_at: int, now: float = None):
+        now = time.time() if now is None else now
+        # a client clock ahead of ours isn't negative lag
+        self.lag_s = ewma(self.lag_s, max(0.0, now - created_at))
+        self.counters["events"] += 1
+
+    def recent_disconnects(self, now: float = None) -> int:
+        now = time.time() if now is None else now
+        self._disconnects = [t for t in self._disconnects
+                             if now - t < DISCONNECT_WINDOW]
+        return len(self._disconnects)
+
+    def error_rate(self) -> float:
+        failed = self.counters["rejected"] + self.counters["errors"]
+        total = failed + self.counters["acked"]
+        return failed / total if total else 0.0
+
+    def score(self) -> float:
+        """estimated ms a response spends on this relay plus penalties, None when down"""
+        if not self.connected:
+            return None
+        latencies = [ms for ms in (self.ping_ms, self.ack_ms) if ms is not None]
+        score = max(latencies) if latencies else 0.0
+        score += (self.lag_s or 0) * LAG_PENALTY_MS
+        score += self.error_rate() * ERROR_PENALTY_MS
+        score += self.recent_disconnects() * DISCONNECT_PENALTY_MS
+        return score
+
+    @property
+    def state(self) -> str:
+        score = self.score()
+        if score is None:
+            return "down"
+        if score > DEGRADED_SCORE_MS:
+            return "degraded"
+        return "healthy"
+
+    def stats(self) -> dict:
+        def rounded(value):
+            return round(value, 1) if value is not None else None
+
+        return {
+            "state": self.state,
+            "score": rounded(self.score()),
+            "ping_ms": rounded(self.ping_ms),
+            "ack_ms": rounded(self.ack_ms),
+            "delivery_lag_s": rounded(self.lag_s),
+            "error_rate": round(self.error_rate(), 3),
+            "recent_disconnects": self.recent_disconnects(),
+            "connected_at": self.connected_at,
+            **dict(self.counters)
+        }
@@ -0,0 +1,216 @@
+"""
+Append-only spend journal with group commit, compacted into the ConnectionStore
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from concurrent.futures import Future
+from .budget import SpendRing
+from .store import JOURNAL_SEQ
+
+# wait this long for more spends to share an fsync with
+GROUP_COMMIT_DELAY = 0.002
+
+# fold the journal into the store after this long or this many spends
+COMPACT_INTERVAL = 10
+COMPACT_RECORDS = 1000
+
+
+class SpendJournal:
+    """
+    Every settled payment is appended as one json line
+    [seq, pubkey, amount_msat, created_at, payment_hash]. A writer thread fsyncs the
+    spends appended meanwhile together, append() resolves once its spend
+    is durable.
+
+    Until compaction the store doesn't know about journaled spends,
+    apply_pending() adds them to a store record. Compaction writes them
+    to the store together with the last applied seq, so replaying a
+    journal that wasn't truncated yet can't count a spend twice.
+    """
+
+    def __init__(self, path: str, store, compact_interval: int = COMPACT_INTERVAL,
+                 compact_records: int = COMPACT_RECORDS, seq_key: str = JOURNAL_SEQ):
+        self.path = path
+        self.store = store
+        # each shard worker has its own journal and seq, see lib.shards
+        self.seq_key = seq_key
+        self.compact_interval = compact_interval
+        self.compact_records = compact_records
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        # [(record, future)] waiting for the writer
+        self._queue = []
+        # durable but not compacted: pubkey -> [(amount_msat, created_at, payment_hash)]
+        self._pending: dict[str, list] = {}
+        self._records = []
+        self._seq = store.journal_seq(seq_key)
+        self._file = None
+        self._running = False
+        self._last_compaction = time.monotonic()
+
+        self.commits = 0
+        self.spends = 0
+        self.compactions = 0
+
+    def replay(self) -> int:
+        """apply the spends a previous run journaled but didn't compact, returns their count"""
+        applied = self.store.journal_seq(self.seq_key)
+        records = []
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # torn write of the last line, never acknowledged
+                        break
+                    if record[0] > applied:
+                        records.append(record)
+
+        if records:
+            self.store.apply_spends(records, self.seq_key)
+        self._seq = max([self._seq, applied] + [r[0] for r in records])
+
+        # start over with an empty journal
+        with open(self.path, "w") as f:
+            os.fsync(f.fileno())
+        return len(records)
+
+    def start(self):
+        self._file = open(self.path, "a")
+        self._running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+    def append(self, pubkey: str, amount_msat: int, created_at: int = None,
+               payment_hash: str = None) -> Future:
+        """journal a spend, the future resolves once it is on disk"""
+        future = Future()
+        with self._cond:
+            self._seq += 1
+            record = [self._seq, pubkey, amount_msat,
+                      created_at or int(time.time()), payment_hash]
+            self._queue.append((record, future))
+            self._cond.notify()
+        return future
+
+    async def record(self, pubkey: str, amount_msat: int, created_at: int = None,
+                     payment_hash: str = None):
+        """append() for the event loop"""
+        await asyncio.wrap_future(
+            self.append(pubkey, amount_msat, created_at, payment_hash))
+
+    def has_spend(self, pubkey: str, payment_hash: str) -> bool:
+        """whether the payment's spend is journaled or in the store"""
+        with self._lock:
+            if any(spend[2] == payment_hash for spend in self._pending.get(pubkey, ())):
+                return True
+            return self.store.has_spend(pubkey, payment_hash)
+
+    def get(self, pubkey: str) -> dict:
+        """store.get() with the not yet compacted spends, never races a compaction"""
+        with self._lock:
+            record = self.store.get(pubkey)
+            spends = list(self._pending.get(pubkey, ()))
+        return self._with_spends(record, spends) if record else None
+
+    def apply_pending(self, record: dict) -> dict:
+        """a store record with the not yet compacted spends added"""
+        with self._lock:
+            spends = list(self._pending.get(record["pubkey"], ()))
+        return self._with_spends(record, spends)
+
+    @staticmethod
+    def _with_spends(record: dict, spends: list) -> dict:
+        if not spends:
+            return record
+
+        record = dict(record)
+        record["spent_msat"] = (record.get("spent_msat") or 0) + \
+            sum(amount for amount, _, _ in spends)
+        ring = SpendRing.from_record(record)
+        if ring.renews:
+            for amount, created_at, _ in spends:
+                ring.add(amount, created_at)
+            record["spend_ring"] = ring.dumps()
+        return record
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._queue and self._running:
+                    self._cond.wait(self.compact_interval)
+                if not self._running:
+                    return
+            # let concurrent payments join this commit
+            time.sleep(GROUP_COMMIT_DELAY)
+
+            with self._cond:
+                batch, self._queue = self._queue, []
+                if batch:
+                    self._commit(batch)
+
+            if self._records and (
+                    len(self._records) >= self.compact_records or
+                    time.monotonic() - self._last_compaction >= self.compact_interval):
+                self.compact()
+
+    def _commit(self, batch):
+        """caller holds the lock"""
+        try:
+            self._file.write("".join(
+                json.dumps(record, separators=(',', ':')) + "\n"
+                for record, _ in batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for record, future in batch:
+            _, pubkey, amount_msat, created_at, payment_hash = record
+            self._pending.setdefault(pubkey, []).append(
+                (amount_msat, created_at, payment_hash))
+            self._records.append(record)
+            future.set_result(record[0])
+        self.commits += 1
+        self.spends += len(batch)
+
+    def compact(self):
+        """write the journaled spends to the store and truncate the journal"""
+        # under the lock so get() sees a spend either journaled or in the store
+        with self._lock:
+            records = self._records
+            if not records:
+                return
+
+            self.store.apply_spends(records, self.seq_key)
+            self._records = []
+            self._pending = {}
+
+            self._file.close()
+            with open(self.path, "w") as f:
+                os.fsync(f.fileno())
+            self._file = open(self.path, "a")
+
+        self.compactions += 1
+        self._last_compaction = time.monotonic()
+
+    def stats(self) -> dict:
+        return {
+            "spends": self.spends,
+            "commits": self.commits,
+            "spends_per_commit": round(self.spends / self.commits, 2) if self.commits else None,
+            "pending": len(self._records),
+            "compactions": self.compactions
+        }
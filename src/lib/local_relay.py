@@ -0,0 +1,300 @@
+"""
+Embedded relay for apps on the same host or LAN, NWC kinds only
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from collections import deque
+import websockets
+from .event import Event
+from .wallet import Wallet
+from .log import logger
+from utilities.rpc_plugin import plugin
+
+# NIP-47 info, request and response
+NWC_KINDS = {13194, 23194, 23195}
+
+# requests are small json payloads, see AdmissionFilter.max_content_length
+MAX_MESSAGE_SIZE = 128 * 1024
+
+MAX_SUBSCRIPTIONS = 32
+
+# responses are kept this long for apps that subscribe after sending the request
+RESPONSE_TTL = 60
+MAX_STORED_RESPONSES = 10000
+
+
+def matches(filter: dict, event: dict) -> bool:
+    """NIP-01 filter match, ids/authors as full hex"""
+    if "ids" in filter and event["id"] not in filter["ids"]:
+        return False
+    if "authors" in filter and event["pubkey"] not in filter["authors"]:
+        return False
+    if "kinds" in filter and event["kind"] not in filter["kinds"]:
+        return False
+    if "since" in filter and event["created_at"] < filter["since"]:
+        return False
+    if "until" in filter and event["created_at"] > filter["until"]:
+        return False
+    for key, values in filter.items():
+        if key.startswith("#") and len(key) == 2:
+            if not any(len(tag) >= 2 and tag[0] == key[1] and tag[1] in values
+                       for tag in event["tags"]):
+                return False
+    return True
+
+
+def supersedes(event: dict, stored: dict) -> bool:
+    """NIP-01 replaceable events, the newest is kept and the lowest id on a tie"""
+    if event["created_at"] != stored["created_at"]:
+        return event["created_at"] > stored["created_at"]
+    return event["id"] < stored["id"]
+
+
+def valid_filter(filter) -> bool:
+    """only filters matches() can evaluate without raising"""
+    if not isinstance(filter, dict):
+        return False
+    for key, value in filter.items():
+        if key in ("ids", "authors", "kinds") or (key.startswith("#") and len(key) == 2):
+            if not isinstance(value, list):
+                return False
+        elif key in ("since", "until", "limit"):
+            if not isinstance(value, int):
+                return False
+    return True
+
+
+class LocalRelay:
+    """
+    Minimal NIP-01 relay (EVENT, REQ, CLOSE, OK, EOSE) for kinds 13194,
+    23194 and 23195, served on the RelayPool's event loop.
+
+    Events are verified here since no upstream relay did. The plugin's
+    LocalWallet subscribes in-process: requests are handed to it as the
+    parsed dict and its responses are routed without a websocket hop.
+    """
+
+    def __init__(self, host: str, port: int, url: str = None):
+        self.host = host
+        self.port = port
+        self.url = url or f"ws://{host}:{port}"
+        self.serving = False
+        self._server = None
+
+        # websocket -> {sub_id: [filter, ...]}
+        self._clients: dict = {}
+        # sub_id -> (filter, deliver) of in-process subscribers
+        self._local: dict = {}
+        # (kind, pubkey) -> latest replaceable event (the 13194 info event)
+        self._replaceable: dict = {}
+        # (received_at, event) of recent responses
+        self._responses = deque(maxlen=MAX_STORED_RESPONSES)
+
+        self.received = 0
+        self.rejected = 0
+        self.delivered = 0
+
+    async def start(self):
+        self._server = await websockets.serve(
+            self._handle, self.host, self.port, max_size=MAX_MESSAGE_SIZE)
+        self.serving = True
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        self.serving = False
+
+    def subscribe_local(self, sub_id: str, filter: dict, deliver):
+        """deliver(event_data) is awaited for every matching event"""
+        self._local[sub_id] = (filter, deliver)
+
+    def unsubscribe_local(self, sub_id: str):
+        self._local.pop(sub_id, None)
+
+    async def publish(self, event_data: dict):
+        """an event from the plugin, already signed"""
+        await self._route(event_data)
+
+    async def _handle(self, ws):
+        self._clients[ws] = {}
+        try:
+            async for message in ws:
+                try:
+                    data = json.loads(message)
+                    verb = data[0]
+                except (ValueError, TypeError, IndexError, KeyError):
+                    await self._send(ws, ["NOTICE", "invalid: not a nostr message"])
+                    continue
+
+                if verb == "EVENT" and len(data) >= 2:
+                    await self._on_event(ws, data[1])
+                elif verb == "REQ" and len(data) >= 3:
+                    await self._on_req(ws, data[1], data[2:])
+                elif verb == "CLOSE" and len(data) >= 2:
+                    self._clients[ws].pop(data[1], None)
+                else:
+                    await self._send(ws, ["NOTICE", f"unsupported: {verb}"])
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        finally:
+            self._clients.pop(ws, None)
+
+    async def _on_event(self, ws, event_data):
+        try:
+            event_id = event_data["id"]
+            kind = event_data["kind"]
+            event = Event.from_JSON(event_data)
+            if not isinstance(event_data["created_at"], int) or \
+                    not all(isinstance(tag, list) for tag in event_data["tags"]):
+                raise ValueError("malformed event")
+        except (KeyError, TypeError, ValueError):
+            self.rejected += 1
+            await self._send(ws, ["NOTICE", "invalid: malformed event"])
+            return
+
+        if kind not in NWC_KINDS:
+            self.rejected += 1
+            await self._send(ws, ["OK", event_id, False,
+                                  "blocked: only nostr wallet connect events"])
+            return
+        if not event.verify():
+            self.rejected += 1
+            await self._send(ws, ["OK", event_id, False, "invalid: bad id or signature"])
+            return
+
+        self.received += 1
+        await self._send(ws, ["OK", event_id, True, ""])
+        await self._route(event_data)
+
+    async def _on_req(self, ws, sub_id, filters):
+        subscriptions = self._clients[ws]
+        if not isinstance(sub_id, str) or not all(valid_filter(f) for f in filters):
+            await self._send(ws, ["CLOSED", sub_id, "invalid: malformed filter"])
+            return
+        if sub_id not in subscriptions and len(subscriptions) >= MAX_SUBSCRIPTIONS:
+            await self._send(ws, ["CLOSED", sub_id, "blocked: too many subscriptions"])
+            return
+        subscriptions[sub_id] = filters
+
+        for event_data in self._stored(filters):
+            await self._send(ws, ["EVENT", sub_id, event_data])
+        await self._send(ws, ["EOSE", sub_id])
+
+    def _stored(self, filters) -> list[dict]:
+        cutoff = time.monotonic() - RESPONSE_TTL
+        while self._responses and self._responses[0][0] < cutoff:
+            self._responses.popleft()
+
+        events = list(self._replaceable.values()) + \
+            [event for _, event in self._responses]
+        stored = {}
+        for filter in filters:
+            found = [event for event in events if matches(filter, event)]
+            if "limit" in filter:
+                found = sorted(found, key=lambda e: e["created_at"])
+                found = found[-filter["limit"]:] if filter["limit"] > 0 else []
+            stored.update((event["id"], event) for event in found)
+        return list(stored.values())
+
+    async def _route(self, event_data: dict):
+        kind = event_data["kind"]
+        if 10000 <= kind < 20000:
+            key = (kind, event_data["pubkey"])
+            stored = self._replaceable.get(key)
+            if stored is not None and not supersedes(event_data, stored):
+                return
+            self._replaceable[key] = event_data
+        elif kind == 23195:
+            self._responses.append((time.monotonic(), event_data))
+
+        # serialized once, only the subscription id differs per frame
+        encoded = None
+        sends = []
+        for ws, subscriptions in list(self._clients.items()):
+            for sub_id, filters in subscriptions.items():
+                if any(matches(filter, event_data) for filter in filters):
+                    if encoded is None:
+                        encoded = json.dumps(event_data)
+                    sends.append(self._send_raw(
+                        ws, f'["EVENT",{json.dumps(sub_id)},{encoded}]'))
+        if sends:
+            self.delivered += len(sends)
+            await asyncio.gather(*sends)
+
+        for filter, deliver in list(self._local.values()):
+            if matches(filter, event_data):
+                self.delivered += 1
+                await deliver(event_data)
+
+    async def _send(self, ws, message: list):
+        await self._send_raw(ws, json.dumps(message))
+
+    @staticmethod
+    async def _send_raw(ws, frame: str):
+        try:
+            await ws.send(frame)
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    def stats(self) -> dict:
+        return {
+            "url": self.url,
+            "serving": self.serving,
+            "clients": len(self._clients),
+            "subscriptions": sum(len(subs) for subs in self._clients.values()),
+            "received": self.received,
+            "rejected": self.rejected,
+            "delivered": self.delivered
+        }
+
+
+class LocalWallet(Wallet):
+    """
+    Wallet on the embedded relay. Nothing is sent over a socket: REQs
+    register in-process subscriptions and requests arrive through deliver().
+    """
+    local = True
+
+    def __init__(self, relay: LocalRelay, since: int = None, pool=None):
+        super().__init__(relay.url, since=since, pool=pool)
+        self.relay = relay
+        self._closed = None
+
+    async def connect(self):
+        self.subscriptions = {}
+        self._running = True
+        self._closed = asyncio.get_running_loop().create_future()
+        self.health.on_connect()
+
+    async def listen(self):
+        # requests come in through deliver(), stay "connected" until stopped
+        await self._closed
+
+    async def deliver(self, event_data: dict):
+        if plugin.capture:
+            plugin.capture.on_event(self.uri, event_data)
+        created_at = event_data.get("created_at")
+        if isinstance(created_at, int):
+            self.health.on_event(created_at)
+        await self.dispatch(event_data)
+
+    async def subscribe(self, filter, sub_id: str = None):
+        sub_id = sub_id or str(uuid.uuid4())[:64]
+        self.relay.subscribe_local(sub_id, filter, self.deliver)
+        self.subscriptions[sub_id] = filter
+        return sub_id
+
+    async def unsubscribe(self, sub_id: str):
+        self.relay.unsubscribe_local(sub_id)
+        self.subscriptions.pop(sub_id, None)
+
+    async def send_event(self, event_data):
+        try:
+            await self.relay.publish(event_data)
+        except Exception as e:
+            logger.error("relay", "nwc local relay publish failed", error=str(e))
+            self.health.on_error()
@@ -0,0 +1,160 @@
+"""
+Structured logging for the request hot path
+
+Every plugin.log line is a JSON-RPC notification to lightningd, whatever
+lightningd's log level. Lines here are dropped before anything is
+formatted when their level is below the configured one, when their
+category is sampled, or when the category is over its rate cap.
+"""
+
+import json
+import re
+import threading
+import time
+from collections import Counter
+from utilities.rpc_plugin import plugin
+
+LEVELS = {"debug": 0, "info": 1, "warn": 2, "error": 3}
+
+DEFAULT_LEVEL = "info"
+
+# lines per second per category, the rest are counted and the count is
+# added to the next line that gets through
+DEFAULT_RATE = 20
+
+REDACTED = "<redacted>"
+
+# fields (at any depth) whose values never end up in the log
+SECRET_FIELDS = {"secret", "preimage", "payment_preimage", "privkey"}
+
+# the secret of a nostr+walletconnect URI
+SECRET_PARAM = re.compile(r"(secret=)[0-9a-fA-F]+")
+
+
+def redact(value):
+    """a copy of value without secrets and preimages"""
+    if isinstance(value, dict):
+        return {key: REDACTED if key in SECRET_FIELDS and item else redact(item)
+                for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    if isinstance(value, str) and "secret=" in value:
+        return SECRET_PARAM.sub(r"\1" + REDACTED, value)
+    return value
+
+
+def parse_samples(values: list[str]) -> dict[str, int]:
+    """["request=100", ...] -> {"request": 100}, log one in 100 of the category"""
+    samples = {}
+    for value in values or []:
+        category, _, every = value.partition("=")
+        if not category or not every.isdigit() or int(every) < 1:
+            raise ValueError(f"expected category=N, got {value}")
+        samples[category] = int(every)
+    return samples
+
+
+class _Category:
+    __slots__ = ("seen", "tokens", "refilled", "suppressed")
+
+    def __init__(self, rate: int):
+        self.seen = 0
+        self.tokens = rate
+        self.refilled = time.monotonic()
+        self.suppressed = 0
+
+
+class Logger:
+    """
+    logger.debug("request", "nwc request executed", method=..., latency_ms=...)
+
+    The first argument is the category sampling and rate caps apply to,
+    fields are formatted as key=json after the message, and only for
+    lines that are emitted.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+
+    def configure(self, level: str = DEFAULT_LEVEL, samples: dict = None,
+                  rate: int = DEFAULT_RATE):
+        if level not in LEVELS:
+            raise ValueError(f"log level is one of {', '.join(LEVELS)}")
+        self.level = LEVELS[level]
+        self.level_name = level
+        self.samples = dict(samples or {})
+        self.rate = rate
+        self._categories: dict[str, _Category] = {}
+        self.emitted = Counter()
+        self.sampled = Counter()
+        self.rate_limited = Counter()
+
+    def config(self) -> dict:
+        """what configure() was called with, for the shard workers"""
+        return {"level": self.level_name, "samples": self.samples, "rate": self.rate}
+
+    def enabled(self, level: str) -> bool:
+        return LEVELS[level] >= self.level
+
+    def debug(self, category: str, message: str, /, **fields):
+        if self.level <= 0:
+            self._log("debug", category, message, fields)
+
+    def info(self, category: str, message: str, /, **fields):
+        if self.level <= 1:
+            self._log("info", category, message, fields)
+
+    def warn(self, category: str, message: str, /, **fields):
+        if self.level <= 2:
+            self._log("warn", category, message, fields)
+
+    def error(self, category: str, message: str, /, **fields):
+        self._log("error", category, message, fields)
+
+    def _log(self, level: str, category: str, message: str, fields: dict):
+        with self._lock:
+            state = self._categories.get(category)
+            if state is None:
+                state = self._categories[category] = _Category(self.rate)
+
+            state.seen += 1
+            # errors are never sampled, only rate capped
+            every = self.samples.get(category, 1) if level != "error" else 1
+            if every > 1 and state.seen % every:
+                self.sampled[category] += 1
+                return
+
+            if self.rate:
+                now = time.monotonic()
+                state.tokens = min(self.rate, state.tokens + (now - state.refilled) * self.rate)
+                state.refilled = now
+                if state.tokens < 1:
+                    state.suppressed += 1
+                    self.rate_limited[category] += 1
+                    return
+                state.tokens -= 1
+
+            if state.suppressed:
+                fields["suppressed"] = state.suppressed
+                state.suppressed = 0
+            self.emitted[category] += 1
+
+        plugin.log(self.format(message, fields), level)
+
+    @staticmethod
+    def format(message: str, fields: dict) -> str:
+        return " ".join([message] + [
+            f"{key}={json.dumps(redact(value), default=str, separators=(',', ':'))}"
+            for key, value in fields.items() if value is not None])
+
+    def stats(self) -> dict:
+        return {
+            "level": self.level_name,
+            "emitted": dict(self.emitted),
+            "sampled": dict(self.sampled),
+            "rate_limited": dict(self.rate_limited)
+        }
+
+
+logger = Logger()
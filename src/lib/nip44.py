@@ -0,0 +1,246 @@
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms
+from cryptography.hazmat.primitives.kdf.hkdf import HKDFExpand
+from collections import OrderedDict
+from coincurve import PublicKey
+import threading
+import hashlib
+import base64
+import hmac
+import os
+
+# NIP44 spec: https://github.com/nostr-protocol/nips/blob/master/44.md
+
+VERSION = 2
+MIN_PLAINTEXT_SIZE = 1
+MAX_PLAINTEXT_SIZE = 65535
+
+
+class ConversationKeyCache:
+    """
+    LRU cache of conversation keys so the ECDH + HKDF-extract is only done
+    once per (wallet key, peer) pair instead of once per message.
+    """
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, secret_key: str, pubkey_hex: str) -> bytes:
+        cache_key = (secret_key, pubkey_hex)
+        with self._lock:
+            conversation_key = self._keys.get(cache_key)
+            if conversation_key is not None:
+                self._keys.move_to_end(cache_key)
+                self.hits += 1
+                return conversation_key
+
+        conversation_key = get_conversation_key(secret_key, pubkey_hex)
+
+        with self._lock:
+            self.misses += 1
+            self._keys[cache_key] = conversation_key
+            if len(self._keys) > self.maxsize:
+                self._keys.popitem(last=False)
+
+        return conversation_key
+
+    def evict(self, pubkey_hex: str):
+        """drop every cached key for a peer, e.g. when its connection is revoked"""
+        with self._lock:
+            for cache_key in [k for k in self._keys if k[1] == pubkey_hex]:
+                del self._keys[cache_key]
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._keys),
+            "hits": self.hits,
+            "misses": self.misses
+        }
+
+
+conversation_keys = ConversationKeyCache()
+
+
+def get_conversation_key(secret_key: str, pubkey_hex: str) -> bytes:
+    """
+    Derive the NIP44 conversation key shared by two parties.
+
+    Parameters:
+    secret_key (str): The private key in hexadecimal format.
+    pubkey_hex (str): The x-only public key in hexadecimal format.
+
+    Returns:
+    bytes: HKDF-extract(salt="nip44-v2", ikm=shared x coordinate)
+    """
+
+    shared_point = PublicKey(bytes.fromhex('02' + pubkey_hex)).multiply(
+        bytes.fromhex(secret_key))
+    shared_x = shared_point.format()[1:]
+
+    return hmac.new(b'nip44-v2', shared_x, hashlib.sha256).digest()
+
+
+def get_message_keys(conversation_key: bytes, nonce: bytes):
+    """
+    Expand the conversation key into per message keys.
+
+    Returns:
+    tuple: (chacha_key, chacha_nonce, hmac_key)
+    """
+
+    keys = HKDFExpand(algorithm=hashes.SHA256(), length=76,
+                      info=nonce).derive(conversation_key)
+
+    return keys[0:32], keys[32:44], keys[44:76]
+
+
+def calc_padded_len(unpadded_len: int) -> int:
+    """padded length of a plaintext, hides the exact message size"""
+    if unpadded_len <= 32:
+        return 32
+
+    next_power = 1 << (unpadded_len - 1).bit_length()
+    chunk = 32 if next_power <= 256 else next_power // 8
+
+    return chunk * ((unpadded_len - 1) // chunk + 1)
+
+
+def pad(plaintext: str) -> bytes:
+    unpadded = plaintext.encode('utf-8')
+    unpadded_len = len(unpadded)
+
+    if not MIN_PLAINTEXT_SIZE <= unpadded_len <= MAX_PLAINTEXT_SIZE:
+        raise ValueError("invalid plaintext length")
+
+    prefix = unpadded_len.to_bytes(2, 'big')
+    suffix = bytes(calc_padded_len(unpadded_len) - unpadded_len)
+
+    return prefix + unpadded + suffix
+
+
+def unpad(padded: bytes) -> str:
+    unpadded_len = int.from_bytes(padded[0:2], 'big')
+    unpadded = padded[2:2 + unpadded_len]
+
+    if (unpadded_len < MIN_PLAINTEXT_SIZE or len(unpadded) != unpadded_len
+            or len(padded) != 2 + calc_padded_len(unpadded_len)):
+        raise ValueError("invalid padding")
+
+    return unpadded.decode('utf-8')
+
+
+def process_chacha(data: bytes, key: bytes, nonce: bytes) -> bytes:
+    """ChaCha20 with a zero counter, the same call encrypts and decrypts"""
+    # cryptography wants the 4 byte little endian counter prepended
+    cipher = Cipher(algorithms.ChaCha20(key, bytes(4) + nonce), mode=None)
+    processor = cipher.encryptor()
+
+    return processor.update(data) + processor.finalize()
+
+
+def hmac_aad(key: bytes, message: bytes, aad: bytes) -> bytes:
+    if len(aad) != 32:
+        raise ValueError("AAD associated data must be 32 bytes")
+
+    return hmac.new(key, aad + message, hashlib.sha256).digest()
+
+
+def encrypt_with_key(conversation_key: bytes, data: str,
+                     nonce: bytes = None) -> str:
+    """
+    Encrypt data with an already derived conversation key.
+
+    Parameters:
+    conversation_key (bytes): The 32 byte conversation key.
+    data (str): The plaintext data to be encrypted.
+    nonce (bytes): Optional 32 byte nonce, random if not given.
+
+    Returns:
+    str: The base64 encoded payload.
+    """
+
+    if nonce is None:
+        nonce = os.urandom(32)
+
+    chacha_key, chacha_nonce, hmac_key = get_message_keys(
+        conversation_key, nonce)
+
+    ciphertext = process_chacha(pad(data), chacha_key, chacha_nonce)
+    mac = hmac_aad(hmac_key, ciphertext, nonce)
+
+    return base64.b64encode(
+        bytes([VERSION]) + nonce + ciphertext + mac).decode()
+
+
+def decrypt_with_key(conversation_key: bytes, data: str) -> str:
+    """
+    Decrypt a payload with an already derived conversation key.
+
+    Parameters:
+    conversation_key (bytes): The 32 byte conversation key.
+    data (str): The base64 encoded payload.
+
+    Returns:
+    str: The decrypted plaintext data.
+    """
+
+    if not data or data[0] == '#':
+        raise ValueError("unknown encryption version")
+    if not 132 <= len(data) <= 87472:
+        raise ValueError("invalid payload size")
+
+    decoded = base64.b64decode(data)
+    if not 99 <= len(decoded) <= 65603:
+        raise ValueError("invalid data size")
+    if decoded[0] != VERSION:
+        raise ValueError(f"unknown encryption version {decoded[0]}")
+
+    nonce = decoded[1:33]
+    ciphertext = decoded[33:-32]
+    mac = decoded[-32:]
+
+    chacha_key, chacha_nonce, hmac_key = get_message_keys(
+        conversation_key, nonce)
+
+    if not hmac.compare_digest(hmac_aad(hmac_key, ciphertext, nonce), mac):
+        raise ValueError("invalid MAC")
+
+    return unpad(process_chacha(ciphertext, chacha_key, chacha_nonce))
+
+
+def encrypt(secret_key: str, pubkey_hex: str, data: str) -> str:
+    """
+    Encrypt data according to the NIP44 v2 specification.
+
+    Parameters:
+    secret_key (str): The private key in hexadecimal format.
+    pubkey_hex (str): The public key in hexadecimal format.
+    data (str): The plaintext data to be encrypted.
+
+    Returns:
+    str: The base64 encoded payload.
+    """
+
+    conversation_key = conversation_keys.get(secret_key, pubkey_hex)
+    return encrypt_with_key(conversation_key, data)
+
+
+def decrypt(secret_key: str, pubkey_hex: str, data: str) -> str:
+    """
+    Decrypt data according to the NIP44 v2 specification.
+
+    Parameters:
+    secret_key (str): The private key in hexadecimal format.
+    pubkey_hex (str): The public key in hexadecimal format.
+    data (str): The base64 encoded payload.
+
+    Returns:
+    str: The decrypted plaintext data.
+    """
+
+    conversation_key = conversation_keys.get(secret_key, pubkey_hex)
+    return decrypt_with_key(conversation_key, data)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import time
 import uuid
@@ -7,8 +8,13 @@ from urllib.parse import urlparse, parse_qs
 from pyln.client import RpcError, Millisatoshi
 from coincurve import PublicKey
 from .event import Event
+from .budget import SpendRing
 from .utils import get_hex_pubkey
-from . import nip04
+from . import crypto
+from .crypto import ENCRYPTION_SCHEMES, DEFAULT_ENCRYPTION
+from .store import DEFAULT_TENANT
+from .log import logger
+from .usage import current_request
 from utilities.rpc_plugin import plugin
 
 
@@ -17,13 +23,19 @@ class URIOptions:
     """defines options for creating a new NWC instance"""
     relay_url: str = None
     secret: str = None
+    pubkey: str = None
     wallet_pubkey: str = None
     nostr_wallet_connect_url: str = None
     expiry_unix: int = None
     budget_msat: Millisatoshi = None
     spent_msat: Millisatoshi = None
+    created_at: int = None
+    budget_renewal: str = None
+    budget_window: int = None
+    tenant: str = None
 
 
+# where connections lived in the datastore before ConnectionStore
 ISSUED_URI_BASE_KEY = ["nwc", "uri"]
 
 
@@ -41,60 +53,48 @@ class NIP47URI:
 
         return options
 
+    @staticmethod
+    def from_record(record: dict):
+        """build a connection from a ConnectionStore record"""
+        budget_msat = record.get("budget_msat")
+        tenant = plugin.tenants.get(record.get("tenant"))
+        nwc = NIP47URI(options=URIOptions(
+            secret=record.get("secret"),
+            pubkey=record.get("pubkey"),
+            budget_msat=Millisatoshi(budget_msat) if budget_msat else None,
+            spent_msat=Millisatoshi(record.get("spent_msat") or 0),
+            expiry_unix=record.get("expiry_unix"),
+            relay_url=record.get("relay_url"),
+            wallet_pubkey=tenant.pubkey if tenant else plugin.pubkey,
+            created_at=record.get("created_at"),
+            tenant=record.get("tenant")
+        ))
+        nwc.spend_ring = SpendRing.from_record(record)
+        return nwc
+
     @staticmethod
     def find_unique(pubkey):
         """find the nostr wallet connection in db"""
-
-        connection_key = ISSUED_URI_BASE_KEY.copy()
-        connection_key.append(pubkey)
-        connection_record = plugin.rpc.listdatastore(
-            key=connection_key)["datastore"]  # TODO: error handling
-        if connection_record:
-            connection_data = json.loads(connection_record[0].get("string"))
-
-            budget_msat = connection_data.get("budget_msat", None)
-            spent_msat = connection_data.get("spent_msat")
-            expiry_unix = connection_data.get("expiry_unix", None)
-
-            return NIP47URI(options=URIOptions(
-                secret=connection_data.get("secret"),
-                budget_msat=Millisatoshi(budget_msat) if budget_msat else None,
-                spent_msat=Millisatoshi(spent_msat),
-                expiry_unix=expiry_unix,
-                # TODO: figure out how to not have to pass relay and wallet pubkey for this
-                relay_url="wss://relay.getalby.com/v1",
-                wallet_pubkey="placeholder"
-            ))
+        record = plugin.journal.get(pubkey)
+        if record:
+            return NIP47URI.from_record(record)
         return None
 
     @staticmethod
-    def find_all():
-        """find all nostr wallet connections in db"""
-        key = ISSUED_URI_BASE_KEY.copy()
-        records = plugin.rpc.listdatastore(key=key)["datastore"]
-
-        if not records:
-            return []
-
-        connections: list[NIP47URI] = []
-
-        for record in records:
-            connection_data = json.loads(record.get("string"))
-            budget_msat = connection_data.get("budget_msat", None)
-            spent_msat = connection_data.get("spent_msat")
-            expiry_unix = connection_data.get("expiry_unix", None)
-
-            connection = NIP47URI(options=URIOptions(
-                secret=connection_data.get("secret"),
-                budget_msat=Millisatoshi(budget_msat) if budget_msat else None,
-                spent_msat=Millisatoshi(spent_msat),
-                expiry_unix=expiry_unix,
-                relay_url="wss://relay.getalby.com/v1",
-                wallet_pubkey="placeholder"
-            ))
-            connections.append(connection)
-
-        return connections
+    def find_all(status: str = None):
+        """find all (or only "active"/"expired") nostr wallet connections in db"""
+        return [NIP47URI.from_record(plugin.journal.apply_pending(record))
+                for record in plugin.store.all(status)]
+
+    @staticmethod
+    def find_page(**filters):
+        """
+        a page of connections, see ConnectionStore.page for the filters
+        returns (connections, next_cursor)
+        """
+        records, next_cursor = plugin.store.page(**filters)
+        return [NIP47URI.from_record(plugin.journal.apply_pending(record))
+                for record in records], next_cursor
 
     @staticmethod
     def construct_wallet_connect_url(options: URIOptions):
@@ -120,54 +120,80 @@ class NIP47URI:
 
         self.relay_url = options.relay_url
         self.secret = options.secret
-        self.pubkey = PublicKey.from_secret(
+        # stored connections already know their pubkey, skip the EC math
+        self.pubkey = options.pubkey or PublicKey.from_secret(
             bytes.fromhex(self.secret)).format().hex()[2:]
         self.wallet_pubkey = options.wallet_pubkey
         self.expiry_unix = options.expiry_unix or None
         self.budget_msat = options.budget_msat or None
         self.spent_msat = options.spent_msat
+        self.created_at = options.created_at
+        # wallet service key the connection talks to, see TenantRegistry
+        self.tenant = options.tenant or DEFAULT_TENANT
+        # lifetime budget unless it renews daily/weekly/... or on a rolling window
+        self.spend_ring = SpendRing(
+            options.budget_renewal, options.budget_window)
+
+    @property
+    def budget_renewal(self):
+        return self.spend_ring.renewal or "never"
 
     @property
-    def datastore_key(self):
-        """get the key for handling connections in the db"""
-        key = ISSUED_URI_BASE_KEY.copy()
-        key.append(self.pubkey)
-        return key
+    def budget_window(self):
+        return self.spend_ring.window_seconds
+
+    @property
+    def window_spent_msat(self):
+        """spent in the current budget window, lifetime spend if it never renews"""
+        if self.spend_ring.renews:
+            return Millisatoshi(self.spend_ring.spent())
+        return Millisatoshi(self.spent_msat or 0)
 
     @property
     def remaining_budget(self):
         total_budget = Millisatoshi(
             self.budget_msat)
-        spent = Millisatoshi(self.spent_msat)
+        spent = self.window_spent_msat
+        if spent > total_budget:
+            return Millisatoshi(0)
         return total_budget - spent
 
     def expired(self):
         if not self.expiry_unix:
             return False
         now = int(time.time())
-        print("NOW", now, "\nEXPIRE", self.expiry_unix)
         if now > self.expiry_unix:
             return True
         return False
 
+    def save(self):
+        """insert the connection into the db"""
+        NIP47URI.save_many([self])
+
+    @staticmethod
+    def save_many(connections):
+        """insert connections into the db in one transaction"""
+        plugin.store.insert_many([{
+            "pubkey": nwc.pubkey,
+            "secret": nwc.secret,
+            "relay_url": nwc.relay_url,
+            "budget_msat": int(nwc.budget_msat) if nwc.budget_msat else None,
+            "spent_msat": int(nwc.spent_msat or 0),
+            "expiry_unix": nwc.expiry_unix,
+            "budget_renewal": nwc.spend_ring.renewal,
+            "budget_window": nwc.spend_ring.window_seconds,
+            "tenant": nwc.tenant
+        } for nwc in connections])
+
     def delete(self):
-        try:
-            plugin.rpc.deldatastore(key=self.datastore_key)
-        except RpcError as e:
-            plugin.log(f"ERROR: {e}", 'error')
-            raise e
+        plugin.store.delete(self.pubkey)
 
 
 class NIP47Response(Event):
-    def __init__(self, content: str, nip04_pubkey,
-                 referenced_event_id: str, privkey: str):
-        # encrypt response payload
-        encrypted_content = nip04.encrypt(
-            secret_key=privkey,
-            pubkey_hex=nip04_pubkey,
-            data=content
-        )
+    __slots__ = ('_privkey',)
 
+    def __init__(self, encrypted_content: str, nip04_pubkey,
+                 referenced_event_id: str, privkey: str):
         event_pubkey = get_hex_pubkey(privkey=privkey)
         p_tag = ['p', nip04_pubkey]
         e_tag = ['e', referenced_event_id]
@@ -182,9 +208,22 @@ class NIP47Response(Event):
 
         self._privkey = privkey  # QUESTION: bad idea to set the priv key on the class?
 
+    @classmethod
+    async def create(cls, content: str, nip04_pubkey,
+                     referenced_event_id: str, privkey: str,
+                     encryption: str = DEFAULT_ENCRYPTION):
+        """encrypt the response payload with the same scheme as the request"""
+        encrypted_content = await crypto.run(
+            "encrypt", encryption, privkey, nip04_pubkey, content)
+        return cls(encrypted_content, nip04_pubkey, referenced_event_id, privkey)
+
     def sign(self):
         return super().sign(privkey=self._privkey)
 
+    async def signed_event_data(self) -> dict:
+        """id + sign the response, in the crypto pool if one is configured"""
+        return await crypto.run("sign", self.event_data(), self._privkey)
+
 
 class ErrorCodes(Enum):
     RATE_LIMITED = "RATE_LIMITED"
@@ -196,6 +235,7 @@ class ErrorCodes(Enum):
     INTERNAL = "INTERNAL"
     OTHER = "OTHER"
     NOT_FOUND = "NOT_FOUND"
+    UNSUPPORTED_ENCRYPTION = "UNSUPPORTED_ENCRYPTION"
 
 
 class NWCError(Exception):
@@ -237,6 +277,18 @@ class NotImplementedError(NWCError):
         super().__init__(code, message)
 
 
+class RateLimitedError(NWCError):
+    def __init__(self, message=None):
+        code = ErrorCodes.RATE_LIMITED
+        super().__init__(code, message)
+
+
+class ExpiredError(NWCError):
+    def __init__(self):
+        code = ErrorCodes.OTHER
+        super().__init__(code, "request expired before it was executed")
+
+
 class NIP47RequestHandler:
     method_params_schema = {
         "pay_invoice": {
@@ -281,7 +333,7 @@ class NIP47RequestHandler:
     def result_type(self):
         return self.request.get("method")
 
-    def __init__(self, request: str, connection: NIP47URI):
+    def __init__(self, request: str, connection: NIP47URI, event=None):
         self._method_handlers = {
             "pay_invoice": self._pay_invoice,
             "make_invoice": self._make_invoice,
@@ -294,6 +346,8 @@ class NIP47RequestHandler:
 
         self.request = request
         self.connection = connection
+        # the NIP47Request this came in, to answer it after a restart
+        self.event = event
 
         self.method = request.get("method")
 
@@ -317,8 +371,12 @@ class NIP47RequestHandler:
         return await self.handler(validated_params)
 
     async def _get_info(self, params):
+        cached = plugin.responses.get_info()
+        if cached:
+            return cached
+
         node_info = plugin.rpc.getinfo()
-        return {
+        result = {
             "alias": node_info.get("alias"),
             "color": node_info.get("color"),
             "pubkey": node_info.get("id"),
@@ -327,14 +385,16 @@ class NIP47RequestHandler:
             "block_hash": None,
             "methods": list(self._method_handlers.keys())
         }
+        plugin.responses.put_info(result)
+        return result
 
-    def handle_pay_result(self, pay_result):
+    async def handle_pay_result(self, pay_result):
         preimage = pay_result.get("payment_preimage", None)
         if not preimage:
             raise NWCError(ErrorCodes.INTERNAL)
 
         amount_sent_msat = pay_result.get("amount_sent_msat")
-        self.add_to_spent(amount_sent_msat)
+        await self.add_to_spent(amount_sent_msat, pay_result.get("payment_hash"))
 
         return {
             "preimage": preimage
@@ -344,23 +404,127 @@ class NIP47RequestHandler:
         invoice = params.get("invoice")
         amount = params.get("amount", None)
 
-        invoice_msat = plugin.rpc.decodepay(
-            bolt11=invoice).get("amount_msat", 0)
+        # retries and relay replays of a known invoice skip the decodepay
+        payment_hash = plugin.payments.payment_hash(invoice)
+        invoice_msat = None
+        if not payment_hash:
+            decoded = plugin.rpc.decodepay(bolt11=invoice)
+            payment_hash = decoded.get("payment_hash")
+            invoice_msat = decoded.get("amount_msat", 0)
+            plugin.payments.remember_hash(invoice, payment_hash)
+
+        key = (self.connection.pubkey, payment_hash)
+        request = None
+        if self.event is not None:
+            request = {"event_id": self.event.id,
+                       "encryption": self.event.response_encryption,
+                       "tenant": self.connection.tenant}
+        return await plugin.payments.pay(
+            key, lambda: self._pay(invoice, amount, invoice_msat), request)
+
+    @staticmethod
+    async def resume_payment(pubkey: str, payment_hash: str):
+        """
+        response content for a pay_invoice that was in flight when the
+        plugin stopped, None while the payment is still pending
+        """
+        key = (pubkey, payment_hash)
+        pays = (await asyncio.to_thread(
+            plugin.rpc.listpays, payment_hash=payment_hash)).get("pays", [])
+        complete = [pay for pay in pays if pay.get("status") == "complete"]
+        if complete:
+            pay = complete[0]
+            result = {"preimage": pay.get("preimage")}
+            # pay may have returned and journaled the spend after the
+            # snapshot listing it as pending was written
+            if not plugin.journal.has_spend(pubkey, payment_hash):
+                amount_msat = int(Millisatoshi(pay.get("amount_sent_msat")))
+                await plugin.journal.record(pubkey, amount_msat,
+                                            payment_hash=payment_hash)
+                record = plugin.store.get(pubkey)
+                if record:
+                    plugin.tenants.add_spend(record.get("tenant"), amount_msat)
+                plugin.usage.add_payment(pubkey, amount_msat)
+            plugin.payments.complete(key, result)
+            return {
+                "result_type": "pay_invoice",
+                "result": result,
+                "error": None
+            }
+
+        if not pays:
+            # lightningd keeps paying after the plugin stops, its pay may
+            # not have made an attempt yet
+            if not plugin.payments.resume_expired():
+                return None
+            # the plugin stopped before pay was called, nothing was spent
+            plugin.payments.forget_interrupted(key)
+            return {
+                "result_type": "pay_invoice",
+                "result": None,
+                "error": {
+                    "code": ErrorCodes.OTHER.value,
+                    "message": "payment was not started"
+                }
+            }
+
+        if all(pay.get("status") == "failed" for pay in pays):
+            plugin.payments.forget_interrupted(
+                key, NWCError(ErrorCodes.OTHER, "payment failed"))
+            return {
+                "result_type": "pay_invoice",
+                "result": None,
+                "error": {
+                    "code": ErrorCodes.OTHER.value,
+                    "message": "payment failed"
+                }
+            }
+
+        return None
+
+    async def _pay(self, invoice, amount, invoice_msat=None):
+        """the actual payment, once per (connection, payment_hash) see PaymentRegistry"""
+        if invoice_msat is None:
+            invoice_msat = plugin.rpc.decodepay(
+                bolt11=invoice).get("amount_msat", 0)
 
         if amount and invoice_msat:
             raise NWCError(ErrorCodes.OTHER,
                            "amount and invoice amount cannot both be specified")
 
-        if self.connection.budget_msat and self.connection.remaining_budget < invoice_msat:
-            plugin.log(
-                f"nwc quota exceded for {self.connection.pubkey}", 'info')
+        amount_msat = int(Millisatoshi(invoice_msat or amount or 0))
+        pubkey = self.connection.pubkey
+        # other payments of this connection may be in flight, their
+        # amounts are not in spent_msat yet
+        reserved = plugin.payments.reserved(pubkey)
+        if self.connection.budget_msat and self.connection.remaining_budget < amount_msat + reserved:
+            logger.info("budget", "nwc quota exceeded", connection=pubkey,
+                        amount_msat=amount_msat)
+            raise QuotaExceededError()
+
+        # the tenant's budget covers all of its connections, its payments
+        # in flight are reserved under its wallet pubkey
+        tenant = plugin.tenants.get(self.connection.tenant)
+        tenant_remaining = tenant.remaining_budget()
+        if tenant_remaining is not None and \
+                tenant_remaining < amount_msat + plugin.payments.reserved(tenant.pubkey):
+            logger.info("budget", "nwc tenant quota exceeded", tenant=tenant.name,
+                        connection=pubkey, amount_msat=amount_msat)
             raise QuotaExceededError()
 
-        pay_result = plugin.rpc.pay(bolt11=invoice, amount_msat=amount)
+        plugin.payments.reserve(pubkey, amount_msat)
+        plugin.payments.reserve(tenant.pubkey, amount_msat)
+        try:
+            # in a thread so duplicates (and other requests) are handled meanwhile
+            pay_result = await asyncio.to_thread(
+                plugin.rpc.pay, bolt11=invoice, amount_msat=amount)
 
-        plugin.log(f"nwc pay result: {pay_result}", 'debug')
+            logger.debug("payment", "nwc pay result", connection=pubkey, result=pay_result)
 
-        return self.handle_pay_result(pay_result)
+            return await self.handle_pay_result(pay_result)
+        finally:
+            plugin.payments.reserve(pubkey, -amount_msat)
+            plugin.payments.reserve(tenant.pubkey, -amount_msat)
 
     async def _pay_keysend(self, params):
         amount_msat = params.get("amount")
@@ -376,10 +540,10 @@ class NIP47RequestHandler:
             raise NWCError(ErrorCodes.NOT_IMPLEMENTED,
                            "tlv records not supported")
 
-        pay_result = plugin.rpc.keysend(destination=pubkey,
-                                        amount_msat=amount_msat)
+        pay_result = await asyncio.to_thread(
+            plugin.rpc.keysend, destination=pubkey, amount_msat=amount_msat)
 
-        return self.handle_pay_result(pay_result)
+        return await self.handle_pay_result(pay_result)
 
     async def _make_invoice(self, params):
         amount_msat = params.get("amount")
@@ -415,6 +579,20 @@ class NIP47RequestHandler:
             raise NWCError(ErrorCodes.OTHER,
                            "payment_hash and invoice cannot both be specified")
 
+        cache_key = plugin.responses.lookup_key(payment_hash, invoice)
+        cached = plugin.responses.get_lookup(cache_key)
+        if cached:
+            return cached
+
+        # identical lookups in flight share one fetch
+        result = await plugin.coalescer.do(
+            ("lookup_invoice", *cache_key),
+            lambda: asyncio.to_thread(self.fetch_invoice, payment_hash, invoice))
+        plugin.responses.put_lookup(cache_key, result)
+        return result
+
+    @staticmethod
+    def fetch_invoice(payment_hash, invoice):
         pays = []
         invoices = []
         if payment_hash:
@@ -471,6 +649,13 @@ class NIP47RequestHandler:
             }
 
     async def _list_transactions(self, params):
+        # identical requests in flight share one set of RPC calls
+        key = ("list_transactions", json.dumps(params, sort_keys=True))
+        return await plugin.coalescer.do(key, lambda: asyncio.to_thread(
+            self.fetch_transactions, params))
+
+    @staticmethod
+    def fetch_transactions(params):
         txs = []
         include_unpaid = False
         include_incoming = True
@@ -558,79 +743,97 @@ class NIP47RequestHandler:
             "transactions": txs
         }
 
-    def add_to_spent(self, amount_sent_msat):
-        key = self.connection.datastore_key
-        new_amount = self.connection.spent_msat + \
-            Millisatoshi(amount_sent_msat)
-        plugin.rpc.datastore(key=key, string=json.dumps({
-            "secret": self.connection.secret,
-            "budget_msat": self.connection.budget_msat,
-            "expiry_unix": self.connection.expiry_unix,
-            "spent_msat": new_amount
-        }), mode="must-replace")
+    async def add_to_spent(self, amount_sent_msat, payment_hash: str = None):
+        amount_msat = int(Millisatoshi(amount_sent_msat))
+        # returns once the spend is durable, see SpendJournal
+        await plugin.journal.record(self.connection.pubkey, amount_msat,
+                                    payment_hash=payment_hash)
+        self.connection.spent_msat = Millisatoshi(
+            int(self.connection.spent_msat or 0) + amount_msat)
+        if self.connection.spend_ring.renews:
+            self.connection.spend_ring.add(amount_msat)
+        plugin.tenants.add_spend(self.connection.tenant, amount_msat)
+        usage = current_request.get()
+        if usage is not None:
+            usage.paid_msat += amount_msat
 
 
 class NIP47Request(Event):
     """Implements all the NIP47 stuff we need"""
+    __slots__ = ()
 
-    def __init__(self, event: Event):
-        if event._kind != 23194:
+    @classmethod
+    def from_JSON(cls, evt_json):
+        if evt_json['kind'] != 23194:
             raise ValueError("NIP47 Requests must be kind 23194")
 
-        super().__init__(
-            id=event._id,
-            sig=event._sig,
-            kind=event._kind,
-            content=event._content,
-            tags=event._tags,
-            pubkey=event._pubkey,
-            created_at=event._created_at
-        )
+        # built in one pass, no intermediate Event
+        return super().from_JSON(evt_json)
 
-    @staticmethod
-    def from_JSON(evt_json):
-        # Create an Event instance from JSON
-        event = Event(
-            id=evt_json['id'],
-            sig=evt_json['sig'],
-            kind=evt_json['kind'],
-            content=evt_json['content'],
-            tags=evt_json['tags'],
-            pubkey=evt_json['pubkey'],
-            created_at=evt_json['created_at']
-        )
-
-        # Return a new NIP47Request instance
-        return NIP47Request(event=event)
-
-    async def process_request(self, dh_privkey_hex: str):
+    @property
+    def encryption(self) -> str:
+        """scheme named by the request's encryption tag"""
+        return self._tags.get_tag_value_pos(
+            "encryption", default=DEFAULT_ENCRYPTION)
+
+    @property
+    def response_encryption(self) -> str:
+        """scheme to encrypt the response with"""
+        encryption = self.encryption
+        if encryption in ENCRYPTION_SCHEMES:
+            return encryption
+        return DEFAULT_ENCRYPTION
+
+    async def process_request(self, tenant, deadline: int = None):
+        """
+        answer the request to tenant, see TenantRegistry.for_event. Not
+        executed after deadline (unix time), see admission.deadline
+        """
+        method = None
         try:
-            request_payload = json.loads(self.decrypt_content(dh_privkey_hex))
+            if self.encryption not in ENCRYPTION_SCHEMES:
+                raise NWCError(ErrorCodes.UNSUPPORTED_ENCRYPTION,
+                               f"unsupported encryption: {self.encryption}")
+
+            request_payload = json.loads(await self.decrypt_content(tenant.privkey_hex))
             method = request_payload.get("method", None)
 
-            plugin.log(f"nwc request received: {request_payload}", 'debug')
+            logger.debug("request", "nwc request received", connection=self.pubkey,
+                         method=method, params=request_payload.get("params"))
 
-            connection = NIP47URI.find_unique(pubkey=self._pubkey)
+            connection = NIP47URI.find_unique(pubkey=self.pubkey)
 
-            if not connection:
+            # a connection only talks to its own tenant's key
+            if not connection or connection.tenant != tenant.name:
                 raise UnauthorizedError()
 
             request_handler = NIP47RequestHandler(
-                connection=connection, request=request_payload)
+                connection=connection, request=request_payload, event=self)
 
             if not request_handler.handler:
                 raise NotImplementedError()
 
-            execution_result = await request_handler.execute(request_payload.get("params"))
+            # the decryption may have waited for a crypto worker
+            if deadline is not None and time.time() > deadline:
+                plugin.shedder.expired += 1
+                raise ExpiredError()
+            if not plugin.shedder.acquire(method, tenant.name):
+                raise RateLimitedError("overloaded, try again later")
+            try:
+                execution_result = await request_handler.execute(request_payload.get("params"))
+            finally:
+                plugin.shedder.release(tenant.name)
 
             return self.success_response(result_type=method, result=execution_result)
 
         except NWCError as e:
-            plugin.log(f"NWC ERROR: {e}", 'debug')
+            logger.debug("request", "nwc request error", connection=self.pubkey,
+                         method=method, error=e.code.value, message=e.message)
             return self.error_response(result_type=method, code=e.code, message=e.message)
 
         except RpcError as e:
-            plugin.log(f"RPC ERROR: {e}", 'error')
+            logger.error("rpc", "nwc rpc error", connection=self.pubkey,
+                         method=method, error=e.error)
             message = e.error.get("message", None)
             return self.error_response(
                 result_type=method, code=ErrorCodes.INTERNAL, message=message)
@@ -639,7 +842,8 @@ class NIP47Request(Event):
             return self.error_response(result_type=method, code=ErrorCodes.OTHER, message=str(e.msg))
 
         except Exception as e:
-            plugin.log(f"ERROR: {e}", 'error')
+            logger.error("request", "nwc request failed", connection=self.pubkey,
+                         method=method, error=str(e))
             return self.error_response(result_type=method, code=ErrorCodes.INTERNAL)
 
     def success_response(self, result_type, result):
@@ -661,20 +865,20 @@ class NIP47Request(Event):
             }
         }
 
-    def decrypt_content(self, dh_privkey_hex: str):
-        """Use nip04 to decrypt the event content"""
-        return nip04.decrypt(
-            secret_key=dh_privkey_hex,
-            pubkey_hex=self._pubkey,
-            data=self._content
-        )
+    async def decrypt_content(self, dh_privkey_hex: str):
+        """Use the requested scheme (nip04 or nip44) to decrypt the event content"""
+        return await crypto.run(
+            "decrypt", self.encryption, dh_privkey_hex, self.pubkey, self._content)
 
 
 class InfoEvent(Event):
+    __slots__ = ()
+
     def __init__(self, supported_methods: list[str]):
         # create kind 23195 (nwc response) event with encrypted payload
         content = ' '.join(supported_methods)
 
         super().__init__(
             content=content,
+            tags=[["encryption", " ".join(ENCRYPTION_SCHEMES)]],
             kind=13194)
@@ -0,0 +1,175 @@
+"""
+Single-flight pay_invoice so retried and replayed requests pay only once
+"""
+
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+
+# completed payments remembered for duplicate requests
+COMPLETED_PAYMENTS = 10000
+
+# an interrupted payment without any pay attempt this long after the
+# restart was never handed to lightningd
+RESUME_GRACE = 60
+
+
+class PaymentRegistry:
+    """
+    Payments keyed by (connection pubkey, payment_hash). A duplicate
+    request for a payment in flight waits for that attempt, a duplicate
+    for a completed payment gets the stored result. Failed attempts are
+    forgotten so the app can retry.
+
+    Only used from the relay thread's event loop, except for snapshot().
+    """
+
+    def __init__(self, size: int = COMPLETED_PAYMENTS):
+        self.size = size
+        self._inflight: dict[tuple, asyncio.Future] = {}
+        # key -> the request that started the attempt, {"event_id", "encryption"}
+        self._requests: dict[tuple, dict] = {}
+        # attempts in flight when the plugin last stopped, see RelayPool.resume_payments
+        self._interrupted: dict[tuple, dict] = {}
+        self._restored_at = time.monotonic()
+        # key -> future of duplicates waiting for an interrupted payment to be resumed
+        self._resumed: dict[tuple, asyncio.Future] = {}
+        self._completed: OrderedDict[tuple, dict] = OrderedDict()
+        # bolt11 -> payment_hash, duplicates skip the decodepay
+        self._hashes: OrderedDict[str, str] = OrderedDict()
+        # connection pubkey -> msat of its payments in flight
+        self._reserved: Counter = Counter()
+        self.counters = Counter()
+        # guards the dicts snapshot() copies from the Snapshotter thread
+        self._lock = threading.Lock()
+
+    def payment_hash(self, invoice: str) -> str:
+        return self._hashes.get(invoice)
+
+    def remember_hash(self, invoice: str, payment_hash: str):
+        self._hashes[invoice] = payment_hash
+        if len(self._hashes) > self.size:
+            self._hashes.popitem(last=False)
+
+    def reserved(self, pubkey: str) -> int:
+        return self._reserved[pubkey]
+
+    def reserve(self, pubkey: str, amount_msat: int):
+        """count (or with a negative amount release) budget for a payment in flight"""
+        self._reserved[pubkey] += amount_msat
+        if self._reserved[pubkey] <= 0:
+            del self._reserved[pubkey]
+
+    def completed(self, key: tuple) -> dict:
+        return self._completed.get(key)
+
+    async def pay(self, key: tuple, attempt, request: dict = None) -> dict:
+        """
+        run attempt() unless the payment for key is in flight or done,
+        request is kept with the attempt so a restart can still answer it
+        """
+        if key in self._interrupted:
+            self.counters["duplicate_interrupted"] += 1
+            # paid or not before the restart, resume_payment settles it
+            future = self._resumed.get(key)
+            if future is None:
+                future = self._resumed[key] = \
+                    asyncio.get_running_loop().create_future()
+            await asyncio.shield(future)
+
+        result = self._completed.get(key)
+        if result is not None:
+            self.counters["duplicate_completed"] += 1
+            return result
+
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.counters["duplicate_inflight"] += 1
+            # shielded, a cancelled waiter must not cancel the payment
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        if request:
+            with self._lock:
+                self._requests[key] = request
+        self.counters["attempts"] += 1
+        try:
+            result = await attempt()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            self.counters["failed"] += 1
+            future.set_exception(e)
+            # retrieved, nobody may be waiting on it
+            future.exception()
+            raise
+        finally:
+            del self._inflight[key]
+            with self._lock:
+                self._requests.pop(key, None)
+
+        self.complete(key, result)
+        future.set_result(result)
+        return result
+
+    def complete(self, key: tuple, result: dict):
+        with self._lock:
+            self._interrupted.pop(key, None)
+            self._completed[key] = result
+            if len(self._completed) > self.size:
+                self._completed.popitem(last=False)
+        self._settle(key)
+
+    def interrupted(self) -> list[tuple[tuple, dict]]:
+        """[((connection pubkey, payment_hash), request), ...] left by the last run"""
+        return list(self._interrupted.items())
+
+    def resume_expired(self) -> bool:
+        """True once interrupted payments without a pay attempt can be given up on"""
+        return time.monotonic() - self._restored_at >= RESUME_GRACE
+
+    def forget_interrupted(self, key: tuple, error: Exception = None):
+        """
+        an interrupted payment that didn't go through, duplicates waiting
+        for it get error, or pay themselves without one (never attempted)
+        """
+        with self._lock:
+            self._interrupted.pop(key, None)
+        self._settle(key, error)
+
+    def _settle(self, key: tuple, error: Exception = None):
+        future = self._resumed.pop(key, None)
+        if future is None or future.done():
+            return
+        if error is None:
+            future.set_result(None)
+        else:
+            future.set_exception(error)
+            # retrieved, the waiters may be gone
+            future.exception()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            pending = {**self._interrupted, **self._requests}
+            completed = list(self._completed.items())
+        return {
+            "pending": [[*key, request] for key, request in pending.items()],
+            "completed": [[*key, result] for key, result in completed]
+        }
+
+    def restore(self, snapshot: dict):
+        for pubkey, payment_hash, result in snapshot.get("completed", []):
+            self._completed[(pubkey, payment_hash)] = result
+        for pubkey, payment_hash, request in snapshot.get("pending", []):
+            self._interrupted[(pubkey, payment_hash)] = request
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._inflight),
+            "completed": len(self._completed),
+            "interrupted": len(self._interrupted),
+            **dict(self.counters)
+        }
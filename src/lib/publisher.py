@@ -0,0 +1,173 @@
+"""
+Outbound event queue with OK tracking and retries
+"""
+
+import asyncio
+import json
+import time
+from collections import Counter, OrderedDict, deque
+import websockets
+
+# unacknowledged events kept, beyond this publish() drops the oldest
+MAX_IN_FLIGHT = 256
+
+# resend an event if the relay hasn't sent an OK for it after this long
+ACK_TIMEOUT = 10
+
+MAX_ATTEMPTS = 3
+
+# events written back to back before yielding to the event loop
+WRITE_BATCH = 64
+
+# keep this many publish-to-OK latencies for the percentiles in stats()
+LATENCY_SAMPLES = 1000
+
+
+class PendingEvent:
+    __slots__ = ('frame', 'queued_at', 'sent_at', 'attempts')
+
+    def __init__(self, frame: str):
+        self.frame = frame
+        self.queued_at = time.monotonic()
+        self.sent_at = None
+        self.attempts = 0
+
+
+class Publisher:
+    """
+    Every published event stays pending until the relay sends an OK for its
+    id. Pending events are resent on ack timeout and after a reconnect.
+    Once MAX_IN_FLIGHT events are unacknowledged publish() drops the
+    oldest, a relay that is down or slow never holds up request handling.
+    """
+
+    def __init__(self, relay_url: str, max_in_flight: int = MAX_IN_FLIGHT,
+                 ack_timeout: float = ACK_TIMEOUT,
+                 max_attempts: int = MAX_ATTEMPTS, health=None):
+        self.relay_url = relay_url
+        # RelayHealth of the relay, fed OK latencies and failures
+        self.health = health
+        self.max_in_flight = max_in_flight
+        self.ack_timeout = ack_timeout
+        self.max_attempts = max_attempts
+
+        self._pending: OrderedDict[str, PendingEvent] = OrderedDict()
+        self._queue = asyncio.Queue()
+        self._ws = None
+        self._tasks = []
+
+        self.counters = Counter()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    async def publish(self, event_data: dict):
+        """queue an event, never waits"""
+        event_id = event_data["id"]
+        if event_id in self._pending:
+            return
+
+        if len(self._pending) >= self.max_in_flight:
+            # still queued for the writer, it skips events no longer pending
+            self._pending.popitem(last=False)
+            self.counters["dropped"] += 1
+        self._pending[event_id] = PendingEvent(json.dumps(["EVENT", event_data]))
+        self._queue.put_nowait(event_id)
+        self.counters["published"] += 1
+
+    def attach(self, ws):
+        """start writing to a (new) relay connection, resends anything unacknowledged"""
+        self.detach()
+        self._ws = ws
+
+        self._queue = asyncio.Queue()
+        for event_id in self._pending:
+            self._queue.put_nowait(event_id)
+
+        self._tasks = [asyncio.ensure_future(self._writer()),
+                       asyncio.ensure_future(self._retry_unacked())]
+
+    def detach(self):
+        """stop writing, pending events are kept for the next attach"""
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._ws = None
+
+    async def on_ok(self, event_id: str, accepted: bool, message: str = ""):
+        """handle the relay's ["OK", event_id, accepted, message]"""
+        pending = self._pending.get(event_id)
+        if pending is None:
+            return
+
+        if not accepted and not message.startswith("duplicate:"):
+            self.counters["rejected"] += 1
+            if self.health and pending.sent_at:
+                self.health.on_ack(time.monotonic() - pending.sent_at, accepted=False)
+            if pending.attempts < self.max_attempts:
+                self.counters["retried"] += 1
+                pending.sent_at = None
+                self._queue.put_nowait(event_id)
+                return
+            self.counters["failed"] += 1
+        else:
+            self.counters["acked"] += 1
+            self.latencies.append(time.monotonic() - pending.queued_at)
+            if self.health and pending.sent_at:
+                self.health.on_ack(time.monotonic() - pending.sent_at)
+
+        self._pending.pop(event_id, None)
+
+    async def _writer(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < WRITE_BATCH and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+
+            for event_id in batch:
+                pending = self._pending.get(event_id)
+                if pending is None:
+                    # acked while queued for a retry, or dropped
+                    continue
+                pending.attempts += 1
+                pending.sent_at = time.monotonic()
+                try:
+                    await self._ws.send(pending.frame)
+                except websockets.exceptions.ConnectionClosed:
+                    # Wallet.run reconnects and attaches again
+                    return
+
+    async def _retry_unacked(self):
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for event_id, pending in list(self._pending.items()):
+                if pending.sent_at is None or now - pending.sent_at < self.ack_timeout:
+                    continue
+                if self.health:
+                    self.health.on_error()
+                if pending.attempts >= self.max_attempts:
+                    self.counters["failed"] += 1
+                    self._pending.pop(event_id, None)
+                    continue
+                self.counters["retried"] += 1
+                pending.sent_at = None
+                self._queue.put_nowait(event_id)
+
+    def stats(self) -> dict:
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1,
+                                       int(len(latencies) * p))] * 1000, 1)
+
+        return {
+            "relay": self.relay_url,
+            "in_flight": len(self._pending),
+            **dict(self.counters),
+            "ack_latency_ms": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": percentile(1)
+            }
+        }
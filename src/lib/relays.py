@@ -0,0 +1,199 @@
+"""
+Several relays on one event loop, responses routed by relay health
+"""
+
+import asyncio
+import json
+import threading
+from .nip47 import NIP47Response, NIP47RequestHandler
+from .wallet import Wallet
+from utilities.rpc_plugin import plugin
+
+# interrupted payments still pending are checked again after this long
+RESUME_INTERVAL = 30
+
+# on shutdown, wait this long for the requests in progress, see stop_requests
+STOP_TIMEOUT = 5
+
+
+class RelayPool:
+    """
+    One Wallet per relay, all on the same event loop so the admission
+    filter, payment registry and coalescing see every relay's requests.
+
+    A response goes to the relay its request came from first, then to
+    the other healthy relays best score first. Degraded relays are only
+    used while no relay is healthy and relays that are down are skipped,
+    their Publisher still resends what they missed once they reconnect.
+
+    With a LocalRelay, requests from apps connected to it are answered
+    there only, and it is never picked for the other responses or for
+    new connection urls unless asked for.
+    """
+
+    def __init__(self, urls: list[str], since: int = None, local=None):
+        self.wallets = [Wallet(url, since=since, pool=self) for url in urls]
+        self.local = local
+        # cleared on shutdown, requests received after are left for the next
+        # run which subscribes from before them
+        self.accepting = True
+        self._loop = None
+        # publish_threadsafe() calls from before the loop started
+        self._early = []
+        self._early_lock = threading.Lock()
+        if local:
+            from .local_relay import LocalWallet
+            self.wallets.append(LocalWallet(local, since=since, pool=self))
+
+    @property
+    def remote(self) -> list[Wallet]:
+        return [wallet for wallet in self.wallets if not wallet.local]
+
+    def listen_for_nip47_requests(self):
+        """start the asyncio event loop"""
+        asyncio.run(self.run())
+
+    async def run(self):
+        with self._early_lock:
+            self._loop = asyncio.get_running_loop()
+        for event_data in self._early:
+            asyncio.ensure_future(self.publish_response(event_data))
+        if self.local:
+            try:
+                await self.local.start()
+                plugin.log(f"nwc local relay listening on {self.local.url}", 'info')
+            except OSError as e:
+                plugin.log(f"nwc local relay failed to start: {e}", 'error')
+        # answer requests paid while the plugin was down
+        if plugin.payments.interrupted():
+            asyncio.ensure_future(self.resume_payments())
+        await asyncio.gather(*(wallet.run() for wallet in self.wallets))
+
+    def stop_requests(self, timeout: float = STOP_TIMEOUT):
+        """
+        stop taking requests and wait up to timeout for those in progress,
+        called from the shutdown hook before the state snapshot
+        """
+        self.accepting = False
+        if self._loop is None:
+            return
+        future = asyncio.run_coroutine_threadsafe(self._drain(timeout), self._loop)
+        try:
+            future.result(timeout + 1)
+        except Exception:
+            # still paying, the snapshot lists them as pending
+            pass
+
+    async def _drain(self, timeout: float):
+        tasks = [task for wallet in self.wallets for task in wallet.requests]
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+
+    def on_connections_changed(self, added: list[str], removed: list[str]):
+        """AdmissionFilter listener, see Wallet.on_connections_changed"""
+        for wallet in self.wallets:
+            wallet.on_connections_changed(added, removed)
+
+    def announce(self, tenant):
+        """publish a new tenant's info event on every relay"""
+        for wallet in self.wallets:
+            wallet.announce(tenant)
+
+    @property
+    def ready(self) -> bool:
+        """subscribed on at least one relay"""
+        return any(wallet.subscribed.is_set() for wallet in self.wallets)
+
+    @property
+    def since(self) -> int:
+        """the oldest subscription checkpoint, see Wallet.since"""
+        return min(wallet.since for wallet in self.remote)
+
+    def ranked(self) -> list[Wallet]:
+        """connected remote relays, best score first"""
+        return sorted((wallet for wallet in self.remote
+                       if wallet.health.score() is not None),
+                      key=lambda wallet: wallet.health.score())
+
+    def best_url(self) -> str:
+        """relay to hand out in new connection urls"""
+        ranked = self.ranked()
+        return (ranked[0] if ranked else self.remote[0]).uri
+
+    def targets(self, origin: Wallet = None) -> list[Wallet]:
+        if origin is not None and origin.local:
+            return [origin]
+        ranked = self.ranked()
+        targets = [wallet for wallet in ranked
+                   if wallet.health.state == "healthy"] or ranked
+
+        if origin is not None:
+            targets = [origin] + [wallet for wallet in targets if wallet is not origin]
+        if not targets:
+            # nothing is connected, queue it on the first relay to come back
+            targets = [self.remote[0]]
+        if origin is None and self.local:
+            # a resumed payment, the app may be on the local relay
+            targets.append(self.wallets[-1])
+        return targets
+
+    async def publish_response(self, event_data: dict, origin: Wallet = None):
+        for wallet in self.targets(origin):
+            await wallet.send_event(event_data)
+
+    async def resume_payments(self):
+        """respond to pay_invoice requests whose payment was in flight on the last shutdown"""
+        await resume_payments(self.publish_response)
+
+    def publish_threadsafe(self, event_data: dict):
+        """publish_response() from another thread, see ShardPool"""
+        with self._early_lock:
+            if self._loop is None:
+                self._early.append(event_data)
+                return
+        asyncio.run_coroutine_threadsafe(self.publish_response(event_data), self._loop)
+
+    def stats(self) -> list[dict]:
+        """health of every relay, best first"""
+        ranked = self.ranked()
+        order = ranked + [wallet for wallet in self.wallets if wallet not in ranked]
+        return [{
+            "url": wallet.uri,
+            **wallet.health.stats(),
+            "in_flight": wallet.publisher.stats()["in_flight"]
+        } for wallet in order]
+
+    def publisher_stats(self) -> dict:
+        return {wallet.uri: wallet.publisher.stats() for wallet in self.remote}
+
+
+async def resume_payments(publish):
+    """
+    answer the interrupted payments of plugin.payments as they settle,
+    publish(event_data) sends a response. Runs in the shard workers too
+    """
+    while True:
+        for (pubkey, payment_hash), request in plugin.payments.interrupted():
+            try:
+                response_content = await NIP47RequestHandler.resume_payment(
+                    pubkey, payment_hash)
+            except Exception as e:
+                plugin.log(f"nwc resume payment {payment_hash} failed: {e}", 'error')
+                continue
+            if response_content is None:
+                continue
+
+            plugin.log(f"nwc resumed payment {payment_hash}", 'info')
+            tenant = plugin.tenants.get(request.get("tenant"))
+            response_event = await NIP47Response.create(
+                content=json.dumps(response_content),
+                nip04_pubkey=pubkey,
+                referenced_event_id=request["event_id"],
+                privkey=tenant.privkey_hex,
+                encryption=request["encryption"]
+            )
+            await publish(await response_event.signed_event_data())
+
+        if not plugin.payments.interrupted():
+            return
+        await asyncio.sleep(RESUME_INTERVAL)
@@ -0,0 +1,426 @@
+"""
+Request handling sharded over worker processes by client pubkey
+"""
+
+import asyncio
+import glob
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from .store import JOURNAL_SEQ
+from .log import logger
+from .usage import RequestUsage
+from utilities.rpc_plugin import plugin
+
+# a worker checks this often whether the plugin process is still alive
+PARENT_CHECK_INTERVAL = 1
+
+# workers report their counters this often, see ShardPool.stats
+STATS_INTERVAL = 5
+
+STOP_TIMEOUT = 5
+
+# the plugin checks this often whether its workers are still alive
+WORKER_CHECK_INTERVAL = 1
+
+# a request not answered by its worker within this long gets an error,
+# longer than a pay_invoice takes with lightningd's default retry_for of 60s
+SUBMIT_TIMEOUT = 120
+
+
+def shard_of(pubkey: str, shards: int) -> int:
+    """client pubkeys are uniformly distributed, their first bytes are hash enough"""
+    return int(pubkey[:8], 16) % shards
+
+
+def journal_path(data_dir: str, index: int) -> str:
+    return os.path.join(data_dir, f"spends.shard{index}.journal")
+
+
+def journal_seq_key(index: int) -> str:
+    return f"{JOURNAL_SEQ}.shard{index}"
+
+
+def shard_payments(payments: dict, index: int, shards: int) -> dict:
+    """the part of a PaymentRegistry snapshot whose client pubkeys belong to shard index"""
+    return {kind: [entry for entry in payments.get(kind, [])
+                   if shard_of(entry[0], shards) == index]
+            for kind in ("pending", "completed")}
+
+
+def replay_journals(data_dir: str, store) -> int:
+    """
+    apply what shard workers journaled but didn't compact, also for shards
+    a previous run had and this one doesn't
+    """
+    from .journal import SpendJournal
+
+    replayed = 0
+    for path in glob.glob(os.path.join(data_dir, "spends.shard*.journal")):
+        index = int(os.path.basename(path)[len("spends.shard"):-len(".journal")])
+        replayed += SpendJournal(path, store, seq_key=journal_seq_key(index)).replay()
+    return replayed
+
+
+class ShardError(Exception):
+    """a request its worker didn't answer"""
+
+
+class ShardPool:
+    """
+    Worker processes (spawned) that each have their own RPC connection,
+    store connection, spend journal and caches.
+
+    The relay thread admits request events and hands them to the worker
+    owning the client pubkey, so one connection's requests are handled by
+    one process, in order, and its budget state never leaves it. Workers
+    send the signed responses back for the relay thread to publish, their
+    log lines come back the same way.
+
+    A worker that dies is restarted with a new inbox, the requests it had
+    are answered with an error rather than handed to the new worker.
+
+    Each worker has its own PaymentRegistry. Workers report its snapshot
+    for the plugin's state.json, and start (or restart) with the part of
+    the last snapshot for their client pubkeys, resuming the payments
+    that were in flight themselves.
+    """
+
+    def __init__(self, workers: int, config: dict, payments: dict = None):
+        self._context = multiprocessing.get_context("spawn")
+        self._config = config
+        self._outbox = self._context.Queue()
+        self._inboxes = [None] * workers
+        self._processes = [None] * workers
+
+        self._lock = threading.Lock()
+        # request id -> (future, loop, shard) waiting for the worker's response
+        self._pending = {}
+        self._ids = itertools.count()
+        self._stopping = False
+
+        self.submitted = Counter()
+        self.failed = 0
+        self.timed_out = 0
+        self.restarts = Counter()
+        # shard -> the counters it last reported
+        self._worker_stats = {}
+        # shard -> its PaymentRegistry snapshot, the restored one until it reports
+        self._payments = {index: shard_payments(payments or {}, index, workers)
+                          for index in range(workers)}
+        # shards that reported their payments since sync_payments() asked
+        self._synced = set()
+        self._synced_cond = threading.Condition(self._lock)
+
+    def __len__(self):
+        return len(self._inboxes)
+
+    def _spawn(self, index: int):
+        """caller holds the lock, or the pool isn't started yet"""
+        inbox = self._context.Queue()
+        process = self._context.Process(
+            target=worker_main, name=f"nwc-shard-{index}",
+            args=(index, self._config, self._payments[index], inbox, self._outbox),
+            daemon=True)
+        process.start()
+        self._inboxes[index] = inbox
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(len(self._inboxes)):
+            self._spawn(index)
+        threading.Thread(target=self._read, daemon=True).start()
+        threading.Thread(target=self._watch, daemon=True).start()
+
+    def stop(self):
+        """let the workers compact their journals and exit"""
+        self._stopping = True
+        self.broadcast("stop")
+        deadline = time.monotonic() + STOP_TIMEOUT
+        for process in self._processes:
+            process.join(max(0, deadline - time.monotonic()))
+
+    async def submit(self, event_data: dict) -> dict:
+        """
+        the worker's signed response event data, None if it has none. An
+        error response if the worker died or didn't answer in time
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        request_id = next(self._ids)
+        shard = shard_of(event_data["pubkey"], len(self._inboxes))
+        with self._lock:
+            self._pending[request_id] = (future, loop, shard)
+            inbox = self._inboxes[shard]
+        self.submitted[shard] += 1
+        inbox.put(("request", request_id, event_data))
+
+        try:
+            return await asyncio.wait_for(future, SUBMIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            with self._lock:
+                self._pending.pop(request_id, None)
+            self.timed_out += 1
+            message = "request timed out"
+        except ShardError as e:
+            message = str(e)
+
+        from .wallet import error_event
+        return await error_event(event_data, message)
+
+    def payments_snapshot(self) -> dict:
+        """the workers' PaymentRegistry snapshots as one, see collect_state"""
+        with self._lock:
+            snapshots = list(self._payments.values())
+        return {kind: [entry for snapshot in snapshots for entry in snapshot[kind]]
+                for kind in ("pending", "completed")}
+
+    def sync_payments(self, timeout: float = STOP_TIMEOUT):
+        """have every worker report its payments now, before the shutdown snapshot"""
+        with self._lock:
+            self._synced = set()
+        self.broadcast("payments")
+        deadline = time.monotonic() + timeout
+        with self._synced_cond:
+            while len(self._synced) < len(self._inboxes):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return
+                self._synced_cond.wait(remaining)
+
+    def broadcast(self, *message):
+        """send every worker a control message, see serve()"""
+        with self._lock:
+            inboxes = list(self._inboxes)
+        for inbox in inboxes:
+            inbox.put(message)
+
+    def _watch(self):
+        """restart dead workers, failing the requests they had"""
+        while not self._stopping:
+            time.sleep(WORKER_CHECK_INTERVAL)
+            for index, process in enumerate(self._processes):
+                if process.is_alive() or self._stopping:
+                    continue
+                logger.error("shard", "nwc shard worker died, restarting",
+                             shard=index, exitcode=process.exitcode)
+                with self._lock:
+                    # requests submitted from here on go to the new inbox
+                    self._spawn(index)
+                    lost = [request_id for request_id, (_, _, shard)
+                            in self._pending.items() if shard == index]
+                    lost = [self._pending.pop(request_id) for request_id in lost]
+                self.restarts[index] += 1
+                for future, loop, _ in lost:
+                    loop.call_soon_threadsafe(
+                        _fail, future, ShardError("request handler failed, try again"))
+
+    def _read(self):
+        while True:
+            message = self._outbox.get()
+            kind = message[0]
+            if kind == "response":
+                _, request_id, event_data, error = message
+                with self._lock:
+                    future, loop, _ = self._pending.pop(request_id, (None, None, None))
+                if error:
+                    self.failed += 1
+                    logger.error("request", "nwc request failed", error=error)
+                if future is None:
+                    # timed out, or its worker was restarted meanwhile
+                    continue
+                if error:
+                    loop.call_soon_threadsafe(_fail, future, ShardError("internal error"))
+                else:
+                    loop.call_soon_threadsafe(_resolve, future, event_data)
+            elif kind == "payments":
+                _, index, payments = message
+                with self._synced_cond:
+                    self._payments[index] = payments
+                    self._synced.add(index)
+                    self._synced_cond.notify_all()
+            elif kind == "publish":
+                # a resumed payment's response
+                plugin.relays.publish_threadsafe(message[1])
+            elif kind == "usage":
+                plugin.usage.add(RequestUsage(*message[1]))
+            elif kind == "usage_payment":
+                plugin.usage.add_payment(*message[1:])
+            elif kind == "log":
+                _, text, level = message
+                plugin.log(text, level)
+            elif kind == "stats":
+                _, index, stats = message
+                self._worker_stats[index] = stats
+
+    def stats(self) -> list[dict]:
+        return [{
+            "shard": index,
+            "pid": process.pid,
+            "alive": process.is_alive(),
+            "submitted": self.submitted[index],
+            "restarts": self.restarts[index],
+            **self._worker_stats.get(index, {})
+        } for index, process in enumerate(self._processes)]
+
+
+def _resolve(future: asyncio.Future, event_data: dict):
+    if not future.done():
+        future.set_result(event_data)
+
+
+def _fail(future: asyncio.Future, error: Exception):
+    if not future.done():
+        future.set_exception(error)
+
+
+class UsageForwarder:
+    """plugin.usage in a worker, sends each request's usage to the plugin process"""
+
+    def __init__(self, outbox):
+        self._outbox = outbox
+
+    def add(self, usage: RequestUsage):
+        self._outbox.put(("usage", usage.astuple()))
+
+    def add_payment(self, pubkey: str, amount_msat: int):
+        self._outbox.put(("usage_payment", pubkey, amount_msat))
+
+
+def worker_main(index: int, config: dict, payments: dict, inbox, outbox):
+    """a shard worker process, sets up its own plugin state and serves the inbox"""
+    from pyln.client import LightningRpc
+    from .store import ConnectionStore
+    from .journal import SpendJournal
+    from .tenants import TenantRegistry
+    from .cache import ResponseCache
+    from .payments import PaymentRegistry
+    from .coalesce import SingleFlight
+    from .admission import LoadShedder
+    from .usage import time_rpc
+
+    # stdout belongs to lightningd's plugin protocol, log through the plugin process
+    def log(message, level='info'):
+        outbox.put(("log", f"nwc shard {index}: {message}", level))
+
+    plugin.log = log
+    # lines are dropped here already, not after the trip to the plugin process
+    logger.configure(**config["log"])
+    plugin.shards = None
+    plugin.rpc = LightningRpc(config["rpc_path"])
+    time_rpc(plugin.rpc)
+    # the plugin process keeps the usage counters of all shards
+    plugin.usage = UsageForwarder(outbox)
+    plugin.capture = None
+    if config["capture"]:
+        # the workers' RPC calls go into the plugin's recording
+        from .capture import Recorder
+        plugin.capture = Recorder(config["capture"])
+        plugin.capture.wrap_rpc(plugin.rpc)
+    plugin.store = ConnectionStore(os.path.join(config["data_dir"], "connections.sqlite3"))
+    plugin.journal = SpendJournal(journal_path(config["data_dir"], index), plugin.store,
+                                  seq_key=journal_seq_key(index))
+    # what a worker that died before compacting left
+    plugin.journal.replay()
+    plugin.journal.start()
+    plugin.tenants = TenantRegistry(plugin.store)
+    plugin.tenants.load(plugin)
+    plugin.pubkey = plugin.tenants.default.pubkey
+    plugin.responses = ResponseCache()
+    plugin.payments = PaymentRegistry()
+    plugin.payments.restore(payments)
+    plugin.coalescer = SingleFlight()
+    plugin.request_max_age = config["request_max_age"]
+    plugin.shedder = LoadShedder()
+
+    try:
+        asyncio.run(serve(index, inbox, outbox))
+    finally:
+        plugin.journal.compact()
+        plugin.journal.stop()
+
+
+async def serve(index: int, inbox, outbox):
+    from . import nip44
+    from .wallet import respond
+    from .relays import resume_payments
+
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    tasks = set()
+
+    async def handle(request_id, event_data):
+        try:
+            response = await respond(event_data)
+        except Exception as e:
+            outbox.put(("response", request_id, None, str(e)))
+            return
+        outbox.put(("response", request_id, response, None))
+
+    def dispatch(message):
+        kind = message[0]
+        if kind == "request":
+            task = asyncio.ensure_future(handle(*message[1:]))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        elif kind == "block":
+            plugin.responses.on_block()
+        elif kind == "payment":
+            plugin.responses.on_payment(message[1])
+        elif kind == "evict":
+            nip44.conversation_keys.evict(message[1])
+        elif kind == "tenants":
+            plugin.tenants.load(plugin)
+        elif kind == "payments":
+            report_payments()
+        elif kind == "stop" and not stopped.done():
+            stopped.set_result(None)
+
+    def read():
+        parent = multiprocessing.parent_process()
+        while True:
+            try:
+                message = inbox.get(timeout=PARENT_CHECK_INTERVAL)
+            except queue.Empty:
+                if parent is not None and not parent.is_alive():
+                    # the plugin was killed, nothing will send "stop"
+                    message = ("stop",)
+                else:
+                    continue
+            loop.call_soon_threadsafe(dispatch, message)
+            if message[0] == "stop":
+                return
+
+    def report_payments():
+        outbox.put(("payments", index, plugin.payments.snapshot()))
+
+    async def publish(event_data):
+        outbox.put(("publish", event_data))
+
+    async def report():
+        while True:
+            report_payments()
+            outbox.put(("stats", index, {
+                "in_progress": len(tasks),
+                "tenants": [tenant.stats() for tenant in plugin.tenants.all()],
+                "response_cache": plugin.responses.stats(),
+                "payments": plugin.payments.stats(),
+                "load_shedding": plugin.shedder.stats(),
+                "logging": logger.stats(),
+                "spend_journal": plugin.journal.stats()
+            }))
+            await asyncio.sleep(STATS_INTERVAL)
+
+    threading.Thread(target=read, daemon=True).start()
+    reporter = asyncio.ensure_future(report())
+    if plugin.payments.interrupted():
+        # answered through the plugin process' relays
+        asyncio.ensure_future(resume_payments(publish))
+    await stopped
+    reporter.cancel()
+    if tasks:
+        await asyncio.wait(tasks, timeout=STOP_TIMEOUT)
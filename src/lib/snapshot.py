@@ -0,0 +1,85 @@
+"""
+Periodic and on-shutdown snapshots of the in-memory state for warm restarts
+"""
+
+import json
+import os
+import threading
+import time
+from utilities.rpc_plugin import plugin
+
+SNAPSHOT_VERSION = 1
+
+# seconds between snapshots, one is also written on shutdown
+SNAPSHOT_INTERVAL = 60
+
+
+class Snapshotter:
+    """
+    Writes collect()'s dict to path as compact json, atomically (temp file
+    + rename) so a crash mid write leaves the previous snapshot intact.
+    """
+
+    def __init__(self, path: str, collect, interval: int = SNAPSHOT_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self._collect = collect
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self.saved_at = None
+        self.size = None
+        self.failures = 0
+        self.last_error = None
+
+    def load(self) -> dict:
+        """the last snapshot, {} if there is none or it can't be used"""
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if state.get("version") != SNAPSHOT_VERSION:
+            return {}
+        return state
+
+    def save(self):
+        state = {
+            "version": SNAPSHOT_VERSION,
+            "saved_at": int(time.time()),
+            **self._collect()
+        }
+        data = json.dumps(state, separators=(',', ':'))
+
+        with self._lock:
+            tmp = self.path + ".tmp"
+            with open(tmp, "w") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            self.saved_at = state["saved_at"]
+            self.size = len(data)
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                # the previous snapshot is kept, try again next interval
+                self.failures += 1
+                self.last_error = str(e)
+                plugin.log(f"nwc state snapshot failed: {e}", 'error')
+
+    def stats(self) -> dict:
+        return {
+            "saved_at": self.saved_at,
+            "bytes": self.size,
+            "failures": self.failures,
+            "last_error": self.last_error
+        }
@@ -0,0 +1,441 @@
+"""
+Local storage for nostr wallet connections and their spend history
+"""
+
+import json
+import sqlite3
+import threading
+import time
+from pyln.client import Millisatoshi
+from .budget import SpendRing
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS connections (
+    pubkey TEXT PRIMARY KEY,
+    secret TEXT NOT NULL,
+    relay_url TEXT,
+    budget_msat INTEGER,
+    spent_msat INTEGER NOT NULL DEFAULT 0,
+    expiry_unix INTEGER,
+    created_at INTEGER NOT NULL,
+    budget_renewal TEXT,
+    budget_window INTEGER,
+    spend_ring TEXT,
+    tenant TEXT
+);
+CREATE INDEX IF NOT EXISTS connections_expiry_unix
+    ON connections (expiry_unix);
+CREATE INDEX IF NOT EXISTS connections_created_at
+    ON connections (created_at);
+
+CREATE TABLE IF NOT EXISTS spends (
+    id INTEGER PRIMARY KEY,
+    pubkey TEXT NOT NULL,
+    amount_msat INTEGER NOT NULL,
+    created_at INTEGER NOT NULL,
+    payment_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS spends_created_at
+    ON spends (created_at);
+
+CREATE TABLE IF NOT EXISTS tenants (
+    name TEXT PRIMARY KEY,
+    budget_msat INTEGER,
+    spent_msat INTEGER NOT NULL DEFAULT 0,
+    budget_renewal TEXT,
+    budget_window INTEGER,
+    spend_ring TEXT,
+    created_at INTEGER NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+CONNECTION_COLUMNS = ("pubkey", "secret", "relay_url", "budget_msat",
+                      "spent_msat", "expiry_unix", "created_at",
+                      "budget_renewal", "budget_window", "tenant")
+
+TENANT_COLUMNS = ("name", "budget_msat", "spent_msat", "budget_renewal",
+                  "budget_window", "spend_ring", "created_at")
+
+# columns added after the first release, added to existing databases
+ADDED_COLUMNS = {
+    "connections": {
+        "budget_renewal": "TEXT",
+        "budget_window": "INTEGER",
+        "spend_ring": "TEXT",
+        "tenant": "TEXT",
+    },
+    "spends": {
+        "payment_hash": "TEXT",
+    },
+}
+
+DATASTORE_MIGRATED = "datastore_migrated"
+
+# connections without a tenant use the wallet service key the plugin always had
+DEFAULT_TENANT = "v0"
+
+# bumped whenever connections are added or removed, tells a state snapshot
+# whether its copy of the connection registry is still current
+GENERATION = "generation"
+
+# last SpendJournal seq compacted into the store
+JOURNAL_SEQ = "journal_seq"
+
+# the spends table only answers whether a payment was charged already (see
+# resume_payment), it keeps the spends of this long before the newest one.
+# Relative to the newest so a plugin that was down keeps them until it resumes
+SPEND_RETENTION = 24 * 60 * 60
+
+# what a connection spent in its current budget window, see window_spent()
+WINDOW_SPENT = "window_spent(spent_msat, budget_renewal, budget_window, spend_ring)"
+
+# nwc-list sort keys, NULL (no expiry/budget) sorts last
+SORT_KEYS = {
+    "created_at": "created_at",
+    "expiry_unix": "COALESCE(expiry_unix, 9223372036854775807)",
+    "spent_msat": "spent_msat",
+    # as nwc-list shows it, renewed budgets start over
+    "remaining_budget_msat":
+        f"COALESCE(MAX(budget_msat - {WINDOW_SPENT}, 0), 9223372036854775807)"
+}
+
+
+def window_spent(spent_msat: int, budget_renewal: str, budget_window: int,
+                 spend_ring: str) -> int:
+    """sqlite function, the spend that counts against a connection's budget now"""
+    ring = SpendRing.from_record({"budget_renewal": budget_renewal,
+                                  "budget_window": budget_window,
+                                  "spend_ring": spend_ring})
+    return ring.spent() if ring.renews else spent_msat or 0
+
+
+class ConnectionStore:
+    """
+    sqlite (WAL mode) backed connection store. A single connection is
+    shared by the rpc thread and the relay thread, guarded by a lock.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.create_function("window_spent", 4, window_spent)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            self._db.executescript(SCHEMA)
+            for table, columns in ADDED_COLUMNS.items():
+                existing = {row["name"] for row in self._db.execute(
+                    f"PRAGMA table_info({table})")}
+                for column, column_type in columns.items():
+                    if column not in existing:
+                        self._db.execute(
+                            f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            self._db.execute("CREATE INDEX IF NOT EXISTS connections_tenant "
+                             "ON connections (tenant)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS spends_payment_hash "
+                             "ON spends (payment_hash)")
+            # nothing looks spends up by connection
+            self._db.execute("DROP INDEX IF EXISTS spends_pubkey_created_at")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def get(self, pubkey: str) -> dict:
+        """a single connection record or None"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT * FROM connections WHERE pubkey = ?",
+                (pubkey,)).fetchone()
+        return dict(row) if row else None
+
+    def all(self, status: str = None) -> list[dict]:
+        """
+        every connection record, oldest first. status can be "active" or
+        "expired" to only return those connections.
+        """
+        return self.page(status=status)[0]
+
+    def page(self, limit: int = None, cursor: str = None,
+             status: str = None, min_budget_used_pct: float = None,
+             created_since: int = None, sort: str = "created_at",
+             tenant: str = None):
+        """
+        A page of connection records, filtered and sorted in sqlite.
+
+        sort is one of SORT_KEYS, prefixed with "-" for descending order.
+        Returns (records, next_cursor), next_cursor is None on the last page.
+        """
+        descending = sort.startswith("-")
+        sort_key = sort.lstrip("-")
+        if sort_key not in SORT_KEYS:
+            raise ValueError(f"unknown sort key {sort_key}")
+        sort_expr = SORT_KEYS[sort_key]
+
+        where, params = [], []
+        now = int(time.time())
+        if status == "active":
+            where.append("(expiry_unix IS NULL OR expiry_unix >= ?)")
+            params.append(now)
+        elif status == "expired":
+            where.append("expiry_unix < ?")
+            params.append(now)
+        elif status is not None:
+            raise ValueError(f"unknown status {status}")
+
+        if min_budget_used_pct is not None:
+            where.append(
+                f"budget_msat IS NOT NULL AND {WINDOW_SPENT} * 100.0 >= budget_msat * ?")
+            params.append(min_budget_used_pct)
+
+        if created_since is not None:
+            where.append("created_at >= ?")
+            params.append(created_since)
+
+        if tenant is not None:
+            # connections from before tenants belong to the default one
+            where.append("COALESCE(tenant, ?) = ?")
+            params.extend((DEFAULT_TENANT, tenant))
+
+        # keyset pagination, the cursor is the last row's "sort_value:pubkey"
+        if cursor:
+            try:
+                cursor_value, cursor_pubkey = cursor.split(":")
+                cursor_value = int(cursor_value)
+            except ValueError:
+                raise ValueError(f"invalid cursor {cursor}")
+            where.append(
+                f"({sort_expr}, pubkey) {'<' if descending else '>'} (?, ?)")
+            params.extend((cursor_value, cursor_pubkey))
+
+        direction = "DESC" if descending else "ASC"
+        query = (f"SELECT *, {sort_expr} AS sort_value FROM connections "
+                 f"{'WHERE ' + ' AND '.join(where) if where else ''} "
+                 f"ORDER BY sort_value {direction}, pubkey {direction}")
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit + 1)
+
+        with self._lock:
+            rows = [dict(row) for row in self._db.execute(query, params)]
+
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['sort_value']}:{rows[-1]['pubkey']}"
+
+        for row in rows:
+            del row["sort_value"]
+
+        return rows, next_cursor
+
+    def insert(self, record: dict):
+        """add a connection, created_at defaults to now"""
+        self.insert_many([record])
+
+    def insert_many(self, records: list[dict]):
+        """add connections in a single transaction"""
+        now = int(time.time())
+        rows = [
+            tuple({"spent_msat": 0, "created_at": now, **record}.get(column)
+                  for column in CONNECTION_COLUMNS)
+            for record in records
+        ]
+        with self._lock, self._db:
+            self._db.executemany(
+                f"INSERT INTO connections ({', '.join(CONNECTION_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(CONNECTION_COLUMNS))})",
+                rows)
+            self._bump_generation()
+
+    def delete(self, pubkey: str) -> bool:
+        """remove a connection and its spend history"""
+        with self._lock, self._db:
+            deleted = self._db.execute(
+                "DELETE FROM connections WHERE pubkey = ?",
+                (pubkey,)).rowcount
+            self._db.execute("DELETE FROM spends WHERE pubkey = ?", (pubkey,))
+            self._bump_generation()
+        return deleted > 0
+
+    def add_spend(self, pubkey: str, amount_msat: int,
+                  created_at: int = None, payment_hash: str = None) -> dict:
+        """
+        record a payment against a connection, returns the updated record
+        """
+        if created_at is None:
+            created_at = int(time.time())
+        with self._lock, self._db:
+            return self._apply_spend(pubkey, amount_msat, created_at, payment_hash)
+
+    def apply_spends(self, records: list[list], seq_key: str = JOURNAL_SEQ):
+        """
+        SpendJournal compaction, [[seq, pubkey, amount_msat, created_at,
+        payment_hash], ...] in one transaction that also stores the last
+        seq under seq_key
+        """
+        with self._lock, self._db:
+            # journals written before payment hashes were recorded have 4 fields
+            for _, pubkey, amount_msat, created_at, *payment_hash in records:
+                self._apply_spend(pubkey, amount_msat, created_at,
+                                  payment_hash[0] if payment_hash else None)
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (seq_key, str(records[-1][0])))
+            self._db.execute(
+                "DELETE FROM spends WHERE created_at < "
+                "(SELECT MAX(created_at) FROM spends) - ?", (SPEND_RETENTION,))
+
+    def journal_seq(self, seq_key: str = JOURNAL_SEQ) -> int:
+        """seq of the last journaled spend applied to the store"""
+        return int(self.get_meta(seq_key) or 0)
+
+    def has_spend(self, pubkey: str, payment_hash: str) -> bool:
+        """whether the payment's spend was recorded, see resume_payment"""
+        with self._lock:
+            return self._db.execute(
+                "SELECT 1 FROM spends WHERE payment_hash = ? AND pubkey = ?",
+                (payment_hash, pubkey)).fetchone() is not None
+
+    def _apply_spend(self, pubkey: str, amount_msat: int,
+                     created_at: int, payment_hash: str = None) -> dict:
+        """caller holds the lock and a transaction"""
+        row = self._db.execute(
+            "SELECT * FROM connections WHERE pubkey = ?",
+            (pubkey,)).fetchone()
+        if not row:
+            return None
+
+        record = dict(row)
+        record["spent_msat"] += amount_msat
+
+        ring = SpendRing.from_record(record)
+        if ring.renews:
+            ring.add(amount_msat, created_at)
+            record["spend_ring"] = ring.dumps()
+
+        self._db.execute(
+            "UPDATE connections SET spent_msat = ?, spend_ring = ? "
+            "WHERE pubkey = ?",
+            (record["spent_msat"], record["spend_ring"], pubkey))
+        self._db.execute(
+            "INSERT INTO spends (pubkey, amount_msat, created_at, payment_hash) "
+            "VALUES (?, ?, ?, ?)", (pubkey, amount_msat, created_at, payment_hash))
+        self._apply_tenant_spend(record.get("tenant") or DEFAULT_TENANT,
+                                 amount_msat, created_at)
+        return record
+
+    def _apply_tenant_spend(self, name: str, amount_msat: int, created_at: int):
+        """caller holds the lock and a transaction"""
+        row = self._db.execute(
+            "SELECT * FROM tenants WHERE name = ?", (name,)).fetchone()
+        if not row:
+            return
+
+        record = dict(row)
+        ring = SpendRing.from_record(record)
+        if ring.renews:
+            ring.add(amount_msat, created_at)
+            record["spend_ring"] = ring.dumps()
+        self._db.execute(
+            "UPDATE tenants SET spent_msat = spent_msat + ?, spend_ring = ? "
+            "WHERE name = ?", (amount_msat, record["spend_ring"], name))
+
+    def tenants(self) -> list[dict]:
+        """every tenant record (budgets and their spends)"""
+        with self._lock:
+            return [dict(row) for row in self._db.execute(
+                "SELECT * FROM tenants ORDER BY created_at, name")]
+
+    def tenant_connections(self) -> dict:
+        """tenant name -> number of connections"""
+        with self._lock:
+            return {row[0]: row[1] for row in self._db.execute(
+                "SELECT COALESCE(tenant, ?), COUNT(*) FROM connections GROUP BY 1",
+                (DEFAULT_TENANT,))}
+
+    def put_tenant(self, record: dict):
+        """add a tenant or replace its budget, keeps what it spent"""
+        row = {"spent_msat": 0, "created_at": int(time.time()), **record}
+        with self._lock, self._db:
+            self._db.execute(
+                f"INSERT INTO tenants ({', '.join(TENANT_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(TENANT_COLUMNS))}) "
+                "ON CONFLICT (name) DO UPDATE SET "
+                # the ring's buckets only fit the renewal they were made for
+                "spend_ring = CASE WHEN budget_renewal IS excluded.budget_renewal "
+                "AND budget_window IS excluded.budget_window THEN spend_ring END, "
+                "budget_msat = excluded.budget_msat, "
+                "budget_renewal = excluded.budget_renewal, "
+                "budget_window = excluded.budget_window",
+                tuple(row.get(column) for column in TENANT_COLUMNS))
+
+    def get_meta(self, key: str) -> str:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row["value"] if row else None
+
+    def set_meta(self, key: str, value: str):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (key, value))
+
+    def _bump_generation(self):
+        """caller holds the lock and a transaction"""
+        self._db.execute(
+            "INSERT INTO meta (key, value) VALUES (?, '1') "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+            (GENERATION,))
+
+    def generation(self) -> int:
+        return int(self.get_meta(GENERATION) or 0)
+
+    def migrate_from_datastore(self, rpc, base_key: list[str],
+                               default_relay_url: str) -> int:
+        """
+        One time import of the json records lightningd's datastore held
+        before this store existed. The datastore records are left in place.
+        Returns the number of imported connections.
+        """
+        if self.get_meta(DATASTORE_MIGRATED):
+            return 0
+
+        records = rpc.listdatastore(key=base_key)["datastore"]
+
+        rows = []
+        for record in records:
+            if "string" not in record or len(record["key"]) != len(base_key) + 1:
+                continue
+            data = json.loads(record["string"])
+            rows.append({
+                "pubkey": record["key"][-1],
+                "secret": data.get("secret"),
+                "relay_url": default_relay_url,
+                "budget_msat": int(Millisatoshi(data["budget_msat"]))
+                if data.get("budget_msat") else None,
+                "spent_msat": int(Millisatoshi(data.get("spent_msat") or 0)),
+                "expiry_unix": data.get("expiry_unix"),
+                "created_at": int(time.time())
+            })
+
+        with self._lock, self._db:
+            self._db.executemany(
+                f"INSERT OR IGNORE INTO connections ({', '.join(CONNECTION_COLUMNS)}) "
+                f"VALUES ({', '.join('?' * len(CONNECTION_COLUMNS))})",
+                [tuple(row.get(column) for column in CONNECTION_COLUMNS)
+                 for row in rows])
+            self._db.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (DATASTORE_MIGRATED, str(int(time.time()))))
+            self._bump_generation()
+
+        return len(rows)
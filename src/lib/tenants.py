@@ -0,0 +1,182 @@
+"""
+Wallet service keys per tenant, sharing the relays, dispatcher and caches
+"""
+
+import threading
+from collections import Counter
+from coincurve import PublicKey
+from .budget import SpendRing
+from .store import DEFAULT_TENANT
+from .utils import generate_keypair, get_keypair
+
+# the keys are in the datastore under ["nwc", "key", <tenant>]
+KEY_BASE = ["nwc", "key"]
+
+MAX_NAME_LENGTH = 64
+
+
+class Tenant:
+    """one wallet service key, optionally with a budget over all its connections"""
+
+    def __init__(self, name: str, privkey: bytes, record: dict = None):
+        record = record or {}
+        self.name = name
+        self.privkey = privkey
+        self.privkey_hex = privkey.hex()
+        self.pubkey = PublicKey.from_secret(privkey).format()[1:].hex()
+        self.created_at = record.get("created_at")
+        self.budget_msat = record.get("budget_msat")
+        self.spent_msat = record.get("spent_msat") or 0
+        self.spend_ring = SpendRing.from_record(record)
+        self.in_flight = 0
+        self.counters = Counter()
+
+    def set_budget(self, budget_msat: int = None, budget_renewal: str = None,
+                   budget_window: int = None):
+        ring = SpendRing(budget_renewal, budget_window)
+        if (ring.renewal, ring.window_seconds) != \
+                (self.spend_ring.renewal, self.spend_ring.window_seconds):
+            self.spend_ring = ring
+        self.budget_msat = budget_msat or None
+
+    def window_spent(self) -> int:
+        """spent in the current budget window, lifetime spend if it never renews"""
+        if self.spend_ring.renews:
+            return self.spend_ring.spent()
+        return self.spent_msat
+
+    def remaining_budget(self) -> int:
+        """None without a budget"""
+        if not self.budget_msat:
+            return None
+        return max(0, self.budget_msat - self.window_spent())
+
+    def add_spend(self, amount_msat: int):
+        self.spent_msat += amount_msat
+        if self.spend_ring.renews:
+            self.spend_ring.add(amount_msat)
+
+    def stats(self) -> dict:
+        return {
+            "name": self.name,
+            "pubkey": self.pubkey,
+            "budget_msat": self.budget_msat,
+            "budget_renewal": self.spend_ring.renewal or "never",
+            "budget_window": self.spend_ring.window_seconds,
+            "window_spent_msat": self.window_spent(),
+            "remaining_budget_msat": self.remaining_budget(),
+            "in_flight": self.in_flight,
+            **dict(self.counters)
+        }
+
+
+class TenantRegistry:
+    """
+    All tenants' keys are loaded up front, the relay thread picks the key
+    for a request by the wallet pubkey in its p tag. Budgets and what was
+    spent against them are in the ConnectionStore, the in-memory copies
+    are kept current by add_spend() as spends are journaled.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._tenants: dict[str, Tenant] = {}
+        self._by_pubkey: dict[str, Tenant] = {}
+        # requests p tagging a pubkey that isn't ours
+        self.unknown = 0
+
+    def load(self, plugin):
+        """
+        read the keys from the datastore, creates the default key on first
+        start. Loading again adds the tenants created meanwhile and updates budgets.
+        """
+        records = {record["name"]: record for record in self.store.tenants()}
+        for entry in plugin.rpc.listdatastore(key=KEY_BASE)["datastore"]:
+            if "string" not in entry or len(entry["key"]) != len(KEY_BASE) + 1:
+                continue
+            name = entry["key"][-1]
+            if name in self._tenants:
+                # reloading, keep the counters but pick up budget changes
+                record = records.get(name)
+                if record:
+                    self._tenants[name].set_budget(
+                        record["budget_msat"], record["budget_renewal"],
+                        record["budget_window"])
+                continue
+            self._add(Tenant(name, bytes.fromhex(entry["string"]), records.get(name)))
+
+        if DEFAULT_TENANT not in self._tenants:
+            privkey, _ = get_keypair(plugin)
+            self._add(Tenant(DEFAULT_TENANT, privkey, records.get(DEFAULT_TENANT)))
+
+        # the store counts every tenant's spends, budget or not
+        for name in self._tenants:
+            if name not in records:
+                self.store.put_tenant({"name": name})
+
+    def _add(self, tenant: Tenant):
+        with self._lock:
+            self._tenants[tenant.name] = tenant
+            self._by_pubkey[tenant.pubkey] = tenant
+
+    def create(self, plugin, name: str, budget_msat: int = None,
+               budget_renewal: str = None, budget_window: int = None) -> Tenant:
+        """a new tenant with its own key, or a new budget for an existing one"""
+        if not name or len(name) > MAX_NAME_LENGTH:
+            raise ValueError(f"tenant names are 1 to {MAX_NAME_LENGTH} characters")
+        # raises on an invalid renewal/window before anything is stored
+        SpendRing(budget_renewal, budget_window)
+
+        tenant = self.get(name)
+        if tenant is None:
+            privkey, _ = generate_keypair(plugin)
+            plugin.rpc.datastore(key=KEY_BASE + [name], string=privkey.hex())
+            tenant = Tenant(name, privkey)
+            self._add(tenant)
+
+        self.store.put_tenant({
+            "name": name,
+            "budget_msat": budget_msat or None,
+            "budget_renewal": budget_renewal,
+            "budget_window": budget_window
+        })
+        tenant.set_budget(budget_msat, budget_renewal, budget_window)
+        return tenant
+
+    def get(self, name: str = None) -> Tenant:
+        """the tenant called name, None is the default tenant"""
+        return self._tenants.get(name or DEFAULT_TENANT)
+
+    @property
+    def default(self) -> Tenant:
+        return self._tenants[DEFAULT_TENANT]
+
+    def for_event(self, evt_json: dict) -> Tenant:
+        """the tenant a request is addressed to by its p tag"""
+        for tag in evt_json.get("tags", ()):
+            if len(tag) >= 2 and tag[0] == "p":
+                tenant = self._by_pubkey.get(tag[1])
+                if tenant is not None:
+                    return tenant
+        self.unknown += 1
+        return None
+
+    def all(self) -> list[Tenant]:
+        with self._lock:
+            return list(self._tenants.values())
+
+    def add_spend(self, name: str, amount_msat: int):
+        tenant = self.get(name)
+        if tenant is not None:
+            tenant.add_spend(amount_msat)
+            tenant.counters["paid_msat"] += amount_msat
+
+    def __len__(self):
+        return len(self._tenants)
+
+    def stats(self) -> dict:
+        return {
+            "tenants": len(self._tenants),
+            "unknown_pubkey": self.unknown
+        }
@@ -0,0 +1,225 @@
+"""
+Per-connection usage counters in fixed size rings of minute buckets
+"""
+
+import threading
+import time
+from array import array
+from contextvars import ContextVar
+
+METHODS = ("pay_invoice", "multi_pay_invoice", "pay_keysend", "multi_pay_keysend",
+           "make_invoice", "lookup_invoice", "list_transactions", "get_balance",
+           "get_info")
+METHOD_INDEX = {method: index for index, method in enumerate(METHODS)}
+# unknown methods and requests answered before decryption (result_type None)
+OTHER = len(METHODS)
+COLUMNS = len(METHODS) + 1
+
+# minutes of history per connection, one bucket each
+WINDOW_MINUTES = 60
+
+SORT_KEYS = ("requests", "errors", "paid_msat", "rpc_ms")
+
+
+class RequestUsage:
+    """what one request cost, filled in while it is handled, see current_request"""
+    __slots__ = ("pubkey", "method", "error", "paid_msat", "rpc_seconds")
+
+    def __init__(self, pubkey: str, method: str = None, error: bool = False,
+                 paid_msat: int = 0, rpc_seconds: float = 0.0):
+        self.pubkey = pubkey
+        self.method = method
+        self.error = error
+        self.paid_msat = paid_msat
+        self.rpc_seconds = rpc_seconds
+
+    def astuple(self) -> tuple:
+        return (self.pubkey, self.method, self.error, self.paid_msat, self.rpc_seconds)
+
+
+# the RequestUsage of the request being handled, RPC calls and spends
+# made on its behalf (in asyncio.to_thread too) are added to it
+current_request: ContextVar[RequestUsage] = ContextVar("nwc_request_usage", default=None)
+
+
+def time_rpc(rpc):
+    """add the time of every call of rpc to the current request"""
+    call = rpc.call
+
+    def timed_call(*args, **kwargs):
+        usage = current_request.get()
+        if usage is None:
+            return call(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            usage.rpc_seconds += time.perf_counter() - start
+
+    rpc.call = timed_call
+
+
+class ConnectionUsage:
+    """
+    One connection's counters. Each slot of the ring is one minute, it is
+    cleared when a later minute reuses it, so recording is O(1) and the
+    memory per connection is fixed.
+    """
+    __slots__ = ("_minutes", "_requests", "_errors", "_paid_msat", "_rpc_us",
+                 "requests", "errors", "paid_msat", "rpc_us", "last_seen")
+
+    def __init__(self):
+        # the minute (unix time // 60) each slot holds
+        self._minutes = array("q", [-1]) * WINDOW_MINUTES
+        # requests per slot and method, slot * COLUMNS + method index
+        self._requests = array("I", [0]) * (WINDOW_MINUTES * COLUMNS)
+        self._errors = array("I", [0]) * WINDOW_MINUTES
+        self._paid_msat = array("Q", [0]) * WINDOW_MINUTES
+        self._rpc_us = array("Q", [0]) * WINDOW_MINUTES
+
+        # since the plugin started
+        self.requests = 0
+        self.errors = 0
+        self.paid_msat = 0
+        self.rpc_us = 0
+        self.last_seen = None
+
+    def _slot(self, now: float) -> int:
+        minute = int(now // 60)
+        slot = minute % WINDOW_MINUTES
+        if self._minutes[slot] != minute:
+            self._minutes[slot] = minute
+            start = slot * COLUMNS
+            self._requests[start:start + COLUMNS] = array("I", [0]) * COLUMNS
+            self._errors[slot] = 0
+            self._paid_msat[slot] = 0
+            self._rpc_us[slot] = 0
+        return slot
+
+    def add_request(self, usage: RequestUsage, now: float):
+        slot = self._slot(now)
+        rpc_us = int(usage.rpc_seconds * 1e6)
+        self._requests[slot * COLUMNS + METHOD_INDEX.get(usage.method, OTHER)] += 1
+        self._rpc_us[slot] += rpc_us
+        self.requests += 1
+        self.rpc_us += rpc_us
+        if usage.error:
+            self._errors[slot] += 1
+            self.errors += 1
+        self.last_seen = int(now)
+        self.add_payment(usage.paid_msat, now)
+
+    def add_payment(self, amount_msat: int, now: float):
+        if amount_msat:
+            self._paid_msat[self._slot(now)] += amount_msat
+            self.paid_msat += amount_msat
+
+    def _live_slots(self, now: float) -> list[int]:
+        """slots holding one of the last WINDOW_MINUTES minutes, oldest first"""
+        minute = int(now // 60)
+        return sorted((slot for slot in range(WINDOW_MINUTES)
+                       if minute - WINDOW_MINUTES < self._minutes[slot] <= minute),
+                      key=lambda slot: self._minutes[slot])
+
+    def _method_counts(self, slot: int) -> dict:
+        start = slot * COLUMNS
+        return {(METHODS[index] if index < OTHER else "other"): count
+                for index, count in enumerate(self._requests[start:start + COLUMNS])
+                if count}
+
+    def window(self, now: float) -> dict:
+        """totals over the last WINDOW_MINUTES minutes"""
+        by_method = {}
+        totals = {"requests": 0, "errors": 0, "paid_msat": 0, "rpc_ms": 0.0}
+        for slot in self._live_slots(now):
+            for method, count in self._method_counts(slot).items():
+                by_method[method] = by_method.get(method, 0) + count
+                totals["requests"] += count
+            totals["errors"] += self._errors[slot]
+            totals["paid_msat"] += self._paid_msat[slot]
+            totals["rpc_ms"] += self._rpc_us[slot] / 1000
+        totals["rpc_ms"] = round(totals["rpc_ms"], 1)
+        totals["by_method"] = by_method
+        return totals
+
+    def per_minute(self, now: float) -> list[dict]:
+        return [{
+            "minute": self._minutes[slot] * 60,
+            "requests": self._method_counts(slot),
+            "errors": self._errors[slot],
+            "paid_msat": self._paid_msat[slot],
+            "rpc_ms": round(self._rpc_us[slot] / 1000, 1)
+        } for slot in self._live_slots(now)]
+
+    def summary(self, now: float) -> dict:
+        return {
+            "last_hour": self.window(now),
+            "since_start": {
+                "requests": self.requests,
+                "errors": self.errors,
+                "paid_msat": self.paid_msat,
+                "rpc_ms": round(self.rpc_us / 1000, 1)
+            },
+            "last_seen": self.last_seen
+        }
+
+
+class UsageTracker:
+    """
+    ConnectionUsage per client pubkey, created on its first request and
+    dropped when the connection is revoked or expires. Counters are in
+    memory and start over when the plugin restarts.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections: dict[str, ConnectionUsage] = {}
+
+    def add(self, usage: RequestUsage):
+        """account a handled request, see wallet.respond"""
+        now = time.time()
+        with self._lock:
+            connection = self._connections.get(usage.pubkey)
+            if connection is None:
+                connection = self._connections[usage.pubkey] = ConnectionUsage()
+            connection.add_request(usage, now)
+
+    def add_payment(self, pubkey: str, amount_msat: int):
+        """a payment made outside of a request, see NIP47RequestHandler.resume_payment"""
+        with self._lock:
+            connection = self._connections.get(pubkey)
+            if connection is None:
+                connection = self._connections[pubkey] = ConnectionUsage()
+            connection.add_payment(amount_msat, time.time())
+
+    def remove(self, pubkey: str):
+        with self._lock:
+            self._connections.pop(pubkey, None)
+
+    def summary(self, pubkey: str) -> dict:
+        """None if the connection made no request since the plugin started"""
+        with self._lock:
+            connection = self._connections.get(pubkey)
+            return connection.summary(time.time()) if connection else None
+
+    def detail(self, pubkey: str) -> dict:
+        with self._lock:
+            connection = self._connections.get(pubkey)
+            if connection is None:
+                return None
+            now = time.time()
+            return {**connection.summary(now), "per_minute": connection.per_minute(now)}
+
+    def top(self, sort: str = "requests", limit: int = 20) -> list[dict]:
+        """the connections with the most sort in the last hour"""
+        if sort not in SORT_KEYS:
+            raise ValueError(f"sort must be one of {', '.join(SORT_KEYS)}")
+        now = time.time()
+        with self._lock:
+            summaries = [{"pubkey": pubkey, **connection.summary(now)}
+                         for pubkey, connection in self._connections.items()]
+        summaries.sort(key=lambda summary: summary["last_hour"][sort], reverse=True)
+        return summaries[:limit]
+
+    def __len__(self):
+        return len(self._connections)
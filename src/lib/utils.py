@@ -16,6 +16,29 @@ def get_hex_pubkey(privkey: str):
     return x_only_hex_pubkey
 
 
+def generate_secrets(count: int) -> list[tuple[str, str]]:
+    """
+    Generate count random connection secrets with one urandom call
+
+    Returns:
+        [(secret_hex, x_only_pubkey_hex), ...]
+    """
+    entropy = os.urandom(32 * count)
+
+    secrets = []
+    for i in range(count):
+        secret = entropy[i * 32:(i + 1) * 32]
+        try:
+            pubkey = PublicKey.from_secret(secret).format()[1:]
+        except ValueError:
+            # zero or >= curve order, astronomically unlikely
+            secret = os.urandom(32)
+            pubkey = PublicKey.from_secret(secret).format()[1:]
+        secrets.append((secret.hex(), pubkey.hex()))
+
+    return secrets
+
+
 def generate_keypair(plugin: Plugin) -> tuple[bytes, bytes]:
     """
     Use the node's hsm secret to generate a keypair
@@ -47,7 +70,7 @@ def get_keypair(plugin: Plugin):
     privkey = None
     pubkey = None
 
-    if len(datastore) is not 0:
+    if datastore:
         privkey = bytes.fromhex(datastore[0]["string"])
         pubkey = PublicKey.from_secret(privkey).format()[1:]
 
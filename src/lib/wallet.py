@@ -2,22 +2,70 @@
 
 import asyncio
 import json
+import threading
+import time
 import uuid
 import websockets
-from .nip47 import NIP47Response, NIP47Request, InfoEvent
+from .nip47 import NIP47Response, NIP47Request, InfoEvent, ErrorCodes, ExpiredError
+from .admission import deadline
+from .usage import RequestUsage, current_request
+from .publisher import Publisher
+from .health import RelayHealth
+from .log import logger
 from utilities.rpc_plugin import plugin
 
+# relays cap filter sizes, split the authors over several REQs
+AUTHORS_PER_SUBSCRIPTION = 500
+
+# re-requested subscriptions look back this far, replays are dropped as
+# duplicates by the AdmissionFilter
+SUBSCRIPTION_LOOKBACK = 60
+
+# requests handled concurrently, listen() stops reading the relay beyond this
+MAX_CONCURRENT_REQUESTS = 64
+
+# seconds between pings measuring the relay round trip
+PING_INTERVAL = 30
+PING_TIMEOUT = 10
+
+# reconnect delay doubles per failed attempt up to the max
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 5 * 60
+
 
 class Wallet:
     """connect to a relay, subscribe to filters, and publish events"""
+    # see LocalWallet
+    local = False
 
-    def __init__(self, uri: str):
+    def __init__(self, uri: str, since: int = None, pool=None):
         self.uri = uri
         self.ws = None
         self.subscriptions = {}
+        self.health = RelayHealth(uri)
+        self.publisher = Publisher(uri, health=self.health)
+        # RelayPool routing the responses, None publishes to this relay only
+        self.pool = pool
         self._first_time_connected = True
         self._listen = None
         self._running = False
+        self._loop = None
+        # set while connected and subscribed to the connections' requests
+        self.subscribed = threading.Event()
+
+        # sub_id -> set of client pubkeys in that subscription's authors filter
+        self._author_chunks: dict[str, set] = {}
+        self._author_sub: dict[str, str] = {}
+        # pubkey -> True (add) / False (remove), applied on the event loop
+        self._pending_authors: dict[str, bool] = {}
+        self._pending_lock = threading.Lock()
+        self._flush_scheduled = False
+        # only ask the relay for requests newer than this
+        self._since = since or int(time.time()) - SUBSCRIPTION_LOOKBACK
+        # requests in progress, see dispatch()
+        self._requests = set()
+        self._request_slots = None
+        self._pinger = None
 
     def listen_for_nip47_requests(self):
         """start the asyncio event loop"""
@@ -25,30 +73,66 @@ class Wallet:
 
     async def run(self):
         """connect, subscribe, and listen for incoming events"""
+        self._loop = asyncio.get_running_loop()
+        self._request_slots = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
         self._listen = True
+        failures = 0
         while self._listen:
             try:
                 await self.connect()  # Connect to the relay
                 if self._first_time_connected:
-                    await self.send_info_event()  # publish kind 13194 info event
+                    # publish the kind 13194 info events, in the background:
+                    # with many tenants the publisher waits for OKs listen() reads
+                    asyncio.ensure_future(self.send_info_event())
                     self._first_time_connected = False  # Update the flag
-                # subscribe to nwc requests
-                await self.subscribe(filter={"kinds": [23194], "#p": [plugin.pubkey]})
+                # subscribe to nwc requests from active connections
+                await self.subscribe_requests()
+                self.subscribed.set()
+                failures = 0
                 await self.listen()
             except websockets.exceptions.ConnectionClosedError as e:
-                plugin.log(
-                    f"NWC relay connection closed with: {e}. Attempting to reconnect...", 'debug')
-                # Wait for 5 seconds before trying to reconnect
-                await asyncio.sleep(5)
+                logger.debug("relay", "nwc relay connection closed, reconnecting",
+                             relay=self.uri, error=str(e))
+                failures += 1
             except Exception as e:
-                plugin.log(f"An unexpected error occurred: {e}", 'error')
-                self._listen = False  # Stop the loop if an unexpected error occurs
+                logger.error("relay", "nwc relay error", relay=self.uri, error=str(e))
+                self.health.on_error()
+                failures += 1
             finally:
+                self.subscribed.clear()
                 self._running = False
+                self.health.on_disconnect()
+                if self._pinger:
+                    self._pinger.cancel()
+                self.publisher.detach()
+
+            if self._listen:
+                await asyncio.sleep(min(RECONNECT_DELAY * 2 ** max(0, failures - 1),
+                                        MAX_RECONNECT_DELAY))
 
     async def connect(self):
         self.ws = await websockets.connect(self.uri)
+        self.subscriptions = {}
         self._running = True
+        self.health.on_connect()
+        # resends responses the previous connection never got an OK for
+        self.publisher.attach(self.ws)
+        self._pinger = asyncio.ensure_future(self.ping())
+
+    async def ping(self):
+        """measure the websocket round trip for RelayHealth"""
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            start = time.monotonic()
+            try:
+                pong = await self.ws.ping()
+                await asyncio.wait_for(pong, PING_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.health.on_error()
+                continue
+            except websockets.exceptions.ConnectionClosed:
+                return
+            self.health.on_ping(time.monotonic() - start)
 
     async def disconnect(self):
         """close websocket connection"""
@@ -58,64 +142,263 @@ class Wallet:
     async def listen(self):
         """Listen for messages from the relay"""
         async for message in self.ws:
+            # we were connected up to here, a reconnect only needs newer events
+            self._since = max(self._since, int(time.time()) - SUBSCRIPTION_LOOKBACK)
             data = json.loads(message)
             if data[0] == "EVENT":
-                await self.on_event(data=data[2])
+                if plugin.capture:
+                    plugin.capture.on_event(self.uri, data[2])
+                created_at = data[2].get("created_at")
+                if isinstance(created_at, int):
+                    self.health.on_event(created_at)
+                await self.dispatch(data[2])
             elif data[0] == "OK":
-                plugin.log(f"OK received {data}", 'debug')
+                await self.publisher.on_ok(
+                    event_id=data[1], accepted=data[2],
+                    message=data[3] if len(data) > 3 else "")
             elif data[0] == "CLOSED":
-                plugin.log(f"CLOSED received {data}", 'debug')
+                logger.debug("relay", "nwc subscription closed by relay",
+                             relay=self.uri, message=data[1:])
 
-    async def subscribe(self, filter):
-        """subscribe to a filter"""
-        plugin.log(f"nwc subscription: {filter}", 'info')
+    @property
+    def since(self) -> int:
+        """subscription checkpoint, requests before this were already seen"""
+        return self._since
 
-        sub_id = str(uuid.uuid4())[:64]
+    async def subscribe(self, filter, sub_id: str = None):
+        """subscribe to a filter, or replace the filter of an existing sub_id"""
+        if logger.enabled("debug"):
+            logger.debug("relay", "nwc subscription", relay=self.uri,
+                         filter=dict(filter, authors=len(filter.get("authors", []))))
+
+        sub_id = sub_id or str(uuid.uuid4())[:64]
         await self.ws.send(json.dumps(["REQ", sub_id, filter]))
 
         self.subscriptions[sub_id] = filter
 
         return sub_id
 
-    async def send_info_event(self):
+    async def unsubscribe(self, sub_id: str):
+        """close a subscription"""
+        await self.ws.send(json.dumps(["CLOSE", sub_id]))
+        self.subscriptions.pop(sub_id, None)
+
+    def request_filter(self, authors) -> dict:
+        """filter for nwc requests to us from the given client pubkeys"""
+        # no #p: the client keys are ours, so are all their requests, and
+        # the filter stays the same size however many tenants there are
+        return {
+            "kinds": [23194],
+            "authors": sorted(authors),
+            "since": self._since
+        }
+
+    async def subscribe_requests(self):
+        """(re)build the author chunks from the active connections and REQ them all"""
+        with self._pending_lock:
+            self._pending_authors = {}
+
+        pubkeys = plugin.admission.pubkeys
+        self._author_chunks = {}
+        self._author_sub = {}
+        for i in range(0, len(pubkeys), AUTHORS_PER_SUBSCRIPTION):
+            sub_id = str(uuid.uuid4())[:64]
+            chunk = set(pubkeys[i:i + AUTHORS_PER_SUBSCRIPTION])
+            self._author_chunks[sub_id] = chunk
+            self._author_sub.update((pubkey, sub_id) for pubkey in chunk)
+            await self.subscribe(self.request_filter(chunk), sub_id=sub_id)
+
+    def on_connections_changed(self, added: list[str], removed: list[str]):
+        """
+        AdmissionFilter listener, may be called from any thread. Changes are
+        batched and applied on the event loop.
+        """
+        with self._pending_lock:
+            self._pending_authors.update((pubkey, True) for pubkey in added)
+            self._pending_authors.update((pubkey, False) for pubkey in removed)
+            if self._flush_scheduled or self._loop is None:
+                return
+            self._flush_scheduled = True
+
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(self.apply_author_changes()))
+
+    async def apply_author_changes(self):
+        """move pending authors in/out of their chunks, re-REQ only the changed chunks"""
+        with self._pending_lock:
+            pending = self._pending_authors
+            self._pending_authors = {}
+            self._flush_scheduled = False
+
+        changed = set()
+        for pubkey, active in pending.items():
+            sub_id = self._author_sub.get(pubkey)
+            if active and sub_id is None:
+                sub_id = next((sid for sid, chunk in self._author_chunks.items()
+                               if len(chunk) < AUTHORS_PER_SUBSCRIPTION),
+                              None) or str(uuid.uuid4())[:64]
+                self._author_chunks.setdefault(sub_id, set()).add(pubkey)
+                self._author_sub[pubkey] = sub_id
+                changed.add(sub_id)
+            elif not active and sub_id is not None:
+                self._author_chunks[sub_id].discard(pubkey)
+                del self._author_sub[pubkey]
+                changed.add(sub_id)
+
+        if not self._running:
+            # subscribe_requests sends everything on the next connect
+            return
+
+        for sub_id in changed:
+            chunk = self._author_chunks[sub_id]
+            if chunk:
+                # a REQ with an existing id replaces that subscription's filter
+                await self.subscribe(self.request_filter(chunk), sub_id=sub_id)
+            else:
+                del self._author_chunks[sub_id]
+                await self.unsubscribe(sub_id)
+
+    async def send_info_event(self, tenants: list = None):
+        """publish the info event of each (by default every) tenant's key"""
         supported_methods = ["pay_invoice",
                              "make_invoice", "get_info", "pay_keysend", "lookup_invoice", "get_balance", "list_transactions"]
-        nip47_info_event = InfoEvent(supported_methods)
-
-        nip47_info_event.sign(privkey=plugin.privkey.hex())
+        tenants = tenants or plugin.tenants.all()
 
         plugin.log(
-            f"sending info event. Supported methods: {supported_methods}", 'info')
+            f"sending info event for {len(tenants)} wallet keys. "
+            f"Supported methods: {supported_methods}", 'info')
 
-        await self.send_event(nip47_info_event.event_data())
+        for tenant in tenants:
+            nip47_info_event = InfoEvent(supported_methods)
+            nip47_info_event.sign(privkey=tenant.privkey_hex)
+            await self.send_event(nip47_info_event.event_data())
+
+    def announce(self, tenant):
+        """publish a new tenant's info event, may be called from any thread"""
+        if self._loop is None or self._first_time_connected:
+            # the first connect sends every tenant's
+            return
+        self._loop.call_soon_threadsafe(
+            lambda: asyncio.ensure_future(self.send_info_event([tenant])))
 
     async def send_event(self, event_data):
-        """send an event to the relay"""
-        try:
-            event = json.dumps(["EVENT", event_data])
+        """queue an event for the relay, see Publisher"""
+        await self.publisher.publish(event_data)
+
+    async def dispatch(self, data: dict):
+        """
+        handle a request event in its own task so the crypto of concurrent
+        requests can overlap (see lib.crypto), waits while too many are in progress
+        """
+        await self._request_slots.acquire()
+        task = asyncio.ensure_future(self.on_event(data=data))
+        self._requests.add(task)
+        task.add_done_callback(self._request_done)
 
-            await self.ws.send(event)
-        # TODO: make sure this is the right exception to catch
-        except websockets.exceptions.WebSocketException as e:
-            print(f"Error broadcasting {e}")
+    def _request_done(self, task: asyncio.Task):
+        self._requests.discard(task)
+        self._request_slots.release()
+        if not task.cancelled() and task.exception():
+            logger.error("request", "nwc request failed", error=str(task.exception()))
+
+    @property
+    def requests(self) -> list[asyncio.Task]:
+        """the requests in progress"""
+        return list(self._requests)
 
     async def on_event(self, data: str):
         """handle incoming NIP47 request events"""
-        request = NIP47Request.from_JSON(evt_json=data)
+        if self.pool and not self.pool.accepting:
+            # shutting down
+            return
+        # drop spam and revoked/expired connections before doing any EC work
+        if not plugin.admission.admit(data):
+            return
+
+        if plugin.shards:
+            # handled by the worker process owning the client pubkey
+            event_data = await plugin.shards.submit(data)
+        else:
+            event_data = await respond(data)
+        if event_data is None:
+            return
+
+        if self.pool:
+            # the client listens here, the pool adds the other healthy relays
+            await self.pool.publish_response(event_data, origin=self)
+        else:
+            await self.send_event(event_data)
+
+
+async def respond(data: dict) -> dict:
+    """
+    answer an admitted request event, returns the signed response event
+    data or None if the request isn't for one of our keys. Runs in the
+    shard workers too, see lib.shards
+    """
+    # the wallet key the request is for
+    tenant = plugin.tenants.for_event(data)
+    if tenant is None:
+        return None
+
+    request = NIP47Request.from_JSON(evt_json=data)
+    start = time.perf_counter()
+    # the RPC time and spends of this request, see lib.usage
+    usage = RequestUsage(request.pubkey)
+    token = current_request.set(usage)
+
+    tenant.counters["requests"] += 1
+    tenant.in_flight += 1
+    try:
+        request_deadline = deadline(data, plugin.request_max_age)
+        if request_deadline is not None and time.time() > request_deadline:
+            # waited too long to be started, the app has given up on it
+            plugin.shedder.expired += 1
+            expired = ExpiredError()
+            response_content = request.error_response(
+                result_type=None, code=expired.code, message=expired.message)
+        else:
+            # the LoadShedder's limits, per tenant too, apply once the
+            # method is known, see process_request
+            response_content = await request.process_request(tenant, request_deadline)
+    finally:
+        tenant.in_flight -= 1
+        current_request.reset(token)
+    error = response_content["error"]
+    if error:
+        tenant.counters["errors"] += 1
+    usage.method = response_content["result_type"]
+    usage.error = bool(error)
+    plugin.usage.add(usage)
+
+    logger.debug("request", "nwc request executed", connection=request.pubkey,
+                 tenant=tenant.name, method=response_content["result_type"],
+                 latency_ms=round((time.perf_counter() - start) * 1000, 1),
+                 error=error and error["code"])
 
-        response_content = await request.process_request(
-            dh_privkey_hex=plugin.privkey.hex()
-        )
+    return await sign_response(request, tenant, response_content)
 
-        plugin.log(f"nwc request exectuted: {response_content}", 'debug')
 
-        response_event = NIP47Response(
-            content=json.dumps(response_content),
-            nip04_pubkey=request._pubkey,
-            referenced_event_id=request._id,
-            privkey=plugin.privkey.hex()
-        )
+async def error_event(data: dict, message: str, code: ErrorCodes = ErrorCodes.INTERNAL) -> dict:
+    """
+    a signed error response to a request event that wasn't handled, see
+    ShardPool.submit. None if the request isn't for one of our keys
+    """
+    tenant = plugin.tenants.for_event(data)
+    if tenant is None:
+        return None
+    request = NIP47Request.from_JSON(evt_json=data)
+    return await sign_response(request, tenant, request.error_response(
+        result_type=None, code=code, message=message))
 
-        response_event.sign()
 
-        await self.send_event(response_event.event_data())
+async def sign_response(request: NIP47Request, tenant, response_content: dict) -> dict:
+    """encrypt response_content to the request's sender and sign it with tenant's key"""
+    response_event = await NIP47Response.create(
+        content=json.dumps(response_content),
+        nip04_pubkey=request.pubkey,
+        referenced_event_id=request.id,
+        privkey=tenant.privkey_hex,
+        encryption=request.response_encryption
+    )
+    return await response_event.signed_event_data()
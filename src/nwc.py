@@ -6,48 +6,342 @@ Entry point for this plugin
 
 try:
     from pyln.client import Plugin, Millisatoshi
-    from coincurve import PrivateKey, PublicKey
     import threading
+    import os
     import json
-    from lib.nip47 import URIOptions, NIP47URI
-    from lib.wallet import Wallet
-    from lib.utils import get_keypair
+    import time
+    import hashlib
     from utilities.rpc_plugin import plugin
 except ImportError as e:
     # TODO: if something isn't installed then disable the plugin
     print("BAD STUFF", f"{e}")
 
+# the lib modules pull in websockets, cryptography and coincurve, they are
+# imported where needed so lightningd doesn't wait on them during startup
+
 
 DEFAULT_RELAY = 'wss://relay.getalby.com/v1'
 
+# nwc-create-batch keygen + insert chunk size
+BATCH_SIZE = 1000
+
+# how long RPC methods called during startup wait for the connections to load
+STARTUP_WAIT = 30
+
+# starting -> loading -> connecting -> ready (or failed), see nwc-stats
+plugin.state = "starting"
+plugin.loaded = threading.Event()
+# set when load() is done, whether it succeeded (loaded) or not (load_error)
+plugin.load_finished = threading.Event()
+plugin.load_error = None
+plugin.startup_ms = {}
+# ShardPool when nwc-shards is set, see lib.shards
+plugin.shards = None
+# Recorder when nwc-capture is set, see lib.capture
+plugin.capture = None
+
 
 @plugin.init()
 def init(options, configuration, plugin: Plugin):
-    """initialize the plugin"""
+    """initialize the plugin, keys, connections and relay load in the background"""
+    plugin.data_dir = os.path.join(configuration["lightning-dir"], "nwc")
+    plugin.rpc_path = os.path.join(configuration["lightning-dir"],
+                                   configuration["rpc-file"])
+
+    loader = threading.Thread(target=load, args=(options,))
+    loader.start()
+
+
+def load(options):
+    """everything init() defers, sets plugin.loaded once the connections are usable"""
     # TODO: create a Main class that implements Keys, Wallet, Plugin
+    plugin.state = "loading"
+    start = time.perf_counter()
+
+    def phase(name):
+        nonlocal start
+        now = time.perf_counter()
+        plugin.startup_ms[name] = round((now - start) * 1000, 1)
+        start = now
+
+    try:
+        from lib.nip47 import NIP47URI, ISSUED_URI_BASE_KEY
+        from lib.store import ConnectionStore
+        from lib.admission import AdmissionFilter, LoadShedder
+        from lib.expiry import ExpiryScheduler
+        from lib.cache import ResponseCache
+        from lib.payments import PaymentRegistry
+        from lib.coalesce import SingleFlight
+        from lib import crypto
+        from lib.relays import RelayPool
+        from lib.tenants import TenantRegistry
+        from lib import shards
+        from lib.snapshot import Snapshotter
+        from lib.log import logger, parse_samples
+        from lib.journal import SpendJournal
+        from lib.capture import Recorder
+        from lib.usage import UsageTracker, time_rpc
+        phase("imports")
+
+        # before anything on the request path logs
+        logger.configure(options["nwc-log-level"],
+                         parse_samples(options["nwc-log-sample"]),
+                         options["nwc-log-rate"])
+
+        os.makedirs(plugin.data_dir, exist_ok=True)
+
+        # requests, errors, payments and RPC time per connection, see nwc-usage
+        plugin.usage = UsageTracker()
+        time_rpc(plugin.rpc)
+
+        # record the inbound events and RPC responses for replaying offline,
+        # from before the keys are read so the recording can decrypt
+        if options["nwc-capture"]:
+            plugin.capture = Recorder(
+                os.path.join(plugin.data_dir, options["nwc-capture"]))
+            plugin.capture.wrap_rpc(plugin.rpc)
+            plugin.log(f"recording nwc traffic to {plugin.capture.path}", 'info')
+        plugin.store = ConnectionStore(
+            os.path.join(plugin.data_dir, "connections.sqlite3"))
+        migrated = plugin.store.migrate_from_datastore(
+            plugin.rpc, ISSUED_URI_BASE_KEY, relay_urls(options)[0])
+        if migrated:
+            plugin.log(f"migrated {migrated} connections from the datastore",
+                       'info')
+
+        # spends are journaled and compacted into the store in the background,
+        # apply what the last run didn't get to
+        plugin.journal = SpendJournal(
+            os.path.join(plugin.data_dir, "spends.journal"), plugin.store)
+        replayed = plugin.journal.replay() + \
+            shards.replay_journals(plugin.data_dir, plugin.store)
+        if replayed:
+            plugin.log(f"replayed {replayed} journaled nwc spends", 'info')
+        plugin.journal.start()
+
+        # a wallet service key per tenant, the default one is the key
+        # connections from before tenants use
+        plugin.tenants = TenantRegistry(plugin.store)
+        plugin.tenants.load(plugin)
+        plugin.privkey = plugin.tenants.default.privkey
+        plugin.pubkey = plugin.tenants.default.pubkey
+        phase("keys")
+
+        plugin.snapshots = Snapshotter(
+            os.path.join(plugin.data_dir, "state.json"), collect_state)
+        state = plugin.snapshots.load()
+
+        # only events from known connections get past this, see Wallet.on_event
+        plugin.admission = AdmissionFilter()
+        if state and state.get("generation") == plugin.store.generation():
+            # no connection was added or removed since the snapshot
+            plugin.admission.load_entries(state["connections"])
+        else:
+            plugin.admission.load(NIP47URI.find_all(status="active"))
+        if isinstance(state.get("seen"), str):
+            plugin.admission.restore_seen(state["seen"])
+        phase("connections")
 
-    privkey, pubkey = get_keypair(plugin)
-    plugin.privkey = privkey
-    plugin.pubkey = pubkey.hex()
+        # get_info/lookup_invoice results, see the notification handlers below
+        plugin.responses = ResponseCache()
+        # pay_invoice single-flight, see NIP47RequestHandler._pay_invoice
+        plugin.payments = PaymentRegistry()
+        # merge identical lookup_invoice/list_transactions calls in flight
+        plugin.coalescer = SingleFlight()
 
-    # create a Wallet instance to listent for incoming nip47 requests
-    url = DEFAULT_RELAY
-    wallet = Wallet(url)
+        plugin.purge_expired = options["nwc-purge-expired"]
 
-    # start a new thread for the relay
-    wallet_thread = threading.Thread(target=wallet.listen_for_nip47_requests)
-    wallet_thread.start()
+        # admitted requests past their deadline get an error instead of
+        # being executed, reads are shed first under load
+        plugin.request_max_age = options["nwc-request-max-age"]
+        plugin.shedder = LoadShedder()
 
-    plugin.log(f"connected to {url}", 'info')
+        # decrypt/encrypt/sign in worker processes, 0 keeps them on the relay thread
+        crypto_workers = crypto.parse_workers(options["nwc-crypto-workers"])
+        crypto.configure(crypto_workers)
+        if crypto_workers:
+            plugin.log(f"using {crypto_workers} nwc crypto workers", 'info')
+
+        # requests are handled in worker processes owning a share of the
+        # client pubkeys, the relay thread only admits and publishes
+        shard_count = options["nwc-shards"]
+        if shard_count and any(tenant.budget_msat for tenant in plugin.tenants.all()):
+            # a tenant's connections are spread over the workers, each of
+            # them would only count its own spends against the budget
+            plugin.log("nwc-shards ignored: tenant budgets need all spends "
+                       "in one process", 'error')
+            shard_count = 0
+        if shard_count:
+            # each worker restores and resumes the payments of its client pubkeys
+            plugin.shards = shards.ShardPool(shard_count, {
+                "data_dir": plugin.data_dir,
+                "rpc_path": plugin.rpc_path,
+                "request_max_age": plugin.request_max_age,
+                "log": logger.config(),
+                "capture": plugin.capture.path if plugin.capture else None
+            }, payments=state.get("payments"))
+            plugin.log(f"handling nwc requests in {shard_count} shard workers", 'info')
+        else:
+            plugin.payments.restore(state.get("payments", {}))
+
+        plugin.expiry = ExpiryScheduler(on_expire=on_connection_expired)
+        plugin.expiry.load(plugin.admission.entries())
+        plugin.expiry.start()
+
+        # a Wallet per relay to listen for incoming nip47 requests
+        urls = relay_urls(options)
+        # pick the subscription up where the last run stopped, requests
+        # older than the admission max age would be dropped anyway
+        since = state.get("since")
+        if since:
+            since = max(since, int(time.time()) - plugin.admission.max_age)
+        relays = RelayPool(urls, since=since, local=local_relay(options))
+        plugin.relays = relays
+        if plugin.shards:
+            # after the relays, workers publish the responses of resumed payments
+            plugin.shards.start()
+        # keep the relay subscriptions' authors in sync with the active connections
+        plugin.admission.add_listener(relays.on_connections_changed)
+        phase("services")
+    except Exception as e:
+        plugin.state = "failed"
+        plugin.load_error = str(e)
+        plugin.log(f"nwc startup failed: {e}", 'error')
+        plugin.load_finished.set()
+        return
+
+    plugin.state = "connecting"
+    plugin.loaded.set()
+    plugin.load_finished.set()
+    plugin.snapshots.start()
+
+    # start a new thread for the relays
+    relay_thread = threading.Thread(target=relays.listen_for_nip47_requests)
+    relay_thread.start()
+
+    plugin.log(f"connecting to {', '.join(urls)}", 'info')
+
+
+def relay_urls(options) -> list[str]:
+    """the nwc-relay option(s), DEFAULT_RELAY if none is set"""
+    urls = options.get("nwc-relay") or [DEFAULT_RELAY]
+    if isinstance(urls, str):
+        urls = [urls]
+    return urls
+
+
+def local_relay(options):
+    """the embedded relay if nwc-local-relay is set, see lib.local_relay"""
+    listen = options.get("nwc-local-relay")
+    if not listen:
+        return None
+    from lib.local_relay import LocalRelay
+
+    host, _, port = listen.rpartition(":")
+    return LocalRelay(host or "127.0.0.1", int(port),
+                      url=options.get("nwc-local-relay-url") or None)
+
+
+def connection_relay(relay: str = None) -> str:
+    """relay url for new connections, relay="local" picks the embedded relay"""
+    if relay is None:
+        return plugin.relays.best_url()
+    if relay == "local":
+        if not plugin.relays.local:
+            raise ValueError("the local relay is not enabled, see nwc-local-relay")
+        return plugin.relays.local.url
+    if relay not in (wallet.uri for wallet in plugin.relays.wallets):
+        raise ValueError(f"not one of the plugin's relays: {relay}")
+    return relay
+
+
+def create_output_file(name: str):
+    """a new file readable by the owner only, name is relative to the plugin's data dir"""
+    data_dir = os.path.realpath(plugin.data_dir)
+    path = os.path.realpath(os.path.join(data_dir, name))
+    if os.path.dirname(path) != data_dir:
+        raise ValueError(f"output_file must be a file name in {data_dir}")
+    if os.path.exists(path):
+        raise ValueError(f"{path} already exists")
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    return os.fdopen(fd, "w")
+
+
+def collect_state() -> dict:
+    """what Snapshotter writes to state.json, reloaded by load()"""
+    return {
+        "generation": plugin.store.generation(),
+        "connections": plugin.admission.entries(),
+        "seen": plugin.admission.dump_seen(),
+        "since": plugin.relays.since,
+        "payments": plugin.shards.payments_snapshot() if plugin.shards
+        else plugin.payments.snapshot()
+    }
+
+
+def loaded() -> bool:
+    """wait for load() if the plugin is still starting, False right away if it failed"""
+    plugin.load_finished.wait(STARTUP_WAIT)
+    return plugin.loaded.is_set()
+
+
+def not_loaded_error():
+    if plugin.load_error:
+        return {
+            "error": f"nwc plugin failed to start: {plugin.load_error}"
+        }
+    return {
+        "error": f"nwc plugin is not ready ({plugin.state})"
+    }
+
+
+def on_connection_expired(pubkey: str):
+    """called by the ExpiryScheduler thread when a connection expires"""
+    from lib import nip44
+    try:
+        plugin.admission.remove(pubkey)
+        nip44.conversation_keys.evict(pubkey)
+        plugin.usage.remove(pubkey)
+        if plugin.shards:
+            plugin.shards.broadcast("evict", pubkey)
+        if plugin.purge_expired:
+            plugin.store.delete(pubkey)
+        plugin.log(f"nwc connection expired: {pubkey}", 'info')
+    except Exception as e:
+        plugin.log(f"error expiring nwc connection {pubkey}: {e}", 'error')
 
 
 # https://github.com/nostr-protocol/nips/blob/master/47.md#example-connection-string
 @plugin.method("nwc-create")
 def create_nwc_uri(plugin: Plugin, expiry_unix: int = None,
-                   budget_msat: int = None):
-    """Create a new nostr wallet connection"""
-    wallet_pubkey = plugin.pubkey
-    relay_url = DEFAULT_RELAY
+                   budget_msat: int = None, budget_renewal: str = None,
+                   budget_window: int = None, relay: str = None,
+                   tenant: str = None):
+    """
+    Create a new nostr wallet connection
+
+    budget_renewal: daily, weekly, monthly, yearly or never (default)
+    budget_window: or renew the budget over a rolling window of this many seconds
+    relay: "local" for the embedded relay or one of the nwc-relay urls,
+    the healthiest relay by default
+    tenant: wallet service key to connect to, see nwc-tenant-create
+    """
+    if not loaded():
+        return not_loaded_error()
+    from coincurve import PrivateKey
+    from lib.nip47 import URIOptions, NIP47URI
+
+    wallet = plugin.tenants.get(tenant)
+    if wallet is None:
+        return {
+            "error": f"unknown tenant {tenant}"
+        }
+    try:
+        relay_url = connection_relay(relay)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }
 
     # 32-byte hex encoded secret to sign/encrypt
     sk = PrivateKey()
@@ -56,20 +350,24 @@ def create_nwc_uri(plugin: Plugin, expiry_unix: int = None,
     options = URIOptions(
         relay_url=relay_url,
         secret=secret,
-        wallet_pubkey=wallet_pubkey,
+        wallet_pubkey=wallet.pubkey,
         expiry_unix=expiry_unix or None,
-        budget_msat=Millisatoshi(budget_msat) if budget_msat else None
+        budget_msat=Millisatoshi(budget_msat) if budget_msat else None,
+        budget_renewal=budget_renewal,
+        budget_window=budget_window,
+        tenant=wallet.name
     )
 
-    nwc = NIP47URI(options=options)
+    try:
+        nwc = NIP47URI(options=options)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }
 
-    data_string = json.dumps({
-        "secret": nwc.secret,
-        "budget_msat": nwc.budget_msat,
-        "expiry_unix": nwc.expiry_unix,
-        "spent_msat": Millisatoshi(0)
-    })
-    plugin.rpc.datastore(key=nwc.datastore_key, string=data_string)
+    nwc.save()
+    plugin.admission.add(nwc.pubkey, nwc.expiry_unix)
+    plugin.expiry.schedule(nwc.pubkey, nwc.expiry_unix)
 
     return {
         "url": nwc.url,
@@ -77,38 +375,186 @@ def create_nwc_uri(plugin: Plugin, expiry_unix: int = None,
     }
 
 
+@plugin.method("nwc-create-batch")
+def create_nwc_uri_batch(plugin: Plugin, count: int = None, specs: list = None,
+                         expiry_unix: int = None, budget_msat: int = None,
+                         budget_renewal: str = None, budget_window: int = None,
+                         output_file: str = None, relay: str = None,
+                         tenant: str = None):
+    """
+    Create many nostr wallet connections at once.
+
+    Either count connections sharing expiry_unix, budget_msat and
+    budget_renewal, or one connection per entry of specs:
+    [{"budget_msat": ..., "expiry_unix": ..., "budget_renewal": ..., "budget_window": ...}].
+    With output_file the urls are written to that new file in the plugin's
+    data dir (one json object per line) instead of being returned. relay
+    and tenant as for nwc-create.
+    """
+    if not loaded():
+        return not_loaded_error()
+    from lib.nip47 import URIOptions, NIP47URI
+    from lib.budget import SpendRing
+    from lib.utils import generate_secrets
+
+    if (count is None) == (specs is None):
+        return {
+            "error": "specify one of count or specs"
+        }
+    if specs is None:
+        specs = [{
+            "expiry_unix": expiry_unix,
+            "budget_msat": budget_msat,
+            "budget_renewal": budget_renewal,
+            "budget_window": budget_window
+        }] * int(count)
+
+    for spec in specs:
+        try:
+            SpendRing(spec.get("budget_renewal"), spec.get("budget_window"))
+        except ValueError as e:
+            return {
+                "error": str(e)
+            }
+
+    wallet = plugin.tenants.get(tenant)
+    if wallet is None:
+        return {
+            "error": f"unknown tenant {tenant}"
+        }
+    try:
+        relay_url = connection_relay(relay)
+        # the urls hold the connection secrets, never overwrite another file
+        out = create_output_file(output_file) if output_file else None
+    except (ValueError, OSError) as e:
+        return {
+            "error": str(e)
+        }
+
+    start = time.perf_counter()
+
+    connections = []
+    try:
+        for offset in range(0, len(specs), BATCH_SIZE):
+            chunk = specs[offset:offset + BATCH_SIZE]
+
+            batch = []
+            for spec, (secret, pubkey) in zip(chunk, generate_secrets(len(chunk))):
+                batch.append(NIP47URI(options=URIOptions(
+                    relay_url=relay_url,
+                    secret=secret,
+                    pubkey=pubkey,
+                    wallet_pubkey=wallet.pubkey,
+                    tenant=wallet.name,
+                    expiry_unix=spec.get("expiry_unix") or None,
+                    budget_msat=Millisatoshi(spec["budget_msat"])
+                    if spec.get("budget_msat") else None,
+                    budget_renewal=spec.get("budget_renewal"),
+                    budget_window=spec.get("budget_window")
+                )))
+
+            NIP47URI.save_many(batch)
+
+            for nwc in batch:
+                plugin.admission.add(nwc.pubkey, nwc.expiry_unix)
+                plugin.expiry.schedule(nwc.pubkey, nwc.expiry_unix)
+
+            # only hand out urls once they are persisted
+            results = [{"url": nwc.url, "pubkey": nwc.pubkey} for nwc in batch]
+            if out:
+                out.writelines(json.dumps(result) + "\n" for result in results)
+                out.flush()
+            else:
+                connections.extend(results)
+    finally:
+        if out:
+            out.close()
+
+    elapsed = time.perf_counter() - start
+
+    rtn = {
+        "created": len(specs),
+        "elapsed_seconds": round(elapsed, 3),
+        "connections_per_second": round(len(specs) / elapsed, 1) if elapsed else None
+    }
+    if output_file:
+        rtn["output_file"] = os.path.join(plugin.data_dir, output_file)
+    else:
+        rtn["connections"] = connections
+    return rtn
+
+
 @plugin.method("nwc-list")
-def list_nwc_uris(plugin: Plugin):
-    """List all nostr wallet connections"""
+def list_nwc_uris(plugin: Plugin, status: str = None, limit: int = None,
+                  cursor: str = None, min_budget_used_pct: float = None,
+                  created_since: int = None, sort: str = "created_at",
+                  summary: bool = False, tenant: str = None):
+    """
+    List nostr wallet connections.
 
-    all_connections = NIP47URI.find_all()
+    status: "active" or "expired"
+    limit/cursor: page size, pass the returned next_cursor to get the next page
+    min_budget_used_pct: only connections that spent at least this % of their budget
+    created_since: only connections created at or after this unix time
+    sort: created_at, expiry_unix, spent_msat or remaining_budget_msat, prefix with - to reverse
+    summary: leave out the secret bearing urls
+    tenant: only connections of this tenant
+    """
+    if not loaded():
+        return not_loaded_error()
+    from lib.nip47 import NIP47URI
+
+    try:
+        connections, next_cursor = NIP47URI.find_page(
+            status=status,
+            limit=limit,
+            cursor=cursor,
+            min_budget_used_pct=min_budget_used_pct,
+            created_since=created_since,
+            sort=sort,
+            tenant=tenant
+        )
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }
 
     rtn = []
-    for nwc in all_connections:
+    for nwc in connections:
         remaining_budget_msat = None
 
         if nwc.budget_msat:
-            try:
-                remaining_budget_msat = nwc.budget_msat - nwc.spent_msat
-            except:
-                remaining_budget_msat = Millisatoshi(0)
+            remaining_budget_msat = nwc.remaining_budget
 
         data = {
-            "url": nwc.url,
             "pubkey": nwc.pubkey,
+            "tenant": nwc.tenant,
+            "created_at": nwc.created_at,
             "expiry_unix": nwc.expiry_unix,
-            "remaining_budget_msat": remaining_budget_msat
+            "budget_renewal": nwc.budget_renewal,
+            "budget_window": nwc.budget_window,
+            "window_spent_msat": nwc.window_spent_msat,
+            "remaining_budget_msat": remaining_budget_msat,
+            "usage": plugin.usage.summary(nwc.pubkey)
         }
+        if not summary:
+            data["url"] = nwc.url
         rtn.append(data)
 
     return {
-        "connections": rtn
+        "connections": rtn,
+        "next_cursor": next_cursor
     }
 
 
 @plugin.method("nwc-revoke")
 def revoke_nwc_uri(plugin: Plugin, pubkey: str):
     """Revoke a nostr wallet connection"""
+    if not loaded():
+        return not_loaded_error()
+    from lib import nip44
+    from lib.nip47 import NIP47URI
+
     nwc = NIP47URI.find_unique(pubkey=pubkey)
 
     if not nwc:
@@ -117,7 +563,274 @@ def revoke_nwc_uri(plugin: Plugin, pubkey: str):
         }
 
     nwc.delete()
+    plugin.admission.remove(pubkey)
+    plugin.expiry.cancel(pubkey)
+    nip44.conversation_keys.evict(pubkey)
+    plugin.usage.remove(pubkey)
+    if plugin.shards:
+        plugin.shards.broadcast("evict", pubkey)
     return True
 
 
-plugin.run()
+@plugin.method("nwc-stats")
+def nwc_stats(plugin: Plugin):
+    """Show counters for incoming nostr wallet connect requests"""
+    state = plugin.state
+    if state == "connecting" and plugin.relays.ready:
+        state = "ready"
+    startup = {
+        "state": state,
+        "startup_ms": plugin.startup_ms
+    }
+    if plugin.load_error:
+        startup["error"] = plugin.load_error
+    if not plugin.loaded.is_set():
+        return startup
+
+    from lib import nip44, crypto
+    from lib.log import logger
+    return {
+        **startup,
+        "admission": plugin.admission.stats(),
+        "load_shedding": plugin.shedder.stats(),
+        "logging": logger.stats(),
+        "capture": plugin.capture.stats() if plugin.capture else None,
+        "tenants": plugin.tenants.stats(),
+        "conversation_keys": nip44.conversation_keys.stats(),
+        "publisher": plugin.relays.publisher_stats(),
+        "crypto": crypto.stats(),
+        "shards": plugin.shards.stats() if plugin.shards else None,
+        "response_cache": plugin.responses.stats(),
+        "payments": plugin.payments.stats(),
+        "snapshot": plugin.snapshots.stats(),
+        "spend_journal": plugin.journal.stats(),
+        "coalesced": plugin.coalescer.stats(),
+        "expiry": {
+            "scheduled": len(plugin.expiry),
+            "next_deadline": plugin.expiry.next_deadline
+        }
+    }
+
+
+@plugin.method("nwc-relays")
+def nwc_relays(plugin: Plugin):
+    """
+    Show relay health, best first: ping/OK round trips, delivery lag,
+    error rate and disconnects folded into a score (lower is better)
+    """
+    if not loaded():
+        return not_loaded_error()
+    rtn = {
+        "relays": plugin.relays.stats()
+    }
+    if plugin.relays.local:
+        rtn["local_relay"] = plugin.relays.local.stats()
+    return rtn
+
+
+@plugin.method("nwc-tenant-create")
+def create_tenant(plugin: Plugin, name: str, budget_msat: int = None,
+                  budget_renewal: str = None, budget_window: int = None):
+    """
+    Create a wallet service key for a tenant, or change a tenant's budget
+
+    budget_msat: limit for all of the tenant's connections together
+    budget_renewal/budget_window: as for nwc-create
+    """
+    if not loaded():
+        return not_loaded_error()
+
+    if budget_msat and plugin.shards:
+        return {
+            "error": "tenant budgets can't be enforced with nwc-shards"
+        }
+
+    existing = plugin.tenants.get(name)
+    try:
+        tenant = plugin.tenants.create(
+            plugin, name, budget_msat=budget_msat,
+            budget_renewal=budget_renewal, budget_window=budget_window)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }
+    if existing is None:
+        plugin.relays.announce(tenant)
+    if plugin.shards:
+        # new keys and budgets
+        plugin.shards.broadcast("tenants")
+    return tenant.stats()
+
+
+@plugin.method("nwc-tenants")
+def list_tenants(plugin: Plugin):
+    """Show every tenant's wallet pubkey, budget, connections and request counters"""
+    if not loaded():
+        return not_loaded_error()
+
+    connections = plugin.store.tenant_connections()
+    return {
+        "tenants": [{
+            **tenant.stats(),
+            "connections": connections.get(tenant.name, 0)
+        } for tenant in plugin.tenants.all()]
+    }
+
+
+@plugin.method("nwc-usage")
+def nwc_usage(plugin: Plugin, pubkey: str = None, sort: str = "requests",
+              limit: int = 20):
+    """
+    Show per-connection usage: requests by method, errors, msat paid and
+    RPC time in the last hour and since the plugin started.
+
+    pubkey: one connection, with its per-minute history
+    sort/limit: otherwise the top connections by requests, errors,
+    paid_msat or rpc_ms in the last hour
+    """
+    if not loaded():
+        return not_loaded_error()
+
+    if pubkey:
+        usage = plugin.usage.detail(pubkey)
+        if usage is None:
+            return {
+                "error": f"No requests from {pubkey} since the plugin started"
+            }
+        return {"pubkey": pubkey, **usage}
+
+    try:
+        top = plugin.usage.top(sort=sort, limit=limit)
+    except ValueError as e:
+        return {
+            "error": str(e)
+        }
+    return {
+        "connections": top,
+        "tracked": len(plugin.usage)
+    }
+
+
+@plugin.subscribe("block_added")
+def on_block_added(plugin: Plugin, **kwargs):
+    # nothing is cached before the plugin has loaded
+    if not plugin.loaded.is_set():
+        return
+    plugin.responses.on_block()
+    if plugin.shards:
+        plugin.shards.broadcast("block")
+
+
+def on_payment(payment_hash: str):
+    """drop cached lookups of a payment hash, in the shard workers too"""
+    plugin.responses.on_payment(payment_hash)
+    if plugin.shards:
+        plugin.shards.broadcast("payment", payment_hash)
+
+
+@plugin.subscribe("invoice_payment")
+def on_invoice_payment(plugin: Plugin, payment: dict = None, **kwargs):
+    preimage = (payment or {}).get("preimage")
+    if preimage and plugin.loaded.is_set():
+        on_payment(hashlib.sha256(bytes.fromhex(preimage)).hexdigest())
+
+
+@plugin.subscribe("sendpay_success")
+def on_sendpay_success(plugin: Plugin, sendpay_success: dict = None, **kwargs):
+    if sendpay_success and plugin.loaded.is_set():
+        on_payment(sendpay_success.get("payment_hash"))
+
+
+@plugin.subscribe("sendpay_failure")
+def on_sendpay_failure(plugin: Plugin, sendpay_failure: dict = None, **kwargs):
+    data = (sendpay_failure or {}).get("data") or {}
+    if data.get("payment_hash") and plugin.loaded.is_set():
+        on_payment(data["payment_hash"])
+
+
+@plugin.subscribe("shutdown")
+def on_shutdown(plugin: Plugin, **kwargs):
+    if plugin.loaded.is_set():
+        try:
+            # payments still in flight after the wait are snapshotted as
+            # pending, resume_payment settles them on the next start
+            plugin.relays.stop_requests()
+            if plugin.shards:
+                plugin.shards.sync_payments()
+            plugin.snapshots.save()
+            plugin.journal.compact()
+            if plugin.shards:
+                plugin.shards.stop()
+            if plugin.capture:
+                plugin.capture.close()
+        except Exception as e:
+            plugin.log(f"nwc state snapshot failed: {e}", 'error')
+    # the relay and expiry threads would keep the process alive
+    os._exit(0)
+
+
+plugin.add_option(
+    "nwc-relay", None,
+    "Relay to listen on and publish responses to, can be given several times",
+    opt_type="string", multi=True)
+
+plugin.add_option(
+    "nwc-local-relay", None,
+    "Serve an embedded relay for local apps on [host:]port, "
+    "see nwc-create relay=local",
+    opt_type="string")
+
+plugin.add_option(
+    "nwc-local-relay-url", None,
+    "Url of the local relay handed out to apps, ws://host:port by default",
+    opt_type="string")
+
+plugin.add_option(
+    "nwc-purge-expired", False,
+    "Delete connections from the store as soon as they expire",
+    opt_type="bool")
+
+plugin.add_option(
+    "nwc-log-level", "info",
+    "Lowest level of the plugin's request, relay and payment log lines "
+    "sent to lightningd: debug, info, warn or error",
+    opt_type="string")
+
+plugin.add_option(
+    "nwc-log-sample", None,
+    "Log one in N lines of a category (request, relay, payment, budget, rpc) "
+    "as category=N, can be given several times",
+    opt_type="string", multi=True)
+
+plugin.add_option(
+    "nwc-log-rate", 20,
+    "Log lines per second per category, the rest are counted, 0 for no cap",
+    opt_type="int")
+
+plugin.add_option(
+    "nwc-capture", None,
+    "Record inbound events and RPC responses to this file (in the nwc "
+    "data dir if relative) for contrib/benchmark.py replay",
+    opt_type="string")
+
+plugin.add_option(
+    "nwc-request-max-age", 60,
+    "Seconds after its created_at a request is answered with an error "
+    "instead of executed, 0 only honors NIP-40 expiration tags",
+    opt_type="int")
+
+plugin.add_option(
+    "nwc-shards", 0,
+    "Worker processes handling requests, sharded by client pubkey, "
+    "0 handles them on the relay thread",
+    opt_type="int")
+
+plugin.add_option(
+    "nwc-crypto-workers", "0",
+    "Processes for request decryption and response encryption/signing, "
+    "0 (inline) or auto for one per core",
+    opt_type="string")
+
+# the crypto workers import this module again, only the plugin process runs
+if __name__ == "__main__":
+    plugin.run()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the plugin imports its modules relative to src, as lightningd runs it from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
@@ -0,0 +1,107 @@
+import base64
+from lib.admission import AdmissionFilter, LoadShedder, RejectReason, deadline
+
+
+def shedder():
+    return LoadShedder(max_in_flight=4, max_reads_in_flight=2,
+                       tenant_max_in_flight=2, tenant_max_reads_in_flight=1)
+
+
+def test_reads_shed_first():
+    s = shedder()
+    assert s.acquire("get_balance")
+    assert s.acquire("get_info")
+    assert not s.acquire("lookup_invoice")
+    # payments keep the remaining slots
+    assert s.acquire("pay_invoice")
+    assert s.acquire("pay_invoice")
+    assert not s.acquire("pay_invoice")
+    assert s.stats()["shed"] == {"lookup_invoice": 1, "pay_invoice": 1}
+
+    s.release()
+    assert s.acquire("pay_invoice")
+    assert s.in_flight == 4
+
+
+def test_tenant_alone_uses_all_slots():
+    s = shedder()
+    for _ in range(4):
+        assert s.acquire("pay_invoice", "a")
+    assert not s.acquire("pay_invoice", "a")
+    assert s.shed_tenant == {}
+
+
+def test_tenant_held_to_its_share():
+    s = shedder()
+    assert s.acquire("pay_invoice", "a")
+    assert s.acquire("pay_invoice", "a")
+    assert s.acquire("pay_invoice", "b")
+    # a has its share while b is busy
+    assert not s.acquire("pay_invoice", "a")
+    assert s.acquire("pay_invoice", "b")
+    assert s.stats()["shed_tenant"] == {"a": 1}
+
+    s.release("b")
+    s.release("b")
+    assert s.acquire("pay_invoice", "a")
+    assert s.tenants == {"a": 3}
+
+
+def test_tenant_read_share():
+    s = LoadShedder(max_in_flight=8, max_reads_in_flight=4,
+                    tenant_max_in_flight=4, tenant_max_reads_in_flight=1)
+    assert s.acquire("get_balance", "b")
+    assert s.acquire("get_balance", "a")
+    assert not s.acquire("get_balance", "a")
+    # its payments have a share of their own
+    assert s.acquire("pay_invoice", "a")
+    assert s.shed_tenant == {"a": 1}
+
+
+def test_release_forgets_idle_tenants():
+    s = shedder()
+    s.acquire("get_info", "a")
+    s.release("a")
+    assert s.in_flight == 0
+    assert "a" not in s.tenants
+
+
+def test_deadline():
+    assert deadline({"created_at": 1000}, 60) == 1060
+    assert deadline({"created_at": 1000, "tags": [["expiration", "1030"]]}, 60) == 1030
+    assert deadline({"created_at": 1000, "tags": [["expiration", "2000"]]}, 60) == 1060
+    assert deadline({"created_at": 1000, "tags": [["expiration", "2000"]]}, 0) == 2000
+    assert deadline({"created_at": 1000, "tags": [["expiration", "x"]]}, 60) == 1060
+    assert deadline({"created_at": 1000}, 0) is None
+
+
+def request_event(n: int, created_at: int) -> dict:
+    return {"id": f"{n:064x}", "kind": 23194, "content": "", "pubkey": "ab" * 32,
+            "created_at": created_at, "tags": []}
+
+
+def test_seen_ids_survive_a_restart():
+    now = 1700000000
+    admission = AdmissionFilter()
+    admission.add("ab" * 32)
+    assert admission.admit(request_event(1, now - 10), now)
+    assert admission.admit(request_event(2, now - 100), now)
+    dumped = admission.dump_seen(now)
+    assert len(dumped) == 2 * 48
+
+    restarted = AdmissionFilter()
+    restarted.add("ab" * 32)
+    restarted.restore_seen(dumped)
+    assert restarted.check(request_event(1, now - 10), now) == RejectReason.DUPLICATE
+    assert restarted.check(request_event(3, now - 10), now) is None
+
+
+def test_stale_seen_ids_are_not_dumped():
+    now = 1700000000
+    admission = AdmissionFilter(max_age=60)
+    admission.add("ab" * 32)
+    assert admission.admit(request_event(1, now - 30), now)
+    assert admission.admit(request_event(2, now - 50), now)
+    # rejected as stale from here on anyway
+    assert base64.b64decode(admission.dump_seen(now + 20)) == \
+        bytes.fromhex(f"{1:064x}") + (now - 30).to_bytes(4, "big")
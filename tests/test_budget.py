@@ -0,0 +1,131 @@
+import pytest
+from datetime import datetime, timezone
+from lib.budget import DAY, SpendRing, period_start
+
+
+def ts(*args) -> int:
+    return int(datetime(*args, tzinfo=timezone.utc).timestamp())
+
+
+# a Monday
+NOW = ts(2024, 1, 15, 12)
+
+
+@pytest.mark.parametrize("renewal, start", [
+    ("daily", ts(2024, 1, 15)),
+    ("weekly", ts(2024, 1, 15)),
+    ("monthly", ts(2024, 1, 1)),
+    ("yearly", ts(2024, 1, 1)),
+])
+def test_period_start(renewal, start):
+    assert period_start(renewal, NOW) == start
+    assert period_start(renewal, start) == start
+
+
+@pytest.mark.parametrize("renewal, renews_at", [
+    ("daily", ts(2024, 1, 16)),
+    ("weekly", ts(2024, 1, 22)),
+    ("monthly", ts(2024, 2, 1)),
+    ("yearly", ts(2025, 1, 1)),
+])
+def test_next_renewal(renewal, renews_at):
+    assert SpendRing(renewal).next_renewal(NOW) == renews_at
+
+
+def test_next_renewal_december():
+    assert SpendRing("monthly").next_renewal(ts(2024, 12, 31, 23)) == ts(2025, 1, 1)
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        SpendRing("hourly")
+    with pytest.raises(ValueError):
+        SpendRing("daily", 3600)
+    with pytest.raises(ValueError):
+        SpendRing(window_seconds=-1)
+
+
+def test_never_renews():
+    ring = SpendRing("never")
+    assert not ring.renews
+    assert ring.next_renewal(NOW) is None
+
+
+def test_daily_renews():
+    ring = SpendRing("daily")
+    ring.add(1000, ts(2024, 1, 15, 1))
+    ring.add(2000, NOW)
+    assert ring.spent(NOW) == 3000
+    assert ring.spent(ts(2024, 1, 15, 23, 59)) == 3000
+    assert ring.spent(ts(2024, 1, 16)) == 0
+
+    ring.add(500, ts(2024, 1, 16, 1))
+    assert ring.spent(ts(2024, 1, 16, 2)) == 500
+
+
+@pytest.mark.parametrize("renewal, last_day", [
+    ("weekly", ts(2024, 1, 21, 23)),
+    ("monthly", ts(2024, 1, 31, 23)),
+    ("yearly", ts(2024, 12, 31, 23)),
+])
+def test_calendar_periods(renewal, last_day):
+    ring = SpendRing(renewal)
+    ring.add(1000, NOW)
+    ring.add(1000, last_day)
+    assert ring.spent(last_day) == 2000
+    assert ring.spent(ring.next_renewal(NOW)) == 0
+
+
+def test_buckets_reused_next_period():
+    """a slot that held last period's spend is reset, not added to"""
+    ring = SpendRing("daily")
+    ring.add(1000, NOW)
+    # 32 hourly slots, the same slot comes round after 32 hours
+    later = NOW + 32 * 60 * 60
+    ring.add(10, later)
+    assert ring.spent(later) == 10
+
+
+def test_rolling_window():
+    ring = SpendRing(window_seconds=3600)
+    ring.add(1000, NOW)
+    ring.add(2000, NOW + 1800)
+    assert ring.spent(NOW + 1800) == 3000
+    # the first spend's bucket may be counted up to a bucket width longer
+    assert ring.spent(NOW + 3600 + 200) == 2000
+    assert ring.spent(NOW + 1800 + 3600 + 200) == 0
+
+
+def test_old_spend_ignored():
+    ring = SpendRing(window_seconds=3600)
+    ring.add(1000, NOW)
+    # same slot, a ring ago
+    ring.add(5000, NOW - 32 * 120)
+    assert ring.spent(NOW) == 1000
+
+
+def test_many_spends_bounded():
+    ring = SpendRing("monthly")
+    for minute in range(0, 30 * 24 * 60, 7):
+        ring.add(1, ts(2024, 1, 1) + minute * 60)
+    assert ring.spent(ts(2024, 1, 31)) == len(range(0, 30 * 24 * 60, 7))
+    assert len(ring._buckets) == 32
+
+
+def test_roundtrip():
+    ring = SpendRing("weekly")
+    ring.add(1000, NOW)
+    ring.add(2000, NOW + DAY)
+    loaded = SpendRing.from_record({
+        "budget_renewal": "weekly",
+        "spend_ring": ring.dumps()
+    })
+    assert loaded.spent(NOW + DAY) == 3000
+
+    rolling = SpendRing(window_seconds=DAY)
+    rolling.add(700, NOW)
+    loaded = SpendRing.from_record({
+        "budget_window": DAY,
+        "spend_ring": rolling.dumps()
+    })
+    assert loaded.spent(NOW + 60) == 700
@@ -0,0 +1,51 @@
+from lib.cache import INFO_MAX_AGE, ResponseCache
+
+HASH = "ab" * 32
+
+
+def test_get_info_dropped_on_block():
+    cache = ResponseCache()
+    assert cache.get_info(now=0) is None
+    cache.put_info({"block_height": 1}, now=0)
+    assert cache.get_info(now=1) == {"block_height": 1}
+    assert cache.get_info(now=INFO_MAX_AGE) is None
+    cache.put_info({"block_height": 1}, now=0)
+    cache.on_block()
+    assert cache.get_info(now=1) is None
+    assert cache.stats()["get_info"] == {"hits": 1, "misses": 3, "evictions": 1, "hit_rate": 0.25}
+
+
+def test_pending_lookup_expires_or_is_invalidated():
+    cache = ResponseCache(pending_ttl=5)
+    by_hash = cache.lookup_key(payment_hash=HASH)
+    by_invoice = cache.lookup_key(invoice="lnbc1")
+    pending = {"type": "incoming", "payment_hash": HASH, "expires_at": 100}
+    cache.put_lookup(by_hash, pending, now=0)
+    cache.put_lookup(by_invoice, pending, now=0)
+    assert cache.get_lookup(by_hash, now=4) == pending
+    assert cache.get_lookup(by_hash, now=5) is None
+
+    # a payment notification drops every key holding the payment hash
+    cache.put_lookup(by_hash, pending, now=0)
+    cache.on_payment(HASH)
+    assert cache.get_lookup(by_hash, now=1) is None
+    assert cache.get_lookup(by_invoice, now=1) is None
+    assert cache.stats()["lookup_invoice"]["size"] == 0
+    assert cache._by_hash == {}
+
+
+def test_final_lookups_kept_in_lru():
+    cache = ResponseCache(lookup_size=2)
+    settled = [{"payment_hash": f"{n:064x}", "settled_at": 1} for n in range(3)]
+    keys = [cache.lookup_key(payment_hash=result["payment_hash"]) for result in settled]
+    cache.put_lookup(keys[0], settled[0], now=0)
+    cache.put_lookup(keys[1], settled[1], now=0)
+    assert cache.get_lookup(keys[0], now=10 ** 9) == settled[0]
+    # keys[1] is least recently used
+    cache.put_lookup(keys[2], settled[2], now=0)
+    assert cache.get_lookup(keys[1], now=0) is None
+    assert cache.get_lookup(keys[0], now=0) == settled[0]
+    # an expired incoming invoice is final too
+    expired = {"type": "incoming", "payment_hash": HASH, "expires_at": 10}
+    cache.put_lookup(keys[1], expired, now=20)
+    assert cache.get_lookup(keys[1], now=10 ** 9) == expired
@@ -0,0 +1,84 @@
+import json
+import os
+import pytest
+from pyln.client import RpcError
+from lib.capture import REDACTED, Recorder, ReplayRpc, read_recording, redact_rpc
+
+KEY = "11" * 32
+
+
+def test_redact_datastore_params():
+    payload, _ = redact_rpc("datastore", {"key": ["nwc", "key", "t"], "string": KEY}, None)
+    assert payload == {"key": ["nwc", "key", "t"], "string": REDACTED}
+    payload, _ = redact_rpc("datastore", {"key": ["nwc", "key", "t"], "hex": KEY, "string": None}, None)
+    assert payload["hex"] == REDACTED and payload["string"] is None
+
+
+def test_redact_results():
+    _, result = redact_rpc("listdatastore", {"key": ["nwc"]}, {"datastore": [
+        {"key": ["nwc", "key", "v0"], "string": KEY, "hex": KEY, "generation": 0}]})
+    assert result == {"datastore": [{"key": ["nwc", "key", "v0"], "string": REDACTED,
+                                     "hex": REDACTED, "generation": 0}]}
+    _, result = redact_rpc("makesecret", {"string": "nwc"}, {"secret": KEY})
+    assert result == {"secret": REDACTED}
+    _, result = redact_rpc("datastore", None, {"key": ["k"], "string": KEY})
+    assert result == {"key": ["k"], "string": REDACTED}
+    # other calls are recorded as they are
+    assert redact_rpc("getinfo", {}, {"id": "02"}) == ({}, {"id": "02"})
+
+
+class Rpc:
+    def __init__(self, results):
+        self.results = results
+
+    def call(self, method, payload=None):
+        result = self.results[method]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+def test_recording_has_no_keys(tmp_path):
+    path = str(tmp_path / "capture.jsonl")
+    recorder = Recorder(path)
+    rpc = Rpc({
+        "listdatastore": {"datastore": [{"key": ["nwc", "key", "v0"], "string": KEY}]},
+        "makesecret": {"secret": KEY},
+        "datastore": {"key": ["nwc", "key", "t"], "string": KEY},
+        "getinfo": {"id": "02" * 33},
+        "pay": RpcError("pay", {}, {"code": 210, "message": "failed"})
+    })
+    recorder.wrap_rpc(rpc)
+    rpc.call("listdatastore", {"key": ["nwc", "key"]})
+    rpc.call("makesecret", {"string": "nwc"})
+    rpc.call("datastore", {"key": ["nwc", "key", "t"], "string": KEY})
+    rpc.call("getinfo")
+    with pytest.raises(RpcError):
+        rpc.call("pay", {"bolt11": "lnbc"})
+    recorder.on_event("wss://r", {"id": "aa"})
+    recorder.close()
+
+    with open(path) as f:
+        assert KEY not in f.read()
+    assert oct(os.stat(path).st_mode & 0o777) == "0o600"
+    events, calls = read_recording(path)
+    assert [record["method"] for record in calls] == [
+        "listdatastore", "makesecret", "datastore", "getinfo", "pay"]
+    assert calls[-1]["error"]["code"] == 210 and "result" not in calls[-1]
+    assert events[0]["event"] == {"id": "aa"}
+
+
+def test_replay_answers_keys_from_the_node():
+    calls = [{"method": "getinfo", "params": None, "result": {"id": "a"}},
+             {"method": "getinfo", "params": None, "result": {"id": "b"}},
+             {"method": "listdatastore", "params": {"key": ["nwc"]},
+              "result": {"datastore": [{"key": ["nwc", "key", "v0"], "string": REDACTED}]}}]
+    rpc = ReplayRpc(calls, keys={("nwc", "key", "v0"): KEY})
+    assert rpc.call("listdatastore", {"key": ["nwc", "key"]}) == {
+        "datastore": [{"key": ["nwc", "key", "v0"], "string": KEY}]}
+    assert rpc.call("listdatastore", {"key": ["other"]}) == {"datastore": []}
+    # in recorded order, then the last one again
+    assert [rpc.call("getinfo")["id"] for _ in range(3)] == ["a", "b", "b"]
+    with pytest.raises(RpcError):
+        rpc.call("pay", {"bolt11": "x"})
+    assert rpc.missed == 1
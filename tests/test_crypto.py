@@ -0,0 +1,33 @@
+import asyncio
+from coincurve import PrivateKey
+from lib import crypto, nip44
+
+WALLET = "11" * 32
+CLIENT = "22" * 32
+
+
+def x_only(secret_hex: str) -> str:
+    return PrivateKey(bytes.fromhex(secret_hex)).public_key.format()[1:].hex()
+
+
+def test_pool_uses_the_plugins_conversation_keys():
+    client_pubkey = x_only(CLIENT)
+    crypto.configure(1)
+    try:
+        async def roundtrip():
+            encrypted = await crypto.run("encrypt", "nip44_v2", WALLET, client_pubkey, "hi")
+            return await crypto.run("decrypt", "nip44_v2", WALLET, client_pubkey, encrypted)
+
+        assert asyncio.run(roundtrip()) == "hi"
+        assert (WALLET, client_pubkey) in nip44.conversation_keys._keys
+        # a revoked connection's key is gone for the workers too
+        nip44.conversation_keys.evict(client_pubkey)
+        assert (WALLET, client_pubkey) not in nip44.conversation_keys._keys
+        assert crypto.stats()["jobs"] == 2
+    finally:
+        crypto.configure(0)
+
+
+def test_inline_matches_the_pool():
+    encrypted = nip44.encrypt(CLIENT, x_only(WALLET), "hello")
+    assert asyncio.run(crypto.run("decrypt", "nip44_v2", WALLET, x_only(CLIENT), encrypted)) == "hello"
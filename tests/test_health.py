@@ -0,0 +1,45 @@
+import pytest
+from lib.health import (DISCONNECT_PENALTY_MS, DISCONNECT_WINDOW, ERROR_PENALTY_MS,
+                        LAG_PENALTY_MS, RelayHealth, ewma)
+
+
+def test_ewma():
+    assert ewma(None, 10) == 10
+    assert ewma(10, 20) == pytest.approx(12)
+
+
+def test_score():
+    health = RelayHealth("wss://r")
+    assert health.score() is None and health.state == "down"
+    health.on_connect()
+    assert health.score() == 0 and health.state == "healthy"
+
+    # the slower of ping and OK round trips
+    health.on_ping(0.05)
+    health.on_ack(0.2)
+    assert health.score() == pytest.approx(200)
+    # plus delivery lag, a client clock ahead of ours counts as none
+    health.on_event(created_at=110, now=100)
+    assert health.lag_s == 0
+    health.on_event(created_at=100, now=105)
+    assert health.score() == pytest.approx(200 + 1 * LAG_PENALTY_MS)
+
+
+def test_errors_and_disconnects_degrade():
+    health = RelayHealth("wss://r")
+    health.on_connect()
+    health.on_ack(0, accepted=True)
+    health.on_ack(0, accepted=False)
+    health.on_error()
+    assert health.error_rate() == pytest.approx(2 / 3)
+    assert health.score() == pytest.approx(2 / 3 * ERROR_PENALTY_MS)
+    assert health.state == "healthy"
+
+    health.on_disconnect()
+    health.on_disconnect()
+    assert health.counters["disconnects"] == 1 and health.state == "down"
+    health.on_connect()
+    assert health.score() == pytest.approx(2 / 3 * ERROR_PENALTY_MS + DISCONNECT_PENALTY_MS)
+    assert health.state == "degraded"
+    assert health.recent_disconnects(now=health._disconnects[0] + DISCONNECT_WINDOW) == 0
+    assert health.stats()["state"] == "healthy"
@@ -0,0 +1,119 @@
+import os
+import pytest
+from lib.budget import SpendRing
+from lib.journal import SpendJournal
+from lib.store import ConnectionStore
+
+PUBKEY = "ab" * 32
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConnectionStore(str(tmp_path / "connections.sqlite3"))
+    store.insert({"pubkey": PUBKEY, "secret": "00" * 32, "budget_msat": 10000,
+                  "budget_renewal": "daily"})
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def journal(tmp_path, store):
+    # compaction only when asked for
+    journal = SpendJournal(str(tmp_path / "spends.journal"), store,
+                           compact_interval=3600, compact_records=10 ** 6)
+    journal.replay()
+    journal.start()
+    yield journal
+    journal.stop()
+
+
+def spend(journal, amount_msat):
+    return journal.append(PUBKEY, amount_msat).result(timeout=5)
+
+
+def test_append_is_seen_before_compaction(journal, store):
+    assert spend(journal, 1000) == 1
+    assert spend(journal, 2000) == 2
+    assert store.get(PUBKEY)["spent_msat"] == 0
+    assert journal.get(PUBKEY)["spent_msat"] == 3000
+    assert journal.apply_pending(store.get(PUBKEY))["spent_msat"] == 3000
+    with open(journal.path) as f:
+        assert len(f.readlines()) == 2
+
+
+def test_compaction(journal, store):
+    spend(journal, 1000)
+    spend(journal, 2000)
+    journal.compact()
+    assert store.get(PUBKEY)["spent_msat"] == 3000
+    assert store.journal_seq() == 2
+    assert journal.get(PUBKEY)["spent_msat"] == 3000
+    assert os.path.getsize(journal.path) == 0
+    assert journal.stats()["compactions"] == 1
+
+    # seqs go on after compaction
+    assert spend(journal, 500) == 3
+
+
+def test_replay(tmp_path, store):
+    path = str(tmp_path / "spends.journal")
+    store.apply_spends([[1, PUBKEY, 100, 1000]])
+    with open(path, "w") as f:
+        # already compacted
+        f.write(f'[1,"{PUBKEY}",100,1000]\n')
+        f.write(f'[2,"{PUBKEY}",200,1000]\n')
+        f.write(f'[3,"{PUBKEY}",300,1000]\n')
+        # torn write, never acknowledged
+        f.write(f'[4,"{PUBKEY}",40')
+
+    journal = SpendJournal(path, store)
+    assert journal.replay() == 2
+    assert store.get(PUBKEY)["spent_msat"] == 600
+    assert store.journal_seq() == 3
+    assert os.path.getsize(path) == 0
+
+    # nothing left to apply twice
+    assert SpendJournal(path, store).replay() == 0
+    assert store.get(PUBKEY)["spent_msat"] == 600
+
+    journal.start()
+    try:
+        assert spend(journal, 1) == 4
+    finally:
+        journal.stop()
+
+
+def test_replay_is_idempotent_without_truncation(tmp_path, store):
+    """a crash between compaction and truncation replays nothing twice"""
+    path = str(tmp_path / "spends.journal")
+    journal = SpendJournal(path, store, compact_interval=3600, compact_records=10 ** 6)
+    journal.start()
+    spend(journal, 700)
+    with open(path) as f:
+        lines = f.read()
+    journal.compact()
+    journal.stop()
+
+    with open(path, "w") as f:
+        f.write(lines)
+    assert SpendJournal(path, store).replay() == 0
+    assert store.get(PUBKEY)["spent_msat"] == 700
+
+
+def test_spends_count_against_the_renewing_budget(journal, store):
+    spend(journal, 1500)
+    assert SpendRing.from_record(journal.get(PUBKEY)).spent() == 1500
+    journal.compact()
+    assert SpendRing.from_record(store.get(PUBKEY)).spent() == 1500
+
+
+def test_spend_history_is_trimmed(store):
+    day = 24 * 60 * 60
+    store.apply_spends([[1, PUBKEY, 100, 1000, "01" * 32]])
+    store.apply_spends([[2, PUBKEY, 100, 1000 + day, "02" * 32]])
+    assert store.has_spend(PUBKEY, "01" * 32)
+    store.apply_spends([[3, PUBKEY, 100, 1001 + day, "03" * 32]])
+    assert not store.has_spend(PUBKEY, "01" * 32)
+    assert store.has_spend(PUBKEY, "02" * 32)
+    # the totals keep every spend
+    assert store.get(PUBKEY)["spent_msat"] == 300
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import pytest
+from lib.event import Event
+from lib.local_relay import LocalRelay, matches, valid_filter
+
+SECRET = "11" * 32
+
+
+class Ws:
+    def __init__(self):
+        self.sent = []
+
+    async def send(self, frame):
+        self.sent.append(json.loads(frame))
+
+
+def signed(kind=23194, created_at=1000, content="x", tags=None) -> dict:
+    event = Event(kind=kind, content=content, tags=tags or [], created_at=created_at)
+    event.sign(SECRET)
+    return event.event_data()
+
+
+def send(relay, *messages) -> Ws:
+    ws = Ws()
+    relay._clients[ws] = {}
+
+    async def run():
+        for verb, *args in messages:
+            if verb == "EVENT":
+                await relay._on_event(ws, args[0])
+            else:
+                await relay._on_req(ws, args[0], args[1:])
+    asyncio.run(run())
+    return ws
+
+
+def test_accepts_signed_events():
+    relay = LocalRelay("127.0.0.1", 0)
+    event = signed()
+    ws = send(relay, ("EVENT", event))
+    assert ws.sent == [["OK", event["id"], True, ""]]
+    assert relay.received == 1
+
+
+@pytest.mark.parametrize("tamper", [
+    lambda event: event.update(content="y"),
+    lambda event: event.update(sig="00" * 64),
+    lambda event: event.update(id="00" * 32),
+])
+def test_rejects_bad_signatures(tamper):
+    relay = LocalRelay("127.0.0.1", 0)
+    event = signed()
+    tamper(event)
+    ws = send(relay, ("EVENT", event))
+    assert ws.sent == [["OK", event["id"], False, "invalid: bad id or signature"]]
+    assert relay.rejected == 1
+
+
+def test_rejects_other_kinds_and_malformed():
+    relay = LocalRelay("127.0.0.1", 0)
+    event = signed(kind=1)
+    ws = send(relay, ("EVENT", event), ("EVENT", {"id": "00"}))
+    assert ws.sent[0][2] is False
+    assert ws.sent[1][0] == "NOTICE"
+    assert relay.rejected == 2
+
+
+def test_subscribers_get_matching_events():
+    relay = LocalRelay("127.0.0.1", 0)
+    subscriber = send(relay, ("REQ", "s", {"kinds": [23195], "#e": ["aa" * 32]}))
+    assert subscriber.sent == [["EOSE", "s"]]
+
+    response = signed(kind=23195, tags=[["e", "aa" * 32]])
+    other = signed(kind=23195, tags=[["e", "bb" * 32]])
+    send(relay, ("EVENT", response), ("EVENT", other))
+    assert subscriber.sent[1:] == [["EVENT", "s", response]]
+
+    # stored for apps that subscribe after sending their request
+    late = send(relay, ("REQ", "t", {"kinds": [23195], "#e": ["aa" * 32]}))
+    assert late.sent == [["EVENT", "t", response], ["EOSE", "t"]]
+
+
+def test_replaceable_keeps_the_newest():
+    relay = LocalRelay("127.0.0.1", 0)
+    newer = signed(kind=13194, created_at=2000, content="new")
+    older = signed(kind=13194, created_at=1000, content="old")
+    send(relay, ("EVENT", newer), ("EVENT", older))
+    ws = send(relay, ("REQ", "s", {"kinds": [13194]}))
+    assert ws.sent == [["EVENT", "s", newer], ["EOSE", "s"]]
+
+
+def test_replaceable_tie_keeps_the_lower_id():
+    relay = LocalRelay("127.0.0.1", 0)
+    lower, higher = sorted((signed(kind=13194, created_at=2000, content=content)
+                            for content in "ab"), key=lambda event: event["id"])
+    send(relay, ("EVENT", lower), ("EVENT", higher))
+    ws = send(relay, ("REQ", "s", {"kinds": [13194]}))
+    assert ws.sent == [["EVENT", "s", lower], ["EOSE", "s"]]
+
+
+def test_filters():
+    event = {"id": "01", "pubkey": "aa", "kind": 23194, "created_at": 100,
+             "tags": [["p", "bb"]]}
+    assert matches({}, event)
+    assert matches({"authors": ["aa"], "kinds": [23194], "#p": ["bb"]}, event)
+    assert not matches({"#p": ["cc"]}, event)
+    assert not matches({"since": 101}, event)
+    assert not matches({"until": 99}, event)
+    assert not matches({"ids": ["02"]}, event)
+    assert valid_filter({"kinds": [1], "limit": 5})
+    assert not valid_filter({"kinds": 1})
+    assert not valid_filter({"since": "1"})
+    assert not valid_filter([])
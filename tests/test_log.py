@@ -0,0 +1,73 @@
+import pytest
+from lib.log import REDACTED, Logger, parse_samples, redact
+from utilities.rpc_plugin import plugin
+
+
+@pytest.fixture
+def lines(monkeypatch):
+    lines = []
+    monkeypatch.setattr(plugin, "log", lambda message, level='info': lines.append((level, message)))
+    return lines
+
+
+def test_redact():
+    pay_result = {"payment_preimage": "aa" * 32, "amount_sent_msat": 1000,
+                  "parts": [{"preimage": "bb" * 32, "secret": "cc" * 32}],
+                  "privkey": None}
+    assert redact(pay_result) == {
+        "payment_preimage": REDACTED, "amount_sent_msat": 1000,
+        "parts": [{"preimage": REDACTED, "secret": REDACTED}],
+        "privkey": None}
+    url = "nostr+walletconnect://" + "dd" * 32 + "?relay=wss://r&secret=" + "ee" * 32
+    assert redact({"url": url})["url"].endswith("secret=" + REDACTED)
+    assert "ee" * 32 not in redact(("x", url))[1]
+
+
+def test_fields_are_redacted_in_lines(lines):
+    logger = Logger()
+    logger.info("payment", "nwc pay result", result={"payment_preimage": "aa" * 32})
+    assert lines == [("info", 'nwc pay result result={"payment_preimage":"<redacted>"}')]
+
+
+def test_levels(lines):
+    logger = Logger()
+    logger.configure("warn")
+    logger.debug("request", "a")
+    logger.info("request", "b")
+    logger.warn("request", "c", skipped=None)
+    logger.error("request", "d", code=1)
+    assert lines == [("warn", "c"), ("error", "d code=1")]
+    with pytest.raises(ValueError):
+        logger.configure("trace")
+
+
+def test_sampling_spares_errors(lines):
+    logger = Logger()
+    logger.configure("debug", {"request": 10}, rate=0)
+    for _ in range(30):
+        logger.debug("request", "x")
+    logger.error("request", "failed")
+    assert len(lines) == 4
+    assert logger.stats()["sampled"] == {"request": 27}
+
+
+def test_rate_cap_reports_suppressed(lines, monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr("lib.log.time.monotonic", lambda: clock[0])
+    logger = Logger()
+    logger.configure("info", rate=2)
+    for _ in range(5):
+        logger.info("relay", "x")
+    assert len(lines) == 2
+    clock[0] += 1
+    logger.info("relay", "y")
+    assert lines[-1] == ("info", "y suppressed=3")
+    assert logger.stats()["rate_limited"] == {"relay": 3}
+
+
+def test_parse_samples():
+    assert parse_samples(["request=100", "relay=2"]) == {"request": 100, "relay": 2}
+    assert parse_samples(None) == {}
+    for value in ("request", "request=0", "=5", "request=x"):
+        with pytest.raises(ValueError):
+            parse_samples([value])
@@ -0,0 +1,117 @@
+"""NIP-44 v2 against the spec's test vectors (nip44.vectors.json)"""
+
+import base64
+import pytest
+from coincurve import PrivateKey
+from lib import nip44
+
+
+def x_only(secret_hex: str) -> str:
+    return PrivateKey(bytes.fromhex(secret_hex)).public_key.format()[1:].hex()
+
+
+@pytest.mark.parametrize("sec1, pub2, conversation_key", [
+    ("315e59ff51cb9209768cf7da80791ddcaae56ac9775eb25b6dee1234bc5d2268",
+     "c2f9d9948dc8c7c38321e4b85c8558872eafa0641cd269db76848a6073e69133",
+     "3dfef0ce2a4d80a25e7a328accf73448ef67096f65f79588e358d9a0eb9013f1"),
+    ("a1e37752c9fdc1273be53f68c5f74be7c8905728e8de75800b94262f9497c86e",
+     "03bb7947065dde12ba991ea045132581d0954f042c84e06d8c00066e23c1a800",
+     "4d14f36e81b8452128da64fe6f1eae873baae2f444b02c950b90e43553f2178b"),
+])
+def test_conversation_key(sec1, pub2, conversation_key):
+    assert nip44.get_conversation_key(sec1, pub2).hex() == conversation_key
+
+
+ENCRYPT_DECRYPT = [
+    ("0000000000000000000000000000000000000000000000000000000000000001",
+     "0000000000000000000000000000000000000000000000000000000000000002",
+     "c41c775356fd92eadc63ff5a0dc1da211b268cbea22316767095b2871ea1412d",
+     "0000000000000000000000000000000000000000000000000000000000000001",
+     "a",
+     "AgAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAABee0G5VSK0/9YypIObAtDKfYEAjD35uVkHyB0F4DwrcNaCXlCWZKaArsGrY6M9wnuTMxWfp1RTN9Xga8no+kF5Vsb"),
+    ("0000000000000000000000000000000000000000000000000000000000000002",
+     "0000000000000000000000000000000000000000000000000000000000000001",
+     "c41c775356fd92eadc63ff5a0dc1da211b268cbea22316767095b2871ea1412d",
+     "f00000000000000000000000000000f00000000000000000000000000000000f",
+     "🍕🫃",
+     "AvAAAAAAAAAAAAAAAAAAAPAAAAAAAAAAAAAAAAAAAAAPSKSK6is9ngkX2+cSq85Th16oRTISAOfhStnixqZziKMDvB0QQzgFZdjLTPicCJaV8nDITO+QfaQ61+KbWQIOO2Yj"),
+]
+
+
+@pytest.mark.parametrize("sec1, sec2, conversation_key, nonce, plaintext, payload",
+                         ENCRYPT_DECRYPT)
+def test_encrypt_decrypt(sec1, sec2, conversation_key, nonce, plaintext, payload):
+    key = nip44.get_conversation_key(sec1, x_only(sec2))
+    assert key.hex() == conversation_key
+    # both sides derive the same key
+    assert nip44.get_conversation_key(sec2, x_only(sec1)) == key
+
+    assert nip44.encrypt_with_key(key, plaintext, bytes.fromhex(nonce)) == payload
+    assert nip44.decrypt_with_key(key, payload) == plaintext
+
+
+def test_encrypt_decrypt_with_cached_keys():
+    sec1, sec2 = ENCRYPT_DECRYPT[0][:2]
+    payload = nip44.encrypt(sec1, x_only(sec2), "hello")
+    assert nip44.decrypt(sec2, x_only(sec1), payload) == "hello"
+
+
+@pytest.mark.parametrize("unpadded_len, padded_len", [
+    (16, 32), (32, 32), (33, 64), (37, 64), (45, 64), (49, 64), (64, 64),
+    (65, 96), (100, 128), (111, 128), (200, 224), (250, 256), (320, 320),
+    (383, 384), (384, 384), (400, 448), (500, 512), (512, 512), (515, 640),
+    (700, 768), (800, 896), (900, 1024), (1020, 1024), (65536, 65536),
+])
+def test_calc_padded_len(unpadded_len, padded_len):
+    assert nip44.calc_padded_len(unpadded_len) == padded_len
+
+
+def payload_with(key: bytes, padded: bytes, nonce: bytes = bytes(32)) -> str:
+    """a payload with a valid MAC around any padded plaintext"""
+    chacha_key, chacha_nonce, hmac_key = nip44.get_message_keys(key, nonce)
+    ciphertext = nip44.process_chacha(padded, chacha_key, chacha_nonce)
+    mac = nip44.hmac_aad(hmac_key, ciphertext, nonce)
+    return base64.b64encode(bytes([nip44.VERSION]) + nonce + ciphertext + mac).decode()
+
+
+KEY = bytes.fromhex(ENCRYPT_DECRYPT[0][2])
+
+
+def test_rejects_invalid_mac():
+    decoded = bytearray(base64.b64decode(ENCRYPT_DECRYPT[0][5]))
+    decoded[-1] ^= 1
+    with pytest.raises(ValueError, match="invalid MAC"):
+        nip44.decrypt_with_key(KEY, base64.b64encode(bytes(decoded)).decode())
+
+
+def test_rejects_wrong_key():
+    with pytest.raises(ValueError, match="invalid MAC"):
+        nip44.decrypt_with_key(bytes(32), ENCRYPT_DECRYPT[0][5])
+
+
+@pytest.mark.parametrize("padded", [
+    # length prefix longer than the plaintext
+    (40).to_bytes(2, "big") + b"a" + bytes(31),
+    # zero length
+    bytes(34),
+    # padded to 64 instead of 32
+    (1).to_bytes(2, "big") + b"a" + bytes(63),
+])
+def test_rejects_invalid_padding(padded):
+    with pytest.raises(ValueError, match="invalid padding"):
+        nip44.decrypt_with_key(KEY, payload_with(KEY, padded))
+
+
+@pytest.mark.parametrize("payload", [
+    "#" + ENCRYPT_DECRYPT[0][5][1:],
+    payload_with(KEY, nip44.pad("a")).replace("A", "B", 1),
+])
+def test_rejects_unknown_version(payload):
+    with pytest.raises(ValueError, match="unknown encryption version"):
+        nip44.decrypt_with_key(KEY, payload)
+
+
+@pytest.mark.parametrize("plaintext", ["", "a" * 65536])
+def test_rejects_plaintext_length(plaintext):
+    with pytest.raises(ValueError, match="invalid plaintext length"):
+        nip44.encrypt_with_key(KEY, plaintext)
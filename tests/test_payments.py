@@ -0,0 +1,249 @@
+import asyncio
+import pytest
+from lib.journal import SpendJournal
+from lib.nip47 import NIP47RequestHandler
+from lib.payments import PaymentRegistry
+from lib.store import ConnectionStore
+from lib.tenants import TenantRegistry
+from lib.usage import UsageTracker
+from utilities.rpc_plugin import plugin
+
+PUBKEY = "ab" * 32
+PAYMENT_HASH = "cd" * 32
+REQUEST = {"event_id": "ef" * 32, "encryption": "nip44_v2", "tenant": None}
+
+
+class Rpc:
+    """lightningd with one complete payment and the default tenant's key"""
+
+    def listpays(self, payment_hash):
+        return {"pays": [{"status": "complete", "preimage": "00" * 32,
+                          "amount_sent_msat": 1000}]}
+
+    def listdatastore(self, key):
+        if key == ["nwc", "key", "v0"]:
+            return {"datastore": [{"key": key, "string": "01" * 32}]}
+        return {"datastore": []}
+
+
+def start(monkeypatch, tmp_path, snapshot: dict = None):
+    """a plugin (re)start, returns its journal"""
+    store = ConnectionStore(str(tmp_path / "connections.sqlite3"))
+    if store.get(PUBKEY) is None:
+        store.insert({"pubkey": PUBKEY, "secret": "00" * 32, "budget_msat": 10000})
+    journal = SpendJournal(str(tmp_path / "spends.journal"), store)
+    journal.replay()
+    journal.start()
+    payments = PaymentRegistry()
+    payments.restore(snapshot or {})
+
+    monkeypatch.setattr(plugin, "rpc", Rpc(), raising=False)
+    monkeypatch.setattr(plugin, "store", store, raising=False)
+    monkeypatch.setattr(plugin, "journal", journal, raising=False)
+    monkeypatch.setattr(plugin, "payments", payments, raising=False)
+    monkeypatch.setattr(plugin, "usage", UsageTracker(), raising=False)
+    tenants = TenantRegistry(store)
+    tenants.load(plugin)
+    monkeypatch.setattr(plugin, "tenants", tenants, raising=False)
+    return journal
+
+
+@pytest.mark.parametrize("compacted", [False, True])
+def test_complete_after_snapshot_counted_once(monkeypatch, tmp_path, compacted):
+    journal = start(monkeypatch, tmp_path)
+    snapshots = []
+
+    async def attempt():
+        # the Snapshotter runs while lightningd is paying
+        snapshots.append(plugin.payments.snapshot())
+        await journal.record(PUBKEY, 1000, payment_hash=PAYMENT_HASH)
+        return {"preimage": "00" * 32}
+
+    asyncio.run(plugin.payments.pay((PUBKEY, PAYMENT_HASH), attempt, REQUEST))
+    assert snapshots[0]["pending"] == [[PUBKEY, PAYMENT_HASH, REQUEST]]
+    if compacted:
+        journal.compact()
+    # killed before the next snapshot
+    journal.stop()
+    plugin.store.close()
+
+    journal = start(monkeypatch, tmp_path, snapshots[0])
+    assert plugin.store.get(PUBKEY)["spent_msat"] == 1000
+    response = asyncio.run(NIP47RequestHandler.resume_payment(PUBKEY, PAYMENT_HASH))
+    assert response["result"] == {"preimage": "00" * 32}
+    assert plugin.payments.interrupted() == []
+    journal.compact()
+    journal.stop()
+    assert plugin.store.get(PUBKEY)["spent_msat"] == 1000
+
+
+def test_interrupted_spend_recorded_on_resume(monkeypatch, tmp_path):
+    """pay didn't return before the restart, the spend is recorded once resumed"""
+    journal = start(monkeypatch, tmp_path, {"pending": [[PUBKEY, PAYMENT_HASH, REQUEST]]})
+    asyncio.run(NIP47RequestHandler.resume_payment(PUBKEY, PAYMENT_HASH))
+    assert journal.get(PUBKEY)["spent_msat"] == 1000
+    assert plugin.tenants.default.spent_msat == 1000
+    journal.compact()
+    journal.stop()
+    assert plugin.store.has_spend(PUBKEY, PAYMENT_HASH)
+
+
+KEY = (PUBKEY, PAYMENT_HASH)
+RESULT = {"preimage": "00" * 32}
+
+
+def test_duplicates_share_one_attempt():
+    registry = PaymentRegistry()
+    attempts = []
+
+    async def attempt():
+        attempts.append(1)
+        await asyncio.sleep(0.01)
+        return RESULT
+
+    async def run():
+        results = await asyncio.gather(*(registry.pay(KEY, attempt) for _ in range(3)))
+        # completed, a retry gets the stored result
+        results.append(await registry.pay(KEY, attempt))
+        return results
+
+    assert asyncio.run(run()) == [RESULT] * 4
+    assert len(attempts) == 1
+    assert registry.stats()["duplicate_inflight"] == 2
+    assert registry.stats()["duplicate_completed"] == 1
+
+
+def test_failed_payments_can_be_retried():
+    registry = PaymentRegistry()
+
+    async def failing():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("no route")
+
+    async def succeeding():
+        return RESULT
+
+    async def run():
+        outcomes = await asyncio.gather(registry.pay(KEY, failing), registry.pay(KEY, failing),
+                                        return_exceptions=True)
+        assert all(isinstance(outcome, RuntimeError) for outcome in outcomes)
+        return await registry.pay(KEY, succeeding)
+
+    assert asyncio.run(run()) == RESULT
+    assert registry.stats()["failed"] == 1
+    assert registry.stats()["attempts"] == 2
+
+
+def test_cancelled_waiter_doesnt_cancel_the_payment():
+    registry = PaymentRegistry()
+
+    async def attempt():
+        await asyncio.sleep(0.02)
+        return RESULT
+
+    async def run():
+        payment = asyncio.ensure_future(registry.pay(KEY, attempt))
+        await asyncio.sleep(0)
+        waiter = asyncio.ensure_future(registry.pay(KEY, attempt))
+        await asyncio.sleep(0.005)
+        waiter.cancel()
+        return await payment
+
+    assert asyncio.run(run()) == RESULT
+    assert registry.completed(KEY) == RESULT
+
+
+def test_snapshot_restore():
+    registry = PaymentRegistry()
+    started = []
+
+    async def attempt():
+        started.append(registry.snapshot())
+        return RESULT
+
+    asyncio.run(registry.pay(KEY, attempt, REQUEST))
+    assert started[0] == {"pending": [[PUBKEY, PAYMENT_HASH, REQUEST]], "completed": []}
+    assert registry.snapshot() == {"pending": [], "completed": [[PUBKEY, PAYMENT_HASH, RESULT]]}
+
+    restored = PaymentRegistry()
+    restored.restore(started[0])
+    assert restored.interrupted() == [(KEY, REQUEST)]
+    assert restored.snapshot()["pending"] == [[PUBKEY, PAYMENT_HASH, REQUEST]]
+
+
+def test_duplicate_of_interrupted_payment_waits_for_resume():
+    registry = PaymentRegistry()
+    registry.restore({"pending": [[PUBKEY, PAYMENT_HASH, REQUEST]]})
+    attempts = []
+
+    async def attempt():
+        attempts.append(1)
+        return {"preimage": "ff" * 32}
+
+    async def run():
+        duplicate = asyncio.ensure_future(registry.pay(KEY, attempt))
+        await asyncio.sleep(0.01)
+        assert not duplicate.done()
+        # resume_payment found it paid
+        registry.complete(KEY, RESULT)
+        return await duplicate
+
+    assert asyncio.run(run()) == RESULT
+    assert attempts == []
+    assert registry.stats()["duplicate_interrupted"] == 1
+
+
+def test_interrupted_payment_never_started_is_paid_by_the_duplicate():
+    registry = PaymentRegistry()
+    registry.restore({"pending": [[PUBKEY, PAYMENT_HASH, REQUEST]]})
+
+    async def attempt():
+        return RESULT
+
+    async def run():
+        duplicate = asyncio.ensure_future(registry.pay(KEY, attempt))
+        await asyncio.sleep(0.01)
+        registry.forget_interrupted(KEY)
+        return await duplicate
+
+    assert asyncio.run(run()) == RESULT
+    assert registry.stats()["attempts"] == 1
+
+
+def test_interrupted_payment_that_failed_fails_the_duplicate():
+    registry = PaymentRegistry()
+    registry.restore({"pending": [[PUBKEY, PAYMENT_HASH, REQUEST]]})
+
+    async def attempt():
+        return RESULT
+
+    async def run():
+        duplicate = asyncio.ensure_future(registry.pay(KEY, attempt))
+        await asyncio.sleep(0.01)
+        registry.forget_interrupted(KEY, RuntimeError("payment failed"))
+        return await duplicate
+
+    with pytest.raises(RuntimeError, match="payment failed"):
+        asyncio.run(run())
+    assert "attempts" not in registry.stats()
+
+
+def test_completed_payments_are_bounded():
+    registry = PaymentRegistry(size=2)
+    for n in range(3):
+        registry.complete((PUBKEY, f"{n:064x}"), RESULT)
+        registry.remember_hash(f"invoice{n}", f"{n:064x}")
+    assert registry.completed((PUBKEY, f"{0:064x}")) is None
+    assert registry.completed((PUBKEY, f"{2:064x}")) == RESULT
+    assert registry.payment_hash("invoice0") is None
+    assert registry.payment_hash("invoice2") == f"{2:064x}"
+
+
+def test_reservations():
+    registry = PaymentRegistry()
+    registry.reserve(PUBKEY, 1000)
+    registry.reserve(PUBKEY, 500)
+    assert registry.reserved(PUBKEY) == 1500
+    registry.reserve(PUBKEY, -1500)
+    assert registry.reserved(PUBKEY) == 0
+    assert PUBKEY not in registry._reserved
@@ -0,0 +1,126 @@
+import asyncio
+import json
+import websockets
+from lib.publisher import Publisher
+
+
+class Socket:
+    def __init__(self, closed=False):
+        self.sent = []
+        self.closed = closed
+
+    async def send(self, frame):
+        if self.closed:
+            raise websockets.exceptions.ConnectionClosed(None, None)
+        self.sent.append(json.loads(frame)[1]["id"])
+
+
+class Health:
+    def __init__(self):
+        self.acks = []
+        self.errors = 0
+
+    def on_ack(self, latency, accepted=True):
+        self.acks.append(accepted)
+
+    def on_error(self):
+        self.errors += 1
+
+
+def event(n):
+    return {"id": f"{n:064x}", "kind": 23195}
+
+
+def test_publish_and_ack():
+    health = Health()
+
+    async def run():
+        publisher = Publisher("wss://r", health=health)
+        ws = Socket()
+        publisher.attach(ws)
+        await publisher.publish(event(1))
+        await publisher.publish(event(1))
+        await asyncio.sleep(0)
+        await publisher.on_ok(event(1)["id"], True)
+        # an OK for an event that isn't pending
+        await publisher.on_ok(event(2)["id"], True)
+        publisher.detach()
+        return publisher, ws
+
+    publisher, ws = asyncio.run(run())
+    assert ws.sent == [event(1)["id"]]
+    stats = publisher.stats()
+    assert stats["in_flight"] == 0 and stats["published"] == 1 and stats["acked"] == 1
+    assert stats["ack_latency_ms"]["p50"] is not None
+    assert health.acks == [True]
+
+
+def test_rejected_events_are_retried_then_failed():
+    health = Health()
+
+    async def run():
+        publisher = Publisher("wss://r", max_attempts=2, health=health)
+        ws = Socket()
+        publisher.attach(ws)
+        await publisher.publish(event(1))
+        await publisher.publish(event(2))
+        await asyncio.sleep(0)
+        for _ in range(2):
+            await publisher.on_ok(event(1)["id"], False, "blocked: no")
+            await asyncio.sleep(0)
+        await publisher.on_ok(event(2)["id"], False, "duplicate: already have it")
+        publisher.detach()
+        return publisher, ws
+
+    publisher, ws = asyncio.run(run())
+    assert ws.sent == [event(1)["id"], event(2)["id"], event(1)["id"]]
+    stats = publisher.stats()
+    assert stats["rejected"] == 2 and stats["retried"] == 1 and stats["failed"] == 1
+    # a duplicate is as good as an OK
+    assert stats["acked"] == 1 and stats["in_flight"] == 0
+    assert health.acks == [False, False, True]
+
+
+def test_oldest_event_dropped_when_full():
+    async def run():
+        publisher = Publisher("wss://r", max_in_flight=2)
+        for n in range(3):
+            await publisher.publish(event(n))
+        ws = Socket()
+        publisher.attach(ws)
+        await asyncio.sleep(0)
+        publisher.detach()
+        return publisher, ws
+
+    publisher, ws = asyncio.run(run())
+    assert ws.sent == [event(1)["id"], event(2)["id"]]
+    assert publisher.stats()["dropped"] == 1 and publisher.stats()["in_flight"] == 2
+
+
+def test_resent_after_reconnect_and_ack_timeout():
+    health = Health()
+
+    async def run():
+        publisher = Publisher("wss://r", ack_timeout=0, max_attempts=3, health=health)
+        closed = Socket(closed=True)
+        publisher.attach(closed)
+        await publisher.publish(event(1))
+        await asyncio.sleep(0)
+
+        # the event wasn't written, the next connection sends it
+        ws = Socket()
+        publisher.attach(ws)
+        await asyncio.sleep(0)
+        assert ws.sent == [event(1)["id"]]
+
+        # no OK within ack_timeout: resent until max_attempts, then given up
+        while publisher.stats()["in_flight"]:
+            await asyncio.sleep(0.1)
+        publisher.detach()
+        return publisher, ws
+
+    publisher, ws = asyncio.run(asyncio.wait_for(run(), 5))
+    assert ws.sent == [event(1)["id"]] * 2
+    stats = publisher.stats()
+    assert stats["retried"] == 1 and stats["failed"] == 1
+    assert health.errors == 2
@@ -0,0 +1,25 @@
+from lib.shards import shard_of, shard_payments
+
+
+def test_shard_of():
+    assert shard_of("00000005" + "00" * 28, 4) == 1
+    assert shard_of("ffffffff" + "00" * 28, 1) == 0
+    pubkeys = [f"{n * 2654435761 % 2 ** 32:08x}" + "00" * 28 for n in range(400)]
+    counts = [0] * 4
+    for pubkey in pubkeys:
+        counts[shard_of(pubkey, 4)] += 1
+    assert min(counts) > 50
+
+
+def test_shard_payments():
+    a, b = "00000000" + "aa" * 28, "00000001" + "bb" * 28
+    payments = {
+        "pending": [[a, "01" * 32, {"event_id": "e1"}], [b, "02" * 32, {"event_id": "e2"}]],
+        "completed": [[b, "03" * 32, {"preimage": "p"}]]
+    }
+    assert shard_payments(payments, 0, 2) == {
+        "pending": [[a, "01" * 32, {"event_id": "e1"}]], "completed": []}
+    assert shard_payments(payments, 1, 2) == {
+        "pending": [[b, "02" * 32, {"event_id": "e2"}]],
+        "completed": [[b, "03" * 32, {"preimage": "p"}]]}
+    assert shard_payments({}, 0, 2) == {"pending": [], "completed": []}
@@ -0,0 +1,26 @@
+import time
+from lib.snapshot import Snapshotter
+from utilities.rpc_plugin import plugin
+
+
+def test_roundtrip(tmp_path):
+    snapshots = Snapshotter(str(tmp_path / "state.json"), lambda: {"since": 5})
+    assert snapshots.load() == {}
+    snapshots.save()
+    assert snapshots.load()["since"] == 5
+    assert snapshots.stats()["bytes"] > 0
+
+
+def test_failures_are_logged_and_counted(tmp_path, monkeypatch):
+    logged = []
+    monkeypatch.setattr(plugin, "log", lambda message, level='info': logged.append(level))
+    # not json serializable
+    snapshots = Snapshotter(str(tmp_path / "state.json"), lambda: {"since": object()},
+                            interval=0.01)
+    snapshots.start()
+    time.sleep(0.1)
+    snapshots.stop()
+    assert snapshots.stats()["failures"] > 0
+    assert snapshots.stats()["last_error"]
+    assert "error" in logged
+    assert snapshots.load() == {}
@@ -0,0 +1,108 @@
+import pytest
+import time
+from lib.store import ConnectionStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConnectionStore(str(tmp_path / "connections.sqlite3"))
+    yield store
+    store.close()
+
+
+def connection(n: int, **record) -> dict:
+    return {"pubkey": f"{n:064x}", "secret": "00" * 32,
+            "created_at": 1000 + n % 5, **record}
+
+
+def pages(store, limit, **filters) -> list[list[str]]:
+    """every page's pubkeys, following the cursors"""
+    result, cursor = [], None
+    while True:
+        rows, cursor = store.page(limit=limit, cursor=cursor, **filters)
+        result.append([row["pubkey"] for row in rows])
+        if cursor is None:
+            return result
+
+
+def test_cursor_walks_every_row_once(store):
+    store.insert_many([connection(n) for n in range(23)])
+    walked = pages(store, 5)
+    assert [len(page) for page in walked] == [5, 5, 5, 5, 3]
+    flat = [pubkey for page in walked for pubkey in page]
+    # created_at repeats, ties are broken by pubkey
+    assert flat == [row["pubkey"] for row in store.all()]
+    assert len(set(flat)) == 23
+
+
+def test_cursor_descending(store):
+    store.insert_many([connection(n, spent_msat=n * 10) for n in range(7)])
+    flat = [pubkey for page in pages(store, 3, sort="-spent_msat") for pubkey in page]
+    assert flat == [f"{n:064x}" for n in reversed(range(7))]
+
+
+def test_exact_last_page_has_no_cursor(store):
+    store.insert_many([connection(n) for n in range(4)])
+    rows, cursor = store.page(limit=4)
+    assert len(rows) == 4 and cursor is None
+    assert "sort_value" not in rows[0]
+
+
+def test_nulls_sort_last(store):
+    store.insert_many([
+        connection(1, expiry_unix=None),
+        connection(2, expiry_unix=5000),
+        connection(3, budget_msat=1000, spent_msat=900),
+        connection(4, budget_msat=1000, spent_msat=100),
+    ])
+    assert [row["pubkey"][-1] for row in store.page(sort="expiry_unix")[0]] == ["2", "1", "3", "4"]
+    walked = pages(store, 1, sort="remaining_budget_msat")
+    assert [page[0][-1] for page in walked] == ["3", "4", "1", "2"]
+
+
+def test_filters(store):
+    store.insert_many([
+        connection(1, expiry_unix=1),
+        connection(2, budget_msat=1000, spent_msat=800, tenant="t"),
+        connection(3, budget_msat=1000, spent_msat=100, created_at=2000),
+    ])
+    pubkeys = lambda **kw: [row["pubkey"][-1] for row in store.page(**kw)[0]]
+    assert pubkeys(status="expired") == ["1"]
+    assert pubkeys(status="active") == ["2", "3"]
+    assert pubkeys(min_budget_used_pct=50) == ["2"]
+    assert pubkeys(created_since=2000) == ["3"]
+    assert pubkeys(tenant="t") == ["2"]
+    assert pubkeys(tenant="v0") == ["1", "3"]
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"sort": "pubkey"},
+    {"status": "paused"},
+    {"cursor": "abc"},
+    {"cursor": "x:y"},
+])
+def test_invalid(store, kwargs):
+    with pytest.raises(ValueError):
+        store.page(limit=1, **kwargs)
+
+
+def test_renewed_budgets_sort_and_filter_on_the_window(store):
+    now = int(time.time())
+    store.insert_many([
+        connection(1, budget_msat=1000, budget_renewal="daily"),
+        connection(2, budget_msat=1000, budget_renewal="daily"),
+        connection(3, budget_msat=1000, spent_msat=500),
+        connection(4, budget_msat=1000, spent_msat=1200),
+    ])
+    # the budget renewed since
+    store.add_spend(f"{1:064x}", 900, now - 2 * 24 * 60 * 60)
+    store.add_spend(f"{2:064x}", 100, now - 2 * 24 * 60 * 60)
+    store.add_spend(f"{2:064x}", 700, now)
+
+    pubkeys = lambda **kw: [row["pubkey"][-1] for row in store.page(**kw)[0]]
+    assert pubkeys(min_budget_used_pct=50) == ["2", "3", "4"]
+    assert pubkeys(min_budget_used_pct=80) == ["4"]
+    # over budget counts as 0 remaining, as nwc-list shows it
+    assert pubkeys(sort="remaining_budget_msat") == ["4", "2", "3", "1"]
+    walked = pages(store, 1, sort="-remaining_budget_msat")
+    assert [page[0][-1] for page in walked] == ["1", "3", "2", "4"]
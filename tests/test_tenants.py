@@ -0,0 +1,90 @@
+import pytest
+from lib.store import DEFAULT_TENANT, ConnectionStore
+from lib.tenants import TenantRegistry
+
+KEYS = iter(f"{n:064x}" for n in range(1, 100))
+
+
+class Rpc:
+    """a datastore, and makesecret handing out the next key"""
+
+    def __init__(self):
+        self.datastore_values = {}
+
+    def listdatastore(self, key):
+        return {"datastore": [{"key": list(k), "string": value}
+                              for k, value in self.datastore_values.items()
+                              if list(k[:len(key)]) == key]}
+
+    def datastore(self, key, string):
+        self.datastore_values[tuple(key)] = string
+
+    def makesecret(self, hex):
+        return {"secret": next(KEYS)}
+
+
+class Plugin:
+    def __init__(self):
+        self.rpc = Rpc()
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ConnectionStore(str(tmp_path / "connections.sqlite3"))
+    yield store
+    store.close()
+
+
+def test_default_tenant_created_once(store):
+    plugin = Plugin()
+    tenants = TenantRegistry(store)
+    tenants.load(plugin)
+    assert len(tenants) == 1 and tenants.get() is tenants.default
+    assert [record["name"] for record in store.tenants()] == [DEFAULT_TENANT]
+
+    reloaded = TenantRegistry(store)
+    reloaded.load(plugin)
+    assert reloaded.default.pubkey == tenants.default.pubkey
+
+
+def test_budgets(store):
+    plugin = Plugin()
+    tenants = TenantRegistry(store)
+    tenants.load(plugin)
+    tenant = tenants.create(plugin, "shop", budget_msat=10000)
+    assert tenants.for_event({"tags": [["p", tenant.pubkey]]}) is tenant
+    assert tenants.for_event({"tags": [["p", "00" * 32]]}) is None
+    assert tenants.stats()["unknown_pubkey"] == 1
+
+    tenants.add_spend("shop", 4000)
+    assert tenant.remaining_budget() == 6000
+    tenants.add_spend("shop", 7000)
+    assert tenant.remaining_budget() == 0
+    assert tenants.default.remaining_budget() is None
+
+    # a renewing budget counts the current window only
+    tenants.create(plugin, "shop", budget_msat=10000, budget_renewal="daily")
+    assert tenant.window_spent() == 0 and tenant.spent_msat == 11000
+    tenants.add_spend("shop", 1000)
+    assert tenant.stats()["remaining_budget_msat"] == 9000
+
+    with pytest.raises(ValueError):
+        tenants.create(plugin, "bad", budget_renewal="hourly")
+    with pytest.raises(ValueError):
+        tenants.create(plugin, "")
+    assert tenants.get("bad") is None
+
+
+def test_reload_picks_up_new_tenants_and_budgets(store):
+    plugin = Plugin()
+    tenants = TenantRegistry(store)
+    tenants.load(plugin)
+    other = TenantRegistry(store)
+    other.load(plugin)
+    other.create(plugin, "shop", budget_msat=5000)
+
+    tenants.load(plugin)
+    assert tenants.get("shop").budget_msat == 5000
+    other.create(plugin, "shop", budget_msat=8000)
+    tenants.load(plugin)
+    assert tenants.get("shop").budget_msat == 8000
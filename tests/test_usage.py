@@ -0,0 +1,82 @@
+import pytest
+from lib.usage import ConnectionUsage, RequestUsage, UsageTracker, WINDOW_MINUTES
+
+PUBKEY = "ab" * 32
+NOW = 1700000000
+
+
+def request(method="get_info", **kwargs):
+    return RequestUsage(PUBKEY, method, **kwargs)
+
+
+def test_window_totals():
+    usage = ConnectionUsage()
+    usage.add_request(request(rpc_seconds=0.0015), NOW)
+    usage.add_request(request("pay_invoice", paid_msat=1000), NOW + 60)
+    usage.add_request(request("pay_invoice", error=True), NOW + 120)
+    usage.add_request(request("no_such_method", error=True), NOW + 120)
+    usage.add_request(request(None), NOW + 121)
+
+    window = usage.window(NOW + 180)
+    assert window == {
+        "requests": 5,
+        "errors": 2,
+        "paid_msat": 1000,
+        "rpc_ms": 1.5,
+        "by_method": {"get_info": 1, "pay_invoice": 2, "other": 2}
+    }
+    assert [minute["requests"] for minute in usage.per_minute(NOW + 180)] == [
+        {"get_info": 1}, {"pay_invoice": 1}, {"pay_invoice": 1, "other": 2}]
+
+
+def test_old_minutes_leave_the_window():
+    usage = ConnectionUsage()
+    usage.add_request(request(), NOW)
+    usage.add_request(request(), NOW + 30 * 60)
+    assert usage.window(NOW + 30 * 60)["requests"] == 2
+    assert usage.window(NOW + WINDOW_MINUTES * 60)["requests"] == 1
+    assert usage.window(NOW + 2 * WINDOW_MINUTES * 60)["requests"] == 0
+    # the lifetime counters stay
+    assert usage.summary(NOW + 2 * WINDOW_MINUTES * 60)["since_start"]["requests"] == 2
+
+
+def test_reused_slot_is_cleared():
+    usage = ConnectionUsage()
+    usage.add_request(request("pay_invoice", paid_msat=500, error=True), NOW)
+    # the same slot, an hour later
+    usage.add_request(request(), NOW + WINDOW_MINUTES * 60)
+    window = usage.window(NOW + WINDOW_MINUTES * 60)
+    assert window["by_method"] == {"get_info": 1}
+    assert window["errors"] == 0
+    assert window["paid_msat"] == 0
+    assert usage.paid_msat == 500
+
+
+def test_payment_outside_a_request():
+    usage = ConnectionUsage()
+    usage.add_payment(0, NOW)
+    usage.add_payment(2500, NOW)
+    summary = usage.summary(NOW)
+    assert summary["last_hour"]["paid_msat"] == 2500
+    assert summary["last_hour"]["requests"] == 0
+    assert summary["last_seen"] is None
+
+
+def test_tracker():
+    tracker = UsageTracker()
+    assert tracker.summary(PUBKEY) is None
+    for _ in range(3):
+        tracker.add(request())
+    tracker.add(RequestUsage("cd" * 32, "pay_invoice", paid_msat=9000))
+    tracker.add_payment("ef" * 32, 100)
+    assert len(tracker) == 3
+
+    assert [row["pubkey"] for row in tracker.top()][:2] == [PUBKEY, "cd" * 32]
+    assert tracker.top("paid_msat", limit=1)[0]["pubkey"] == "cd" * 32
+    assert tracker.detail(PUBKEY)["last_hour"]["by_method"] == {"get_info": 3}
+    with pytest.raises(ValueError):
+        tracker.top("pubkey")
+
+    tracker.remove(PUBKEY)
+    assert tracker.detail(PUBKEY) is None
+    assert len(tracker) == 2